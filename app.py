@@ -1,25 +1,37 @@
 import re
-from base64 import b64encode
+import time
 import pandas as pd
 
-from flask import Flask, render_template, redirect, flash, url_for, request
+from flask import Flask, render_template, redirect, flash, url_for, request, abort, make_response, g
 from flask_login import LoginManager, current_user, login_user, login_required, logout_user
 from werkzeug.urls import url_parse
 from wtforms.validators import ValidationError
-from sqlalchemy.sql import text
 
-from src.create_db import UserData, SurveyManager
+from src.create_db import SurveyManager, is_seed_name
 from src.forms import Registration
 from src.forms import LoginForm
-from config.flaskconfig import MAX_ROWS_SHOW
+from src.photos import image_mimetype
+from src.jobs import RegistrationQueue
+from src.metrics import METRICS, REQUEST_SECONDS, timer
+from config.flaskconfig import MAX_ROWS_SHOW, PHOTO_MAX_AGE, REGISTRATION_MODE
 
 # default template_folder path is 'templates' in root directory if no template folder is specified
 app = Flask(__name__, template_folder='app/templates', static_folder="app/static")
 app.config.from_pyfile('config/flaskconfig.py')
 sm = SurveyManager(app=app)
+registrations = RegistrationQueue(sm) if REGISTRATION_MODE == 'async' else None
 login = LoginManager(app)
 login.login_view = 'login'
 
+METRICS.collector('model_registry', sm.registry.metrics)
+# the match index is replaced by every full reload, so look it up at scrape time
+METRICS.collector('match_index', lambda: sm.match_index.metrics())
+METRICS.collector('match_cache', sm.match_cache.metrics)
+METRICS.collector('photo_cache', sm.photo_cache.metrics)
+METRICS.collector('db_pool', sm.pool_metrics)
+if registrations:
+    METRICS.collector('registration_queue', registrations.metrics)
+
 
 class RegistrationForm(Registration):
     """Update registration form with validation functionality."""
@@ -31,8 +43,8 @@ class RegistrationForm(Registration):
 
         Returns: None
         """
-        user = sm.session.query(UserData).filter_by(name=username.data).first()
-        if user is not None:
+        if is_seed_name(username.data) or sm.username_exists(username.data) or \
+                (registrations and registrations.is_queued(username.data)):
             raise ValidationError('Please use a different username.')
         if len(username.data) > 50:
             raise ValidationError('Username cannot be longer than 50 characters.')
@@ -48,15 +60,44 @@ class RegistrationForm(Registration):
             raise ValidationError('Password cannot be longer than 32 characters.')
 
 
+def render(template, **context):
+    """`render_template`, timed as the 'render' stage."""
+    with timer('render'):
+        return render_template(template, **context)
+
+
+@app.before_request
+def start_timer():
+    """Decide whether the request is sampled and note when it started."""
+    g.request_started = time.perf_counter()
+    METRICS.start_request()
+
+
+@app.after_request
+def record_latency(response):
+    """Record the latency of a sampled request by route, method and status."""
+    started = g.get('request_started')
+    if started is not None and request.endpoint != 'metrics' and METRICS.sampled():
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                request.method, str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def end_request(exception=None):
+    """Forget the sampling decision of the request, even if it failed."""
+    METRICS.end_request()
+
+
 @login.user_loader
 def user_loader(id):
-    """Load user.
+    """Load user; Flask-Login calls this at most once per request and keeps it as `current_user`.
     Args:
         id: int - user id
 
-    Returns: None
+    Returns: :obj: UserData - user record without the password and legacy photo columns
     """
-    return sm.session.query(UserData).get(int(id))
+    return sm.load_user(int(id))
 
 
 @app.route('/')
@@ -64,46 +105,37 @@ def user_loader(id):
 @login_required
 def index():
     """Index page/homepage."""
-    norm = current_user.factor1 ** 2 + \
-           current_user.factor2 ** 2 + \
-           current_user.factor3 ** 2 + \
-           current_user.factor4 ** 2 + \
-           current_user.factor5 ** 2 + \
-           current_user.factor6 ** 2 + \
-           current_user.factor7 ** 2 + \
-           current_user.factor8 ** 2 + \
-           current_user.factor9 ** 2 + \
-           current_user.factor10 ** 2 + \
-           current_user.factor11 ** 2 + \
-           current_user.factor12 ** 2
-    match = text(f'SELECT (factor1 * {current_user.factor1} + '
-                 f'factor2 * {current_user.factor2} + '
-                 f'factor3 * {current_user.factor3} + '
-                 f'factor4 * {current_user.factor4} + '
-                 f'factor5 * {current_user.factor5} + '
-                 f'factor6 * {current_user.factor6} + '
-                 f'factor7 * {current_user.factor7} + '
-                 f'factor8 * {current_user.factor8} + '
-                 f'factor9 * {current_user.factor9} + '
-                 f'factor10 * {current_user.factor10} + '
-                 f'factor11 * {current_user.factor11} + '
-                 f'factor12 * {current_user.factor12}) /'
-                 f'(SQRT(factor1 * factor1 + factor2 * factor2 + factor3 * factor3 + '
-                 f'factor4 * factor4 + factor5 * factor5 + factor6 * factor6 + '
-                 f'factor7 * factor7 + factor8 * factor8 + factor9 * factor9 + '
-                 f'factor10 * factor10 + factor11 * factor11 + factor12 * factor12)'
-                 f' * SQRT({norm})) AS cosine, name, age, image, '
-                 f'CASE WHEN gender = 1 THEN "Male" '
-                 f'WHEN gender = 2 THEN "Female" '
-                 f'WHEN gender = 3 THEN "Non-binary" '
-                 f'ELSE NULL END AS sex '
-                 f'FROM user_data '
-                 f'WHERE cluster = {current_user.cluster} AND id <> {current_user.id} '
-                 f'ORDER BY cosine DESC '
-                 f'LIMIT {MAX_ROWS_SHOW};')
-    top_10 = sm.session.execute(match)
-    photo = current_user.image
-    return render_template('index.html', filestring=photo, top_10=top_10, title='Homepage')
+    top_10 = sm.find_matches(current_user, MAX_ROWS_SHOW)
+    return render('index.html', has_photo=current_user.has_photo, top_10=top_10, title='Homepage')
+
+
+@app.route('/photo/<int:user_id>')
+@login_required
+def photo(user_id):
+    """Profile photo of a user, cacheable by the browser and by proxies.
+    Args:
+        user_id: int - user id; pass `?size=thumb` for the fixed-size thumbnail
+
+    Returns: :obj: flask Response
+    """
+    photo = sm.get_photo(user_id, thumbnail=request.args.get('size') == 'thumb')
+    if photo is None:
+        abort(404)
+    data, etag = photo
+    response = make_response(data)
+    response.mimetype = image_mimetype(data)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = PHOTO_MAX_AGE
+    return response.make_conditional(request)
+
+
+@app.route('/metrics')
+def metrics():
+    """Latency histograms and component gauges of this worker, for a Prometheus scrape."""
+    response = make_response(METRICS.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -114,17 +146,22 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         username = form.username.data
-        user = sm.session.query(UserData).filter_by(name=username,
-                                                    password=form.password.data).first()
+        user = sm.authenticate(username, form.password.data)
         if user is None:
-            flash('Invalid username or password')
+            status = registrations.status(username) if registrations else None
+            if status is not None and status[0] in ('pending', 'running'):
+                flash('Your registration is still being processed. Please try again in a moment.')
+            elif status is not None and status[0] == 'failed':
+                flash('Your registration could not be completed. Please register again.')
+            else:
+                flash('Invalid username or password')
             return redirect(url_for('login'))
         login_user(user)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
             next_page = url_for('index')
         return redirect(next_page)
-    return render_template('login.html', title='Sign In', form=form)
+    return render('login.html', title='Sign In', form=form)
 
 
 @app.route('/logout')
@@ -140,28 +177,32 @@ def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
     form = RegistrationForm()
-    file_string = None
+    photo_data = None
     if form.validate_on_submit():
         # upload picture
         file = form.photo.data
         if file:
-            file_string = b64encode(file.read()).decode('utf-8')
+            photo_data = file.read()
         # organize survey data into np.array
         raw_data = {field.label.field_id: [field.data] for field in form if
                     re.match('^[A-Z]', field.label.field_id)}
         raw_data = {key: value if value != [None] else [0] for key, value in raw_data.items()}
         raw_df = pd.DataFrame.from_dict(raw_data, orient='columns')
         app.logger.debug('Raw_df created from user input.')
-        # add new user record
-        sm.add_user_record(username=form.username.data,
-                           password=form.password.data,
-                           survey=raw_df,
-                           age=form.age.data,
-                           gender=form.gender.data,
-                           image=file_string)
-        flash('Congratulations, you are now a registered user!')
+        # add new user record, or queue it for a background worker
+        add_user_record = registrations.submit if registrations else sm.add_user_record
+        add_user_record(username=form.username.data,
+                        password=form.password.data,
+                        survey=raw_df,
+                        age=form.age.data,
+                        gender=form.gender.data,
+                        image=photo_data)
+        if registrations:
+            flash('Thanks! Your registration is being processed; you can log in in a moment.')
+        else:
+            flash('Congratulations, you are now a registered user!')
         return redirect(url_for('login'))
-    return render_template('register.html', title='Register', form=form)
+    return render('register.html', title='Register', form=form)
 
 
 if __name__ == '__main__':
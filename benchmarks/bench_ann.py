@@ -0,0 +1,102 @@
+"""Benchmark recall@k and latency of the approximate match index against the exact sql ranking.
+
+Seeds a database with random users, takes the matches of a sample of them from the sql match
+query as ground truth, and reports for each number of cells probed the share of those
+matches the approximate index ('ann' backend) returns, with its latency next to the exact
+in-memory index ('index' backend) and the sql query ('sql' backend). By default a temporary
+sqlite file stands in for MySQL; pass `--engine-string` to use a real server.
+
+    python -m benchmarks.bench_ann --users 200000 --clusters 2 --nprobe 4 8 16 32
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.bench_match_query import seed
+from src.create_db import UserData
+from src.matching import MatchIndex, ApproximateMatchIndex, factor_vector, sql_matches, \
+    unpack_factors, user_norm
+
+
+def load(index, engine):
+    """Add every user in the database to an index and build its cells, as the index sync does."""
+    with engine.connect() as connection:
+        rows = connection.execute(sqlalchemy.select([UserData.id, UserData.cluster, UserData.norm,
+                                                     UserData.factors])).fetchall()
+    ids, clusters, norms, blobs = zip(*rows)
+    started = time.perf_counter()
+    index.add(ids, clusters, unpack_factors(blobs), norms=np.array(norms, dtype=np.float64))
+    index.build_cells()
+    return time.perf_counter() - started
+
+
+def time_queries(find, users):
+    """Ids returned by `find` for each user and the seconds each call took."""
+    results, times = [], []
+    for user in users:
+        started = time.perf_counter()
+        results.append(find(user))
+        times.append(time.perf_counter() - started)
+    return results, np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine-string', default=None,
+                        help='database to benchmark; defaults to a temporary sqlite file')
+    parser.add_argument('--users', type=int, default=200000, help='users seeded before the run')
+    parser.add_argument('--clusters', type=int, default=2, help='clusters the users are split in')
+    parser.add_argument('--queries', type=int, default=200, help='users whose matches are ranked')
+    parser.add_argument('--k', type=int, default=10, help='matches per query')
+    parser.add_argument('--cell-size', type=int, default=1000, help='average users per cell')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[2, 4, 8, 16, 32],
+                        help='numbers of cells probed to compare')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine_string = args.engine_string or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = sqlalchemy.create_engine(engine_string)
+        seed(engine, args.users, args.clusters)
+        session = sessionmaker(bind=engine)()
+        users = session.query(UserData).order_by(UserData.id) \
+            .filter(UserData.id % (args.users // args.queries) == 0).limit(args.queries).all()
+        session.expunge_all()
+        session.close()
+
+        with engine.connect() as connection:
+            truth, sql_times = time_queries(
+                lambda user: [match.id for match in sql_matches(connection, user, args.k)], users)
+        exact = MatchIndex()
+        load(exact, engine)
+        approximate = ApproximateMatchIndex(cell_size=args.cell_size)
+        build_seconds = load(approximate, engine)
+        print(f'{args.users} users in {args.clusters} clusters; approximate index built in '
+              f'{build_seconds:.2f}s')
+
+        print(f"{'backend':<18}{f'recall@{args.k}':>12}{'mean ms':>10}{'p50 ms':>10}"
+              f"{'p95 ms':>10}")
+        runs = [('sql', None, None), ('index', exact, None)] + \
+            [(f'ann nprobe={nprobe}', approximate, nprobe) for nprobe in args.nprobe]
+        for name, index, nprobe in runs:
+            if index is None:
+                results, times = truth, sql_times
+            else:
+                if nprobe:
+                    approximate.nprobe = nprobe
+                results, times = time_queries(
+                    lambda user: index.top_k(user.id, user.cluster, factor_vector(user), args.k,
+                                             norm=user_norm(user))[0].tolist(), users)
+            recall = np.mean([len(set(result) & set(expected)) / max(len(expected), 1)
+                              for result, expected in zip(results, truth)])
+            times = times * 1e3
+            print(f'{name:<18}{recall:>12.3f}{times.mean():>10.3f}'
+                  f'{np.percentile(times, 50):>10.3f}{np.percentile(times, 95):>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
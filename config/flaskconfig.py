@@ -7,7 +7,8 @@ logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
                     level=logging.INFO)
 
 # data source
-DATA_SOURCE = 'http://openpsychometrics.org/_rawdata/16PF.zip'
+# data source; a file:// url of a local copy of the archive also works
+DATA_SOURCE = os.environ.get('DATA_SOURCE', 'http://openpsychometrics.org/_rawdata/16PF.zip')
 
 # s3 credentials
 S3_BUCKET = os.environ.get("S3_BUCKET")
@@ -28,6 +29,15 @@ if SQLALCHEMY_DATABASE_URI is None:
     else:
         SQLALCHEMY_DATABASE_URI = f"{conn_type}://{user}:{password}@{host}:{port}/{db_name}"
 
+# connection pool of the database engine (ignored for sqlite); connections idle longer than
+# DB_POOL_RECYCLE seconds are replaced before RDS/MySQL drops them (wait_timeout), and
+# DB_POOL_PRE_PING tests every connection on checkout so stale ones are never handed out
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'yes')
+
 DEBUG = True
 PORT = 5000
 APP_NAME = "A Fun App"
@@ -53,3 +63,48 @@ if FA_PATH is None:
 CA_PATH = os.environ.get('CA_PATH')
 if CA_PATH is None:
     CA_PATH = 'model/ca.pkl'
+SCORER_PATH = os.environ.get('SCORER_PATH')
+if SCORER_PATH is None:
+    SCORER_PATH = 'model/scorer'
+# manifest of the model version currently promoted, and the prefix every version is archived under
+MODEL_MANIFEST_PATH = os.environ.get('MODEL_MANIFEST_PATH')
+if MODEL_MANIFEST_PATH is None:
+    MODEL_MANIFEST_PATH = 'model/manifest.json'
+MODEL_VERSIONS_PATH = os.environ.get('MODEL_VERSIONS_PATH')
+if MODEL_VERSIONS_PATH is None:
+    MODEL_VERSIONS_PATH = 'model/versions'
+
+# seconds between checks for new fitted models in s3; 0 disables background refresh
+MODEL_REFRESH_INTERVAL = float(os.environ.get('MODEL_REFRESH_INTERVAL', 300))
+
+# matching backend for the homepage: 'index' (in-memory vector index), 'ann' (approximate
+# in-memory index for very large clusters), 'sql' (cosine in the database) or 'materialized'
+# (matches precomputed by `run.py refresh_matches`)
+MATCH_BACKEND = os.environ.get('MATCH_BACKEND', 'index')
+# 'ann' backend: clusters are split into cells of about MATCH_ANN_CELL_SIZE users and a query
+# only scans the MATCH_ANN_NPROBE cells closest to the user; more cells probed, better recall
+MATCH_ANN_CELL_SIZE = int(os.environ.get('MATCH_ANN_CELL_SIZE', 1000))
+MATCH_ANN_NPROBE = int(os.environ.get('MATCH_ANN_NPROBE', 8))
+# in-memory backends: also search this many clusters with the closest centroids to the user,
+# skipping those that cannot hold a better match; 0 only searches the user's own cluster
+MATCH_NEIGHBOR_CLUSTERS = int(os.environ.get('MATCH_NEIGHBOR_CLUSTERS', 0))
+# seconds between checks for users registered by other workers when using the in-memory index
+MATCH_INDEX_SYNC_INTERVAL = float(os.environ.get('MATCH_INDEX_SYNC_INTERVAL', 5))
+# seconds between full reloads of the index, which pick up clusters reassigned by a model update
+MATCH_INDEX_RELOAD_INTERVAL = float(os.environ.get('MATCH_INDEX_RELOAD_INTERVAL', 900))
+# number of users whose homepage matches are cached per worker; 0 disables the cache
+MATCH_CACHE_SIZE = int(os.environ.get('MATCH_CACHE_SIZE', 1024))
+# number of decoded profile photos cached per worker, and how long browsers/proxies may cache them
+PHOTO_CACHE_SIZE = int(os.environ.get('PHOTO_CACHE_SIZE', 512))
+PHOTO_MAX_AGE = int(os.environ.get('PHOTO_MAX_AGE', 86400))
+# width and height in pixels of the thumbnails shown next to matches
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 96))
+# 'sync' scores and stores registrations on the request thread; 'async' queues them to
+# REGISTRATION_WORKERS background threads and returns immediately
+REGISTRATION_MODE = os.environ.get('REGISTRATION_MODE', 'sync')
+REGISTRATION_WORKERS = int(os.environ.get('REGISTRATION_WORKERS', 2))
+# fraction of requests whose latency and stage timings are recorded for /metrics
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+# local cache of s3 artifacts (raw data, codebook, models); OFFLINE=1 only reads the cache
+DATA_CACHE_DIR = os.environ.get('DATA_CACHE_DIR', 'data/cache')
+OFFLINE = os.environ.get('OFFLINE', '').lower() in ('1', 'true', 'yes')
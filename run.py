@@ -1,5 +1,9 @@
 import argparse
+import sqlalchemy
 from src.ingest import Ingest
+from src.scoring import LinearScorer
+from src.migrations import Migrator, explain_hot_queries
+from config.flaskconfig import SQLALCHEMY_DATABASE_URI, MAX_ROWS_SHOW
 import src.create_db as create_db
 
 if __name__ == '__main__':
@@ -14,8 +18,44 @@ if __name__ == '__main__':
     # Sub-parser for creating a database
     sb_create = subparsers.add_parser("create_db", description="Create database")
 
-    # Sub-parser for uploading optional seed data (100 anonymized records) to database
+    # Sub-parser for uploading optional seed data (anonymized records) to database
     sb_seed = subparsers.add_parser("upload_seed", description="Upload seed data to database")
+    sb_seed.add_argument("-n", "--n-records", type=int, default=None,
+                         help="number of seed records to upload; defaults to the full dataset")
+    sb_seed.add_argument("--chunk-size", type=int, default=5000,
+                         help="number of records inserted per transaction")
+    sb_seed.add_argument("--no-resume", dest="resume", action="store_false",
+                         help="upload from the first record even if some were already loaded")
+
+    # Sub-parser for adding and backfilling precomputed factor norms on an existing table
+    sb_norms = subparsers.add_parser("backfill_norms",
+                                     description="Store factor norms for existing records")
+
+    # Sub-parser for converting legacy base64 photos to binary storage with thumbnails
+    sb_photos = subparsers.add_parser("migrate_photos",
+                                      description="Move base64 photos to the photos table")
+
+    # Sub-parser for packing the factor columns of existing records into the binary factors column
+    sb_pack = subparsers.add_parser("pack_factors",
+                                    description="Store packed factor vectors for existing records")
+
+    # Sub-parser for applying pending schema migrations to an existing database
+    sb_migrate = subparsers.add_parser("migrate", description="Apply pending schema migrations and "
+                                                              "show query plans before and after")
+
+    # Sub-parser for precomputing the matches of every user into the user_matches table
+    sb_matches = subparsers.add_parser("refresh_matches",
+                                       description="Precompute matches of clusters that changed")
+    sb_matches.add_argument("-k", type=int, default=MAX_ROWS_SHOW,
+                            help="number of matches stored per user")
+    sb_matches.add_argument("--workers", type=int, default=None,
+                            help="worker processes; defaults to the number of cores")
+    sb_matches.add_argument("--full", action="store_true",
+                            help="recompute every cluster, not only those that changed")
+
+    # Sub-parser for exporting the compact scoring artifact from the pickled models in s3
+    sb_scorer = subparsers.add_parser("export_scorer",
+                                      description="Export the scoring artifact used by the app")
 
     # Sub-parser for clearing table
     sb_clear = subparsers.add_parser("clear_table", description="Clear all records from table")
@@ -34,9 +74,47 @@ if __name__ == '__main__':
 
     elif sp_used == 'upload_seed':
         sm = create_db.SurveyManager()
-        sm.upload_seed_data_to_rds()
+        sm.upload_seed_data_to_rds(n_records=args.n_records, chunk_size=args.chunk_size,
+                                   resume=args.resume)
+        sm.close()
+
+    elif sp_used == 'backfill_norms':
+        sm = create_db.SurveyManager()
+        sm.backfill_norms()
+        sm.close()
+
+    elif sp_used == 'migrate_photos':
+        sm = create_db.SurveyManager()
+        sm.migrate_photos()
+        sm.close()
+
+    elif sp_used == 'pack_factors':
+        sm = create_db.SurveyManager()
+        sm.pack_factors()
         sm.close()
 
+    elif sp_used == 'migrate':
+        engine = sqlalchemy.create_engine(SQLALCHEMY_DATABASE_URI)
+        migrator = Migrator(engine)
+        before = explain_hot_queries(engine)
+        applied = migrator.migrate()
+        after = explain_hot_queries(engine)
+        for name in before:
+            print(f'-- {name} query plan before migrating:')
+            print('\n'.join(before[name]))
+            print(f'-- {name} query plan after migrating:')
+            print('\n'.join(after[name]))
+        print(f'{len(applied)} migration(s) applied.')
+
+    elif sp_used == 'refresh_matches':
+        sm = create_db.SurveyManager()
+        sm.refresh_matches(k=args.k, workers=args.workers, full=args.full)
+        sm.close()
+
+    elif sp_used == 'export_scorer':
+        ingest = Ingest()
+        ingest.upload_scorer_to_s3(LinearScorer.from_models(*ingest.download_model_from_s3()))
+
     elif sp_used == 'clear_table':
         sm = create_db.SurveyManager()
         sm.clear_table()
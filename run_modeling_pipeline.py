@@ -1,8 +1,14 @@
 import argparse
+import pickle
+import yaml
+import numpy as np
 import pandas as pd
 
 from src.ingest import Ingest
-from src.modeling import OfflineModeling
+from src.create_db import SurveyManager
+from src.sweep import run_sweep
+from src.modeling import OfflineModeling, score_survey, read_survey, read_table, write_table, \
+    compact_dtypes
 from config.flaskconfig import logging
 
 logger = logging.getLogger(__name__)
@@ -15,18 +21,59 @@ if __name__ == '__main__':
 
     # Sub-parser for downloading data
     sb_download = subparsers.add_parser("download_data", description="Download data from s3")
-    sb_download.add_argument("-o", '--output', default=None, help="local_output_filepath")
+    sb_download.add_argument("-o", '--output', default=None,
+                             help="local_output_filepath (.csv/.parquet/.feather)")
 
     # Sub-parser for generating features
     sb_fa = subparsers.add_parser("generate_features",
                                   description="generate features with factor analysis")
-    sb_fa.add_argument("-i", '--input', default=None, help="local_input_filepath")
-    sb_fa.add_argument("-o", '--output', default=None, help="local_output_filepath")
+    sb_fa.add_argument("-i", '--input', default=None,
+                       help="local_input_filepath (.csv/.parquet/.feather/.npy)")
+    sb_fa.add_argument("-o", '--output', default=None,
+                       help="local_output_filepath (.csv/.parquet/.feather/.npy)")
 
     # Sub-parser for training model
     sb_ca = subparsers.add_parser("train_model", description="train model with cluster analysis")
-    sb_ca.add_argument("-i", '--input', default=None, help="local_input_filepath")
-    sb_ca.add_argument("-o", '--output', default=None, help="local_output_filepath")
+    sb_ca.add_argument("-i", '--input', default=None,
+                       help="local_input_filepath (.csv/.parquet/.feather/.npy)")
+    sb_ca.add_argument("-o", '--output', default=None,
+                       help="local_output_filepath (.csv/.parquet/.feather/.npy)")
+
+    # Sub-parser for batch scoring raw survey responses with fitted models
+    sb_score = subparsers.add_parser("score", description="score survey responses in chunks")
+    sb_score.add_argument("-i", '--input', required=True,
+                          help="local_input_filepath (.csv/.parquet)")
+    sb_score.add_argument("-o", '--output', required=True,
+                          help="local_output_filepath (.csv/.parquet)")
+    sb_score.add_argument("--chunk-size", type=int, default=10000, help="rows scored at a time")
+    sb_score.add_argument("--fa", default=None,
+                          help="local pickled factor analysis model; defaults to the model in s3")
+    sb_score.add_argument("--ca", default=None,
+                          help="local pickled cluster analysis model; defaults to the model in s3")
+
+    # Sub-parser for folding new registrations into the cluster model
+    sb_update = subparsers.add_parser("update_clusters",
+                                      description="update the cluster model with users registered "
+                                                  "since the last model version and reassign users")
+    sb_update.add_argument("--batch-size", type=int, default=10000,
+                           help="user records read or reassigned at a time")
+
+    # Sub-parser for a parallel hyperparameter sweep; unset grids default to config/modeling.yaml
+    sb_sweep = subparsers.add_parser("sweep", description="fit models over a grid of factor "
+                                                          "counts, rotations and cluster counts")
+    sb_sweep.add_argument("-i", '--input', default=None,
+                          help="local_input_filepath (.csv/.parquet/.feather/.npy); "
+                               "defaults to the raw data in s3")
+    sb_sweep.add_argument("-o", '--output', default=None,
+                          help="local_output_filepath of the results table "
+                               "(.csv/.parquet/.feather)")
+    sb_sweep.add_argument("--n-factors", type=int, nargs='+', default=None, help="factor counts")
+    sb_sweep.add_argument("--rotations", nargs='+', default=None, help="factor rotations")
+    sb_sweep.add_argument("--n-clusters", type=int, nargs='+', default=None, help="cluster counts")
+    sb_sweep.add_argument("--workers", type=int, default=None,
+                          help="worker processes; defaults to the number of cores")
+    sb_sweep.add_argument("--sample-size", type=int, default=None,
+                          help="rows sampled for the silhouette score")
 
     args = parser.parse_args()
     sp_used = args.command
@@ -37,21 +84,58 @@ if __name__ == '__main__':
         output = Ingest().download_data_from_s3()[0]
 
     elif sp_used == 'generate_features':
-        data = pd.read_csv(args.input)
-        survey = data.iloc[:, 1:164]
+        survey = read_survey(args.input)
 
         # fit and transform raw survey data with factor analysis
         model.fa.fit(survey)
         arrays = model.fa.transform(survey)
-        output = pd.DataFrame(arrays)
+        output = pd.DataFrame(arrays, columns=[f'factor{i + 1}' for i in range(arrays.shape[1])])
 
     elif sp_used == 'train_model':
-        data = pd.read_csv(args.input).values
+        data = np.asarray(read_table(args.input))
         model.ca.fit(data)
         clusters = model.ca.labels_
         logger.info('Clusters generated.')
         output = None
 
-    if args.output:
-        output.to_csv(args.output, index=False)
+    elif sp_used == 'score':
+        if args.fa and args.ca:
+            with open(args.fa, 'rb') as fa_file, open(args.ca, 'rb') as ca_file:
+                fa, ca = pickle.load(fa_file), pickle.load(ca_file)
+        else:
+            fa, ca = Ingest().download_model_from_s3()
+        score_survey(args.input, args.output, fa, ca, chunk_size=args.chunk_size)
+        output = None
+
+    elif sp_used == 'update_clusters':
+        sm = SurveyManager()
+        manifest = sm.update_cluster_model(batch_size=args.batch_size)
+        if manifest is not None:
+            logger.info('Model version %d promoted; %d new users absorbed.',
+                        manifest['version'], manifest['n_new_users'])
+        sm.close()
+        output = None
+
+    elif sp_used == 'sweep':
+        with open('config/modeling.yaml', 'r') as f:
+            config = yaml.safe_load(f)['sweep']
+        if args.input:
+            survey = read_survey(args.input)
+        else:
+            survey = Ingest().download_data_from_s3()[0].iloc[:, 1:164]
+        output = run_sweep(survey.values,
+                           n_factors=args.n_factors or config['n_factors'],
+                           rotations=args.rotations or config['rotation'],
+                           n_clusters=args.n_clusters or config['n_clusters'],
+                           workers=args.workers,
+                           sample_size=args.sample_size or config['sample_size'],
+                           random_state=config['random_state'])
+        logger.info('Best settings:\n%s', output.head(10).to_string(index=False))
+
+    else:
+        parser.print_help()
+        output = None
+
+    if output is not None and args.output:
+        write_table(compact_dtypes(output), args.output)
         logger.info('Output saved to %s.', args.output)
@@ -0,0 +1,105 @@
+import glob
+import os
+from io import BytesIO
+
+import pandas as pd
+
+from config.flaskconfig import logging, S3_BUCKET, DATA_CACHE_DIR, OFFLINE
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactCache:
+    """Local copies of s3 objects, content-addressed by their ETag.
+
+    Every object gets a directory under `root` named after its key; each version is a file
+    named after its ETag, so a changed object is downloaded once and unchanged objects are
+    only checked with a HEAD request. Tables are stored as parquet for fast reloads. In
+    offline mode s3 is never contacted and the newest local copy is used.
+    """
+
+    def __init__(self, s3, bucket=S3_BUCKET, root=DATA_CACHE_DIR, offline=OFFLINE):
+        """
+        Args:
+            s3: :obj: boto3 s3 client
+            bucket: str - s3 bucket name
+            root: str - local cache directory
+            offline: bool - never contact s3, only use local copies
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.root = root
+        self.offline = offline
+
+    def get_frame(self, key):
+        """Read a csv object from s3 as a DataFrame, through the local parquet cache.
+
+        Args:
+            key: str - object key in the bucket
+
+        Returns: :obj: pandas DataFrame
+        """
+        path = self._current(key, '.parquet')
+        if path is not None:
+            return pd.read_parquet(path)
+        body, etag = self._download(key)
+        data = pd.read_csv(BytesIO(body))
+        self._store(key, etag, '.parquet', lambda tmp: data.to_parquet(tmp, index=False))
+        return data
+
+    def get_bytes(self, key):
+        """Read an object from s3 as bytes, through the local cache.
+
+        Args:
+            key: str - object key in the bucket
+
+        Returns: bytes - object contents
+        """
+        path = self._current(key, '.bin')
+        if path is not None:
+            with open(path, 'rb') as f:
+                return f.read()
+        body, etag = self._download(key)
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                f.write(body)
+        self._store(key, etag, '.bin', write)
+        return body
+
+    def _directory(self, key):
+        return os.path.join(self.root, key.replace('/', '__'))
+
+    def _current(self, key, suffix):
+        """Path of the local copy of the current version of `key`, or None if it is not cached."""
+        directory = self._directory(key)
+        if self.offline:
+            copies = glob.glob(os.path.join(directory, f'*{suffix}'))
+            if not copies:
+                raise FileNotFoundError(f'No local copy of s3://{self.bucket}/{key} in '
+                                        f'{directory}; '
+                                        f'run once with network access to fill the cache.')
+            return max(copies, key=os.path.getmtime)
+        etag = self.s3.head_object(Bucket=self.bucket, Key=key)['ETag'].strip('"')
+        path = os.path.join(directory, f'{etag}{suffix}')
+        if os.path.exists(path):
+            logger.info('Using cached copy of %s.', key)
+            return path
+        return None
+
+    def _download(self, key):
+        result = self.s3.get_object(Bucket=self.bucket, Key=key)
+        return result['Body'].read(), result['ETag'].strip('"')
+
+    def _store(self, key, etag, suffix, write):
+        """Write a version of `key` atomically and remove older versions."""
+        directory = self._directory(key)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{etag}{suffix}')
+        tmp = f'{path}.tmp'
+        write(tmp)
+        os.replace(tmp, path)
+        for old in glob.glob(os.path.join(directory, f'*{suffix}')):
+            if old != path:
+                os.remove(old)
+        logger.info('%s cached at %s.', key, path)
@@ -0,0 +1,141 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe, size-bounded cache that evicts the least recently used entry."""
+
+    def __init__(self, maxsize):
+        """
+        Args:
+            maxsize: int - maximum number of entries; 0 disables caching
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Look up `key`, marking it as most recently used."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store `value` under `key`, evicting the least recently used entry if full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._put(key, value)
+
+    def pop(self, key, default=None):
+        """Remove `key` and return its value."""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def metrics(self):
+        """Counters for monitoring.
+
+        Returns: dict - hits, misses, evictions, hit ratio and current size
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0, 'size': len(self._data)}
+
+    def _put(self, key, value):
+        """Store an entry; the caller holds the lock."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._evict(*self._data.popitem(last=False))
+            self.evictions += 1
+
+    def _evict(self, key, value):
+        """Hook called (with the lock held) for every entry evicted to make room."""
+
+
+class MatchCache(LRUCache):
+    """Top-k match results keyed by user id, invalidated per cluster.
+
+    A user's matches only change when someone joins a cluster they were searched in (their
+    own, plus neighbouring ones with cross-cluster matching), so inserting a user drops the
+    cached results of everyone whose matches came from that cluster.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self._members = {}
+        self._generations = {}
+
+    def generation(self, cluster):
+        """Counter bumped by every invalidation of `cluster`; read it before computing matches."""
+        return self._generations.get(cluster, 0)
+
+    def get_matches(self, user_id, cluster):
+        """Cached matches of a user, or None if missing or computed for another cluster."""
+        entry = self.get(user_id)
+        if entry is None or entry[0] != cluster:
+            return None
+        return entry[1]
+
+    def put_matches(self, user_id, cluster, matches, generation, neighbours=None):
+        """Cache matches unless a cluster they came from was invalidated since they were computed.
+
+        Args:
+            user_id: int - id of the user the matches were computed for
+            cluster: int - cluster of the user
+            matches: list - match rows
+            generation: int - value of `generation(cluster)` before the matches were computed
+            neighbours: dict - `generation` of every other cluster searched, keyed by cluster
+
+        Returns: None
+        """
+        if self.maxsize <= 0:
+            return
+        generations = {**(neighbours or {}), cluster: generation}
+        with self._lock:
+            if any(self._generations.get(c, 0) != g for c, g in generations.items()):
+                return
+            previous = self._data.get(user_id)
+            if previous is not None:
+                self._evict(user_id, previous)
+            for searched in generations:
+                self._members.setdefault(searched, set()).add(user_id)
+            self._put(user_id, (cluster, matches, tuple(generations)))
+
+    def invalidate_cluster(self, cluster):
+        """Drop the cached matches of every user whose matches came from `cluster`."""
+        with self._lock:
+            self._generations[cluster] = self._generations.get(cluster, 0) + 1
+            for user_id in self._members.pop(cluster, ()):
+                entry = self._data.pop(user_id, None)
+                if entry is not None:
+                    self._evict(user_id, entry)
+
+    def clear(self):
+        """Remove every entry and invalidate results being computed concurrently."""
+        with self._lock:
+            self._data.clear()
+            self._members.clear()
+            for cluster in self._generations:
+                self._generations[cluster] += 1
+
+    def _evict(self, key, value):
+        for searched in value[2]:
+            self._members.get(searched, set()).discard(key)
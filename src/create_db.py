@@ -1,18 +1,41 @@
+import datetime
+import threading
+import time
+from base64 import b64decode
+
 import sqlalchemy
+import numpy as np
+import pandas as pd
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, BigInteger, String, Float, LargeBinary, DateTime, or_, \
+    func, bindparam, exists
+from sqlalchemy.orm import sessionmaker, scoped_session, deferred, column_property, load_only
+from sqlalchemy.sql import text
 from sqlalchemy.exc import IntegrityError, InternalError
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 
-from config.flaskconfig import logging, SQLALCHEMY_DATABASE_URI, FA_PATH, CA_PATH
-from src.modeling import OfflineModeling
+from config.flaskconfig import logging, SQLALCHEMY_DATABASE_URI, MAX_ROWS_SHOW, MATCH_BACKEND, \
+    MATCH_INDEX_SYNC_INTERVAL, MATCH_INDEX_RELOAD_INTERVAL, MATCH_CACHE_SIZE, PHOTO_CACHE_SIZE, \
+    MATCH_NEIGHBOR_CLUSTERS
+from src.cache import LRUCache, MatchCache
+from src.matching import MatchIndex, ApproximateMatchIndex, Match, FACTOR_COLUMNS, GENDERS, \
+    PACKED_SIZE, factor_vector, factor_norm, user_norm, sql_matches, pack_factors, unpack_factors, \
+    factor_columns
 from src.ingest import Ingest
+from src.registry import get_registry
+from src.photos import photo_hash, make_thumbnail
+from src.pool import engine_options, pool_metrics
+from src.metrics import timer
+from src.scoring import LinearScorer, nearest_centroid
 
 Base = declarative_base()
 logger = logging.getLogger(__name__)
 
+# seed records are named f'{SEED_NAME} {i}' for their position i in the seed dataset; the
+# prefix is reserved, so a registration cannot pass for a seed record
+SEED_NAME = 'anonymous user'
+
 
 class UserData(UserMixin, Base):
     """Create a data model for the database to be set up for user survey"""
@@ -20,7 +43,8 @@ class UserData(UserMixin, Base):
     __tablename__ = 'user_data'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(50), unique=False, nullable=False)
+    # indexed for login and username checks; not unique since registration enforces it
+    name = Column(String(50), unique=False, nullable=False, index=True)
     password = Column(String(32), unique=False, nullable=False)
     factor1 = Column(Float, unique=False, nullable=False)
     factor2 = Column(Float, unique=False, nullable=False)
@@ -34,22 +58,135 @@ class UserData(UserMixin, Base):
     factor10 = Column(Float, unique=False, nullable=False)
     factor11 = Column(Float, unique=False, nullable=False)
     factor12 = Column(Float, unique=False, nullable=False)
-    cluster = Column(Integer, unique=False, nullable=False)
+    # the twelve factors packed as float64 (see `src.matching.pack_factors`), for bulk loading;
+    # the separate columns are kept for the sql match query
+    factors = Column(LargeBinary(PACKED_SIZE), unique=False, nullable=True)
+    norm = Column(Float, unique=False, nullable=True)
+    # indexed for the sql match query and the per-cluster model jobs
+    cluster = Column(Integer, unique=False, nullable=False, index=True)
     age = Column(Float, unique=False, nullable=True)
     gender = Column(Float, unique=False, nullable=True)
-    image = Column(String(28500), unique=False, nullable=True)
+    # legacy base64 photos; `run.py migrate_photos` moves them to the photos table. Deferred so
+    # loading a user never transfers them; `has_image` is computed by the database instead
+    image = deferred(Column(String(28500), unique=False, nullable=True))
+    has_image = column_property(image.columns[0].isnot(None))
+    photo_hash = Column(String(64), unique=False, nullable=True)
 
     def __repr__(self):
         return f'<Survey user {self.name} assigned to cluster {self.cluster}>'
 
+    @property
+    def has_photo(self):
+        return self.photo_hash is not None or bool(self.has_image)
+
+
+# columns loaded for the logged-in user: everything the homepage (index.html and
+# `find_matches`) reads, without the password
+SESSION_COLUMNS = ['id', 'name', 'age', 'cluster', 'norm', 'factors', 'photo_hash', 'has_image',
+                   *FACTOR_COLUMNS]
+
+
+class Photo(Base):
+    """Profile photos stored once per distinct content, keyed by their sha256 hash"""
+
+    __tablename__ = 'photos'
+
+    hash = Column(String(64), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    thumbnail = Column(LargeBinary, nullable=True)
+
+
+class RegistrationJob(Base):
+    """Registrations queued for background scoring, and what became of them"""
+
+    __tablename__ = 'registration_jobs'
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String(50), nullable=False, index=True)
+    # 'pending', 'running', 'done' or 'failed'
+    status = Column(String(10), nullable=False)
+    error = Column(String(255), nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class UserMatch(Base):
+    """Precomputed top matches of each user, refreshed by `run.py refresh_matches`"""
+
+    __tablename__ = 'user_matches'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    rank = Column(Integer, primary_key=True, autoincrement=False)
+    match_id = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+    # cluster the matches were computed in, so a cluster can be replaced as a whole
+    cluster = Column(Integer, nullable=False, index=True)
+
+
+class MatchCluster(Base):
+    """Membership of each cluster when its matches were last computed"""
+
+    __tablename__ = 'match_clusters'
+
+    cluster = Column(Integer, primary_key=True, autoincrement=False)
+    n_users = Column(Integer, nullable=False)
+    # order-independent hash of the ids of the users (see `src.materialize.cluster_signatures`)
+    members_hash = Column(BigInteger, nullable=False)
+    refreshed_at = Column(DateTime, nullable=False)
+
+
+def add_column(connection, name, ddl_type):
+    """Add a column to an existing user_data table unless it is already there.
+
+    Args:
+        connection: :obj: sqlalchemy Connection
+        name: str - column name
+        ddl_type: str - column type in sql, e.g. 'FLOAT'
+
+    Returns: bool - True if the column was added
+    """
+    columns = [column['name'] for column in
+               sqlalchemy.inspect(connection).get_columns(UserData.__tablename__)]
+    if name in columns:
+        return False
+    connection.execute(text(f'ALTER TABLE user_data ADD COLUMN {name} {ddl_type}'))
+    logger.info('%s column added to user_data.', name)
+    return True
+
+
+def create_index(connection, index):
+    """Create an index declared on a model unless its table already has it.
+
+    Args:
+        connection: :obj: sqlalchemy Connection
+        index: :obj: sqlalchemy Index - e.g. one of `UserData.__table__.indexes`
+
+    Returns: bool - True if the index was created
+    """
+    existing = {existing['name'] for existing in
+                sqlalchemy.inspect(connection).get_indexes(index.table.name)}
+    if index.name in existing:
+        return False
+    index.create(connection)
+    logger.info('Index %s created on %s.', index.name, index.table.name)
+    return True
+
 
 def create_new_db():
     """create database from provided engine string"""
+    # imported here since the migrations are defined in terms of the models in this module
+    from src.migrations import Migrator
     try:
         engine = sqlalchemy.create_engine(SQLALCHEMY_DATABASE_URI)
+        existing = UserData.__tablename__ in sqlalchemy.inspect(engine).get_table_names()
         Base.metadata.create_all(engine)
-        logger.warning('If a user_data table already exists, new schema will not be created.'
-                       'Check mysql database to ensure user_data does not exist.')
+        if existing:
+            # create_all leaves an existing table as it is; `run.py migrate` updates it
+            logger.warning('A user_data table already exists, new schema will not be created. '
+                           'Run `python run.py migrate` to bring it up to date.')
+        else:
+            # the new schema already includes every migration
+            Migrator(engine).stamp()
         logger.info("database created with given engine string credentials.")
     except sqlalchemy.exc.OperationalError:
         # Checking for correct credentials
@@ -60,20 +197,38 @@ def create_new_db():
 
 class SurveyManager(Ingest):
     """Class that interacts with specified database in engine string."""
-    def __init__(self, app=None, engine_string=SQLALCHEMY_DATABASE_URI):
+    def __init__(self, app=None, engine_string=SQLALCHEMY_DATABASE_URI, registry=None):
         """
         Args:
             app: Flask - Flask app
             engine_string: str - Engine string
+            registry: :obj: ModelRegistry - source of the LinearScorer; defaults to the
+                process-wide one
         """
         super().__init__()
+        self.registry = registry if registry is not None else get_registry(self.s3)
+        # exact in-memory index, or the approximate one for very large clusters
+        self.index_class = ApproximateMatchIndex if MATCH_BACKEND == 'ann' else MatchIndex
+        self.match_index = self.index_class()
+        self.neighbor_clusters = MATCH_NEIGHBOR_CLUSTERS if MATCH_BACKEND in ('index', 'ann') else 0
+        self.match_cache = MatchCache(MATCH_CACHE_SIZE)
+        self.photo_cache = LRUCache(PHOTO_CACHE_SIZE)
+        self._synced_at = None
+        self._loaded_at = None
+        # largest user id seen by the last sync of the sql backend, which has no index
+        self._last_id = 0
+        self._sync_lock = threading.Lock()
+        # background thread building a new match index or the cells of the current one
+        self._builder = None
         if app:
+            app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                                  engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
             self.db = SQLAlchemy(app)
             self.session = self.db.session
         elif engine_string:
-            self.engine = sqlalchemy.create_engine(engine_string)
-            Session = sessionmaker(bind=self.engine)
-            self.session = Session()
+            self.engine = sqlalchemy.create_engine(engine_string, **engine_options(engine_string))
+            # one session per thread, like Flask-SQLAlchemy, so background jobs can share it
+            self.session = scoped_session(sessionmaker(bind=self.engine))
         else:
             raise ValueError("Need either an engine string or a Flask app to initialize")
         logger.debug('Session successfully created.')
@@ -82,6 +237,36 @@ class SurveyManager(Ingest):
         """Closes session"""
         self.session.close()
 
+    def load_user(self, user_id):
+        """Load the logged-in user with only the columns the app reads from it.
+
+        Args:
+            user_id: int - user id
+
+        Returns: :obj: UserData - user record, or None if there is no such user
+        """
+        return self.session.query(UserData).options(load_only(*SESSION_COLUMNS)).get(user_id)
+
+    def authenticate(self, username, password):
+        """Look up a user by their credentials, using the index on `name`.
+
+        Args:
+            username: str - username
+            password: str - password
+
+        Returns: :obj: UserData - user record, or None if the credentials do not match
+        """
+        return self.session.query(UserData).options(load_only(*SESSION_COLUMNS)) \
+            .filter(UserData.name == username, UserData.password == password).first()
+
+    def username_exists(self, username):
+        """Check whether a username is taken without loading the user."""
+        return self.session.query(exists().where(UserData.name == username)).scalar()
+
+    def pool_metrics(self):
+        """Checkout wait and saturation metrics of the connection pool (empty for sqlite)."""
+        return pool_metrics(self.session.get_bind())
+
     def add_user_record(self, username, password, age, gender, survey, image):
         """Add user survey record to existing database.
 
@@ -91,39 +276,403 @@ class SurveyManager(Ingest):
             age: float - age
             gender: float - gender, one-hot encoded
             survey: :obj: pandas dataframe - user survey results as a dataframe with header
-            image: str - encoded image
+            image: bytes - uploaded photo
 
         Returns: None
         """
         session = self.session
-        fa, ca = self.download_model_from_s3()
-        pca_features = fa.transform(survey)
-        cluster = ca.predict(pca_features)[0]
+        scorer = self.registry.get()
+        with timer('transform'):
+            pca_features = scorer.transform(survey.values)
+        with timer('predict'):
+            cluster = scorer.predict(pca_features)[0]
         user_record = UserData(name=username, password=password,
                                age=float(age) if age else None,
                                gender=float(gender) if gender else None,
-                               factor1=float(pca_features[0][0]),
-                               factor2=float(pca_features[0][1]),
-                               factor3=float(pca_features[0][2]),
-                               factor4=float(pca_features[0][3]),
-                               factor5=float(pca_features[0][4]),
-                               factor6=float(pca_features[0][5]),
-                               factor7=float(pca_features[0][6]),
-                               factor8=float(pca_features[0][7]),
-                               factor9=float(pca_features[0][8]),
-                               factor10=float(pca_features[0][9]),
-                               factor11=float(pca_features[0][10]),
-                               factor12=float(pca_features[0][11]),
+                               **factor_columns(pca_features[0]),
+                               norm=float(factor_norm(pca_features[0])),
                                cluster=int(cluster),
-                               image=image)
+                               photo_hash=self.add_photo(image) if image else None)
         session.add(user_record)
+        with timer('db_commit'):
+            session.commit()
+        self.match_cache.invalidate_cluster(int(cluster))
+        if self._synced_at is not None:
+            self.sync_match_index(force=True)
+
+    def sync_match_index(self, force=False):
+        """Load users inserted since the last sync, by any worker, into the match index.
+
+        Every MATCH_INDEX_RELOAD_INTERVAL seconds a new index is built from scratch instead, so
+        clusters reassigned by `update_cluster_model` are eventually picked up by every worker.
+        The new index, and the cells of the approximate one, are built on a background thread
+        while requests keep using the current index; only the first load blocks. The sql
+        backend has no index, so only its match cache is kept in step the same way.
+
+        Args:
+            force: bool - sync even if the last sync is more recent than MATCH_INDEX_SYNC_INTERVAL
+
+        Returns: None
+        """
+        with self._sync_lock:
+            now = time.monotonic()
+            if not force and self._loaded_at is not None \
+                    and now - self._synced_at < MATCH_INDEX_SYNC_INTERVAL:
+                return
+            with timer('index_sync'):
+                reload = self._loaded_at is None \
+                    or now - self._loaded_at >= MATCH_INDEX_RELOAD_INTERVAL
+                rebuild = False
+                if MATCH_BACKEND == 'sql':
+                    self._sync_match_cache(reload)
+                    if reload:
+                        self._loaded_at = now
+                elif self._loaded_at is None:
+                    # nothing to serve yet; cells are left to the background thread
+                    index = self.index_class()
+                    self._add_new_users(index)
+                    self._swap_index(index, now)
+                else:
+                    for cluster in self._add_new_users(self.match_index):
+                        self.match_cache.invalidate_cluster(cluster)
+                    # the current index keeps serving until its replacement is built
+                    rebuild = reload
+                self._synced_at = now
+            if rebuild or self.match_index.stale_clusters():
+                self._start_index_build(rebuild)
+
+    def _add_new_users(self, index):
+        """Add the users inserted after the last one in an index to it.
+
+        Returns: set - clusters users were added to
+        """
+        rows = self.session.query(UserData.id, UserData.cluster, UserData.norm, UserData.factors) \
+            .filter(UserData.id > index.last_id) \
+            .order_by(UserData.id).all()
+        if not rows:
+            return set()
+        ids, clusters, norms, _ = zip(*rows)
+        index.add(ids, clusters, self._unpack_factors(rows),
+                  norms=np.array(norms, dtype=np.float64))
+        logger.debug('%d users added to the match index.', len(rows))
+        return set(clusters)
+
+    def _swap_index(self, index, loaded_at):
+        """Serve matches from a new index; call with `_sync_lock` held."""
+        self.match_index = index
+        self.match_cache.clear()
+        self._loaded_at = loaded_at
+
+    def _start_index_build(self, rebuild):
+        """Start building a new match index, or the cells of the current one, unless a build
+        is already running; call with `_sync_lock` held.
+
+        Args:
+            rebuild: bool - build a new index and swap it in; otherwise only build the cells
+                of `match_index.stale_clusters()`
+        """
+        if self._builder is not None and self._builder.is_alive():
+            return
+        self._builder = threading.Thread(target=self._build_index,
+                                         args=(rebuild, self._loaded_at),
+                                         name='match-index', daemon=True)
+        self._builder.start()
+
+    def _build_index(self, rebuild, loaded_at):
+        index = self.match_index
+        try:
+            if rebuild:
+                index = self.index_class()
+                self._add_new_users(index)
+            index.build_cells()
+            if rebuild:
+                with self._sync_lock:
+                    if self._loaded_at != loaded_at:
+                        return  # the index was cleared or reloaded meanwhile
+                    # users inserted during the build; few, so their cells can wait
+                    self._add_new_users(index)
+                    self._swap_index(index, time.monotonic())
+                logger.info('Match index rebuilt with %d users.', len(index))
+        except Exception:  # keep serving the current index if the database is unreachable
+            logger.exception('Match index build failed; keeping the current index.')
+        finally:
+            # do not keep this thread's session (and connection) around
+            self.session.remove()
+
+    def _sync_match_cache(self, reload):
+        """Invalidate the cached sql matches of clusters new users were inserted into."""
+        if reload:
+            self._last_id = self.session.query(func.max(UserData.id)).scalar() or 0
+            self.match_cache.clear()
+            return
+        for cluster, last_id in self.session.query(UserData.cluster, func.max(UserData.id)) \
+                .filter(UserData.id > self._last_id).group_by(UserData.cluster):
+            self.match_cache.invalidate_cluster(cluster)
+            self._last_id = max(self._last_id, last_id)
+
+    def find_matches(self, user, limit=MAX_ROWS_SHOW):
+        """Find the users most similar to `user`, best match first.
+
+        Matches come from the user's cluster and, if `neighbor_clusters` is set, from the
+        clusters whose centroids are closest to the user.
+
+        Args:
+            user: :obj: UserData - user to find matches for
+            limit: int - number of matches to return
+
+        Returns: list - rows with cosine, id, name, age, has_photo and sex attributes
+        """
+        if MATCH_BACKEND == 'materialized':
+            # a primary key lookup is as cheap as the match cache, so the cache is bypassed; the
+            # rows are as fresh as the last `refresh_matches` run
+            with timer('match_query'):
+                return self.materialized_matches(user, limit)
+        self.sync_match_index()
+        matches = self.match_cache.get_matches(user.id, user.cluster)
+        if matches is None:
+            generation = self.match_cache.generation(user.cluster)
+            neighbours = {cluster: self.match_cache.generation(cluster)
+                          for cluster in self.neighbours(user)}
+            with timer('match_query'):
+                matches = self._find_matches(user, limit, list(neighbours))
+            self.match_cache.put_matches(user.id, user.cluster, matches, generation, neighbours)
+        return matches
+
+    def neighbours(self, user):
+        """Other clusters to search for matches, by distance of their centroid to the user.
+
+        Args:
+            user: :obj: UserData - user to find matches for
+
+        Returns: list of int - up to `neighbor_clusters` clusters, closest first
+        """
+        if self.neighbor_clusters <= 0:
+            return []
+        centroids = self.registry.get().centroids
+        distances = np.sum((centroids - factor_vector(user)) ** 2, axis=1)
+        closest = [cluster for cluster in np.argsort(distances).tolist() if cluster != user.cluster]
+        return closest[:self.neighbor_clusters]
+
+    def _find_matches(self, user, limit, neighbours=()):
+        """Compute matches with the configured backend, bypassing the match cache."""
+        if MATCH_BACKEND == 'sql':
+            return sql_matches(self.session.connection(), user, limit)
+
+        ids, scores = self.match_index.top_k_across(user.id, [user.cluster, *neighbours],
+                                                    factor_vector(user), limit,
+                                                    norm=user_norm(user))
+        if not len(ids):
+            return []
+        rows = self.session.query(UserData.id, UserData.name, UserData.age,
+                                  or_(UserData.photo_hash.isnot(None),
+                                      UserData.image.isnot(None)).label('has_photo'),
+                                  UserData.gender) \
+            .filter(UserData.id.in_(ids.tolist())).all()
+        rows = {row.id: row for row in rows}
+        return [Match(float(score), i, rows[i].name, rows[i].age, bool(rows[i].has_photo),
+                      GENDERS.get(rows[i].gender))
+                for i, score in zip(ids.tolist(), scores) if i in rows]
+
+    def materialized_matches(self, user, limit):
+        """Matches of a user precomputed by `refresh_matches`.
+
+        The matches are as old as the last refresh: users registered since then are not
+        among them. Users registered since the last refresh have none yet; their matches are
+        computed by the sql match query instead.
+
+        Args:
+            user: :obj: UserData - user to find matches for
+            limit: int - number of matches to return
+
+        Returns: list of Match - best match first
+        """
+        rows = self.session.query(UserMatch.score, UserData.id, UserData.name, UserData.age,
+                                  or_(UserData.photo_hash.isnot(None),
+                                      UserData.image.isnot(None)).label('has_photo'),
+                                  UserData.gender) \
+            .join(UserData, UserData.id == UserMatch.match_id) \
+            .filter(UserMatch.user_id == user.id) \
+            .order_by(UserMatch.rank).limit(limit).all()
+        if not rows:
+            return sql_matches(self.session.connection(), user, limit)
+        return [Match(row.score, row.id, row.name, row.age, bool(row.has_photo),
+                      GENDERS.get(row.gender)) for row in rows]
+
+    def refresh_matches(self, k=MAX_ROWS_SHOW, workers=None, full=False, chunk_size=10000):
+        """Recompute the `user_matches` of every cluster whose members changed since last time.
+
+        A cluster is recomputed when its number of users or the hash of their ids differs from
+        what `match_clusters` recorded, i.e. after registrations in it or a reassignment by
+        `update_cluster_model`. Each cluster is replaced in its own transaction, so readers see
+        either its old or its new matches.
+
+        Args:
+            k: int - number of matches stored per user
+            workers: int - worker processes; defaults to the number of cores
+            full: bool - recompute every cluster, e.g. after changing `k`
+            chunk_size: int - rows inserted per statement
+
+        Returns: list of int - clusters recomputed or removed
+        """
+        # imported here so the web app does not load threadpoolctl
+        from src.materialize import materialize, cluster_signatures
+
+        session = self.session
+        assignments = np.array(session.query(UserData.id, UserData.cluster)
+                               .filter(UserData.cluster.isnot(None)).all(), dtype=np.int64)
+        current = cluster_signatures(*assignments.reshape(-1, 2).T)
+        stored = {row.cluster: (row.n_users, row.members_hash)
+                  for row in session.query(MatchCluster)}
+        touched = sorted(cluster for cluster in current
+                         if full or stored.get(cluster) != current[cluster])
+        removed = sorted(set(stored) - set(current))
+        for cluster in removed:
+            session.query(UserMatch).filter(UserMatch.cluster == cluster) \
+                .delete(synchronize_session=False)
+            session.query(MatchCluster).filter(MatchCluster.cluster == cluster) \
+                .delete(synchronize_session=False)
+            session.commit()
+        logger.info('Refreshing the matches of %d of %d clusters.', len(touched), len(current))
+
+        clusters = {}
+        for cluster in touched:
+            rows = session.query(UserData.id, UserData.norm, UserData.factors) \
+                .filter(UserData.cluster == cluster).order_by(UserData.id).all()
+            vectors = self._unpack_factors(rows)
+            norms = np.array([row.norm for row in rows], dtype=np.float64)
+            clusters[cluster] = (np.array([row.id for row in rows], dtype=np.int64), vectors,
+                                 np.where(np.isnan(norms), factor_norm(vectors), norms))
+        session.commit()
+
+        for cluster, ids, match_ids, scores in materialize(clusters, k, workers=workers):
+            users, ranks = np.nonzero(np.isfinite(scores))
+            records = [{'user_id': int(ids[user]), 'rank': int(rank) + 1,
+                        'match_id': int(match_ids[user, rank]), 'score': float(scores[user, rank]),
+                        'cluster': cluster} for user, rank in zip(users.tolist(), ranks.tolist())]
+            # rows of users that moved here from another cluster are replaced too
+            members = session.query(UserData.id).filter(UserData.cluster == cluster)
+            session.query(UserMatch) \
+                .filter(or_(UserMatch.cluster == cluster, UserMatch.user_id.in_(members))) \
+                .delete(synchronize_session=False)
+            for start in range(0, len(records), chunk_size):
+                session.execute(UserMatch.__table__.insert(), records[start:start + chunk_size])
+            session.merge(MatchCluster(cluster=cluster, n_users=current[cluster][0],
+                                       members_hash=current[cluster][1],
+                                       refreshed_at=datetime.datetime.utcnow()))
+            session.commit()
+            logger.debug('Matches of cluster %d refreshed: %d rows.', cluster, len(records))
+        logger.info('Matches refreshed.')
+        return sorted(touched + removed)
+
+    def add_photo(self, data):
+        """Store a photo and its thumbnail unless identical content is already stored.
+
+        Args:
+            data: bytes - uploaded photo
+
+        Returns: str - hash of the photo, to be saved in `UserData.photo_hash`
+        """
+        key = photo_hash(data)
+        if self.session.query(Photo.hash).filter(Photo.hash == key).first() is None:
+            photo = Photo(hash=key, data=data, thumbnail=make_thumbnail(data))
+            try:
+                with self.session.begin_nested():
+                    self.session.add(photo)
+            except IntegrityError:
+                # another registration stored the same photo since the check; reuse its row
+                logger.debug('Photo %s was stored concurrently.', key)
+        return key
+
+    def get_photo(self, user_id, thumbnail=False):
+        """Profile photo of a user, served from a per-worker cache when possible.
+
+        Args:
+            user_id: int - user id
+            thumbnail: bool - return the fixed-size thumbnail instead of the original upload
+
+        Returns: (data, etag): tuple - image bytes and their etag, or None if the user has no photo
+        """
+        photo = self.photo_cache.get((user_id, thumbnail))
+        if photo is None:
+            photo = self._load_photo(user_id, thumbnail)
+            if photo is None:
+                return None
+            self.photo_cache.put((user_id, thumbnail), photo)
+        return photo
+
+    def _load_photo(self, user_id, thumbnail):
+        session = self.session
+        key = session.query(UserData.photo_hash).filter(UserData.id == user_id).scalar()
+        if key is None:
+            # not migrated yet; serve the original upload from the legacy base64 column
+            image = session.query(UserData.image).filter(UserData.id == user_id).scalar()
+            if image is None:
+                return None
+            data = b64decode(image)
+            return data, photo_hash(data)
+        stored = session.query(Photo.data, Photo.thumbnail).filter(Photo.hash == key).first()
+        if thumbnail and stored.thumbnail is not None:
+            return stored.thumbnail, f'{key}-thumb'
+        return stored.data, key
+
+    def migrate_photos(self, batch_size=500):
+        """Move legacy base64 photos into the photos table as raw bytes with thumbnails.
+
+        Needs migration 2, which adds the photos table and the `photo_hash` column.
+
+        Args:
+            batch_size: int - number of user records converted per transaction
+
+        Returns: None
+        """
+        session = self.session
+        self._require_migration(2)
+        migrated = 0
+        while True:
+            rows = session.query(UserData.id, UserData.image) \
+                .filter(UserData.image.isnot(None)) \
+                .order_by(UserData.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                session.query(UserData).filter(UserData.id == row.id) \
+                    .update({'photo_hash': self.add_photo(b64decode(row.image)), 'image': None},
+                            synchronize_session=False)
+            session.commit()
+            migrated += len(rows)
+            logger.info('%d photos migrated.', migrated)
+        self.photo_cache.clear()
+        logger.info('Photo migration finished; %d photos converted.', migrated)
+
+    def _require_migration(self, version):
+        """Stop unless `run.py migrate` has applied a migration, e.g. the one adding a column."""
+        # imported here since the migrations are defined in terms of the models in this module
+        from src.migrations import Migrator
+        Migrator(self.session.get_bind()).require(version)
+
+    def backfill_norms(self):
+        """Fill in missing norms; needs migration 1, which adds the `norm` column.
+
+        Returns: None
+        """
+        session = self.session
+        self._require_migration(1)
+        squares = ' + '.join(f'{column} * {column}' for column in FACTOR_COLUMNS)
+        result = session.execute(text(f'UPDATE user_data SET norm = SQRT({squares}) '
+                                      f'WHERE norm IS NULL'))
         session.commit()
+        logger.info('Norms backfilled for %d user records.', result.rowcount)
 
     def clear_table(self):
         """Clear table in case things go wrong in the data ingestion process."""
         session = self.session
         session.query(UserData).delete()
         session.commit()
+        self.match_index.clear()
+        self.match_cache.clear()
+        self._synced_at = None
+        self._loaded_at = None
+        self._last_id = 0
         logger.info('User data table cleared.')
 
     def drop_table(self):
@@ -134,59 +683,247 @@ class SurveyManager(Ingest):
         except InternalError:
             logger.error('Table was not created or was already dropped.')
 
-    def upload_seed_data_to_rds(self):
-        """upload reduced features and cluster assignment to rds and save models to s3"""
-        session = self.session
+    def upload_seed_data_to_rds(self, n_records=None, chunk_size=5000, resume=True):
+        """upload reduced features and cluster assignment to rds and save models to s3
+
+        Args:
+            n_records: int - number of seed records to load; None loads the full dataset
+            chunk_size: int - number of records inserted per transaction
+            resume: bool - skip seed records already loaded by a previous, interrupted run
+
+        Returns: None
+        """
+        # imported here so the web app does not load factor_analyzer and sklearn
+        from src.modeling import OfflineModeling
 
         # prepare data for bulk upload
         offline_model = OfflineModeling()
         data = self.download_data_from_s3()[0]
         pca_features, ca_labels = offline_model.initialize_models(data)
 
-        # save models to s3
-        self.upload_model_to_s3(offline_model.fa, filepath=FA_PATH)
-        self.upload_model_to_s3(offline_model.ca, filepath=CA_PATH)
+        records = seed_records(pca_features, ca_labels, data.iloc[:, 164:166].values)
+        if n_records is not None:
+            records = records.iloc[:n_records]
+        loaded = self.load_records(records, chunk_size=chunk_size,
+                                   start=self.next_seed_record() if resume else 0)
+        if loaded < len(records):
+            logger.error('Seed upload stopped at record %d of %d; models were not uploaded. '
+                         'Run it again to resume.', loaded, len(records))
+            return
+
+        # save models to s3 as a new version that has absorbed every user loaded so far
+        previous = self.download_manifest_from_s3()
+        manifest = {'version': previous['version'] + 1 if previous else 1,
+                    'last_user_id': self.session.query(func.max(UserData.id)).scalar() or 0,
+                    'parent': None, 'n_new_users': len(records)}
+        scorer = offline_model.scorer()
+        self.upload_model_version_to_s3(offline_model.fa, offline_model.ca, scorer, manifest)
+        self.promote_model_version_to_s3(offline_model.fa, offline_model.ca, scorer, manifest)
         logging.info(f'models uploaded to {self.s3}.')
 
-        metadata = data.iloc[:, 164:].values
-
-        # reformat data - just the first 100 records for upload
-        records = [UserData(name=f'anonymous user {i}',
-                            password='00000',
-                            factor1=float(pca_features[i][0]),
-                            factor2=float(pca_features[i][1]),
-                            factor3=float(pca_features[i][2]),
-                            factor4=float(pca_features[i][3]),
-                            factor5=float(pca_features[i][4]),
-                            factor6=float(pca_features[i][5]),
-                            factor7=float(pca_features[i][6]),
-                            factor8=float(pca_features[i][7]),
-                            factor9=float(pca_features[i][8]),
-                            factor10=float(pca_features[i][9]),
-                            factor11=float(pca_features[i][10]),
-                            factor12=float(pca_features[i][11]),
-                            cluster=int(ca_labels[i]),
-                            age=float(metadata[i][0]),
-                            gender=float(metadata[i][1]))
-                   for i in range(100)]
-
-        logging.debug(f'The first record in the database is: {records[0]}.')
+    def update_cluster_model(self, batch_size=10000):
+        """Fold users registered since the last model version into the cluster model.
 
-        try:
-            session.add_all(records)
+        The centroids are updated incrementally with the factors of the new users (no refit),
+        archived as a new model version, users whose nearest centroid changed are reassigned,
+        and finally the new version is promoted.
+
+        Args:
+            batch_size: int - number of user records read or reassigned at a time
+
+        Returns: dict - manifest of the new version, or None if there were no new users
+        """
+        # imported here so the web app does not load factor_analyzer and sklearn
+        from src.modeling import update_cluster_model
+
+        session = self.session
+        previous = self.download_manifest_from_s3()
+        # the models of the version the manifest names, even if a promotion is under way
+        fa, ca = self.download_model_from_s3(previous)
+        previous = previous or {'version': 0, 'last_user_id': 0}
+
+        # rows each centroid already represents
+        counts = np.zeros(len(ca.cluster_centers_))
+        for cluster, count in session.query(UserData.cluster, func.count(UserData.id)) \
+                .filter(UserData.id <= previous['last_user_id']).group_by(UserData.cluster):
+            counts[cluster] = count
+
+        absorbed = {'last_user_id': previous['last_user_id'], 'n_new_users': 0}
+
+        def new_factors():
+            for ids, _, factors in self.factor_batches(after=previous['last_user_id'],
+                                                       batch_size=batch_size):
+                absorbed['last_user_id'] = int(ids[-1])
+                absorbed['n_new_users'] += len(ids)
+                yield factors
+
+        ca, counts = update_cluster_model(ca, counts, new_factors())
+        if not absorbed['n_new_users']:
+            logger.info('No users registered since model version %d.', previous['version'])
+            return None
+
+        manifest = {'version': previous['version'] + 1, 'parent': previous['version'], **absorbed}
+        scorer = LinearScorer.from_models(fa, ca)
+        self.upload_model_version_to_s3(fa, ca, scorer, manifest)
+        self.reassign_clusters(scorer.centroids, batch_size=batch_size)
+        self.promote_model_version_to_s3(fa, ca, scorer, manifest)
+        return manifest
+
+    def factor_batches(self, after=0, batch_size=10000):
+        """Read user factors in id order, one batch at a time (keyset pagination).
+
+        Args:
+            after: int - only read users with a larger id
+            batch_size: int - number of users per batch
+
+        Yields: (ids, clusters, factors): tuple of numpy arrays of shape (n,), (n,) and (n, 12)
+        """
+        while True:
+            rows = self.session.query(UserData.id, UserData.cluster, UserData.factors) \
+                .filter(UserData.id > after) \
+                .order_by(UserData.id).limit(batch_size).all()
+            if not rows:
+                return
+            after = rows[-1].id
+            yield np.array([row.id for row in rows], dtype=np.int64), \
+                np.array([row.cluster for row in rows], dtype=np.int64), self._unpack_factors(rows)
+
+    def _unpack_factors(self, rows):
+        """Factor vectors of query rows with `id` and `factors` attributes, as a (n, 12) array.
+
+        Rows written before the packed column existed are read from the separate factor columns.
+        """
+        missing = [row.id for row in rows if row.factors is None]
+        if not missing:
+            return unpack_factors([row.factors for row in rows]).astype(np.float64)
+        columns = [getattr(UserData, column) for column in FACTOR_COLUMNS]
+        legacy = {row[0]: row[1:] for row in
+                  self.session.query(UserData.id, *columns).filter(UserData.id.in_(missing))}
+        return np.array([legacy[row.id] if row.factors is None else unpack_factors([row.factors])[0]
+                         for row in rows], dtype=np.float64)
+
+    def pack_factors(self, batch_size=5000):
+        """Fill in the packed `factors` column; needs migration 3, which adds it.
+
+        Args:
+            batch_size: int - number of user records packed per transaction
+
+        Returns: None
+        """
+        session = self.session
+        self._require_migration(3)
+        columns = [getattr(UserData, column) for column in FACTOR_COLUMNS]
+        update = UserData.__table__.update() \
+            .where(UserData.__table__.c.id == bindparam('user_id')) \
+            .values(factors=bindparam('packed'))
+        packed = 0
+        while True:
+            rows = session.query(UserData.id, *columns).filter(UserData.factors.is_(None)) \
+                .order_by(UserData.id).limit(batch_size).all()
+            if not rows:
+                break
+            session.execute(update, [{'user_id': row[0], 'packed': pack_factors(row[1:])}
+                                     for row in rows])
             session.commit()
-            logging.info('records committed to database.')
-        except AttributeError:
-            logging.error('Something went wrong. Datatype(s) of input feature(s) may be'
-                          ' incompatible with datatypes in schema.')
-            session.rollback()
-        except IntegrityError:
-            logging.error('New records trespass schema restrictions. '
-                          'Maybe you are trying to upload a primary key '
-                          'that already exists or insert NA values '
-                          'in a non-nullable column.')
-            session.rollback()
-        except InternalError:
-            logging.error('New record contains elements that mysql does not recognize. '
-                          'Maybe you have np.nan in a column with type str.')
-            session.rollback()
+            packed += len(rows)
+            logger.info('%d user records packed.', packed)
+        logger.info('Factor packing finished; %d user records converted.', packed)
+
+    def reassign_clusters(self, centroids, batch_size=10000):
+        """Move every user to their nearest centroid, writing only the rows that change.
+
+        Args:
+            centroids: :obj: numpy array of shape (n_clusters, 12) - cluster centers
+            batch_size: int - number of users checked per transaction
+
+        Returns: int - number of users reassigned
+        """
+        session = self.session
+        update = UserData.__table__.update() \
+            .where(UserData.__table__.c.id == bindparam('user_id')) \
+            .values(cluster=bindparam('new_cluster'))
+        reassigned = 0
+        for ids, clusters, factors in self.factor_batches(batch_size=batch_size):
+            labels = nearest_centroid(factors, centroids)
+            changed = np.flatnonzero(labels != clusters)
+            if len(changed):
+                session.execute(update, [{'user_id': int(ids[i]), 'new_cluster': int(labels[i])}
+                                         for i in changed])
+                session.commit()
+                reassigned += len(changed)
+        self.match_cache.clear()
+        self._loaded_at = None
+        logger.info('%d users reassigned to a new cluster.', reassigned)
+        return reassigned
+
+    def next_seed_record(self):
+        """Position in the seed dataset after the last seed record loaded, to resume from."""
+        position = sqlalchemy.cast(func.substr(UserData.name, len(SEED_NAME) + 2), Integer)
+        last = self.session.query(func.max(position)) \
+            .filter(UserData.name.like(f'{SEED_NAME} %')).scalar()
+        return 0 if last is None else last + 1
+
+    def load_records(self, records, chunk_size=5000, start=0):
+        """Bulk insert user records in chunks, committing after every chunk.
+
+        Args:
+            records: :obj: pandas DataFrame - one column per user_data column, e.g. from
+                `seed_records`
+            chunk_size: int - number of records inserted per transaction
+            start: int - position in `records` to start from, to resume an interrupted load
+
+        Returns: int - position of the first record not loaded
+        """
+        session = self.session
+        insert = UserData.__table__.insert()
+        if start:
+            logger.info('Resuming upload at record %d of %d.', start, len(records))
+        started = time.monotonic()
+        for begin in range(start, len(records), chunk_size):
+            chunk = records.iloc[begin:begin + chunk_size]
+            rows = chunk.astype(object).where(chunk.notna(), None).to_dict('records')
+            try:
+                session.execute(insert, rows)
+                session.commit()
+            except IntegrityError:
+                logger.error('New records trespass schema restrictions. '
+                             'Maybe you are trying to upload a primary key '
+                             'that already exists or insert NA values '
+                             'in a non-nullable column.')
+                session.rollback()
+                return begin
+            except InternalError:
+                logger.error('New record contains elements that mysql does not recognize. '
+                             'Maybe you have np.nan in a column with type str.')
+                session.rollback()
+                return begin
+            end = begin + len(rows)
+            logger.info('%d/%d records committed to database (%.0f rows/sec).', end, len(records),
+                        (end - start) / max(time.monotonic() - started, 1e-9))
+        return len(records)
+
+
+def is_seed_name(name):
+    """Whether a username has the form reserved for seed records."""
+    return name.startswith(f'{SEED_NAME} ')
+
+
+def seed_records(features, clusters, metadata):
+    """Assemble anonymized seed user records.
+
+    Args:
+        features: :obj: numpy array of shape (n, 12) - factors of the seed users
+        clusters: :obj: numpy array of shape (n,) - cluster assignments
+        metadata: :obj: numpy array of shape (n, 2) - age and gender of the seed users
+
+    Returns: :obj: pandas DataFrame - one column per user_data column
+    """
+    records = pd.DataFrame(np.asarray(features, dtype=np.float64), columns=FACTOR_COLUMNS)
+    records.insert(0, 'name', f'{SEED_NAME} ' + pd.RangeIndex(len(records)).astype(str))
+    records.insert(1, 'password', '00000')
+    records['factors'] = [pack_factors(vector) for vector in records[FACTOR_COLUMNS].values]
+    records['norm'] = factor_norm(records[FACTOR_COLUMNS].values)
+    records['cluster'] = np.asarray(clusters, dtype=np.int64)
+    records['age'] = np.asarray(metadata[:, 0], dtype=np.float64)
+    records['gender'] = np.asarray(metadata[:, 1], dtype=np.float64)
+    return records
@@ -1,6 +1,10 @@
 from io import BytesIO
+import json
 import pickle
 import os
+import resource
+import tempfile
+import time
 import requests
 import zipfile36 as zipfile
 import pandas as pd
@@ -8,10 +12,73 @@ import boto3
 import botocore.exceptions
 
 from config.flaskconfig import logging, DATA_SOURCE, S3_BUCKET, \
-    DATA_PATH, CODEBOOK_PATH, FA_PATH, CA_PATH
+    DATA_PATH, CODEBOOK_PATH, FA_PATH, CA_PATH, SCORER_PATH, MODEL_MANIFEST_PATH
+from src.scoring import scorer_paths
+from src.registry import model_version_prefix, pickled_model_paths
+from src.artifacts import ArtifactCache
 
 logger = logging.getLogger(__name__)
 
+# members of the data source archive, selected by file name
+DATA_MEMBER = 'data.csv'
+CODEBOOK_MEMBER = 'codebook.html'
+# s3 multipart uploads need parts of at least 5 MB
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+# default of `Ingest.download_model_from_s3`: the models of the promoted version
+PROMOTED = object()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MultipartWriter:
+    """File-like writer that uploads to s3 in parts of at least `part_size` bytes."""
+
+    def __init__(self, s3, bucket, key, part_size=MULTIPART_PART_SIZE):
+        """
+        Args:
+            s3: :obj: boto3 s3 client
+            bucket: str - s3 bucket name
+            key: str - target object key
+            part_size: int - bytes buffered before a part is uploaded; s3 requires at least 5 MB
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.parts = []
+        self.buffer = BytesIO()
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        result = self.s3.upload_part(Body=self.buffer.getvalue(), Bucket=self.bucket, Key=self.key,
+                                     PartNumber=number, UploadId=self.upload_id)
+        self.parts.append({'ETag': result['ETag'], 'PartNumber': number})
+        self.buffer = BytesIO()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                           UploadId=self.upload_id)
+            return False
+        if self.buffer.tell() or not self.parts:
+            self._upload_part()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                          UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': self.parts})
+        return False
+
 
 class Ingest:
     """This class interacts with AWS's S3 bucket."""
@@ -23,45 +90,73 @@ class Ingest:
         except botocore.exceptions.PartialCredentialsError:
             # Checking for valid AWS credentials
             logger.error("Please provide valid AWS credentials")
+        self.cache = ArtifactCache(self.s3)
 
-    def download(self):
-        """download static, publicly available data and codebook"""
+    def download(self, source, path, chunk_size=1 << 20):
+        """stream the data source archive to a local file without holding it in memory
+
+            Args:
+                source: str - http(s) url of the archive, or a file:// url of a local stand-in
+                path: str - local file to write the archive to
+                chunk_size: int - bytes read at a time
+
+            Returns: str - path of the local archive, or None if it could not be downloaded
+        """
+        if source.startswith('file://'):
+            return source[len('file://'):]
         try:
-            response = requests.get(DATA_SOURCE)
+            with requests.get(source, stream=True) as response:
+                response.raise_for_status()
+                with open(path, 'wb') as f:
+                    for block in response.iter_content(chunk_size=chunk_size):
+                        f.write(block)
         except requests.exceptions.RequestException:
             logger.error("Cannot make web requests to download the data source.")
-            return 0
+            return None
+        return path
 
-        file = zipfile.ZipFile(BytesIO(response.content))
-        files = file.namelist()
-        with file.open(files[1]) as csv:
-            data = pd.read_csv(csv, delimiter='\t')
-        with file.open(files[0]) as html:
-            codebook = html.read()
-        return data, codebook
+    def upload_data_to_s3(self, source=DATA_SOURCE, chunk_size=10000):
+        """upload data and codebook to s3 bucket, streaming the data in bounded memory
 
-    def upload_data_to_s3(self):
-        """upload data and codebook to s3 bucket"""
-        # download data
-        data, codebook = self.download()
+            Args:
+                source: str - url of the zip archive with the codebook and the tab-separated data
+                chunk_size: int - rows of data converted to csv at a time
 
-        # write codebook to target path
-        self.s3.put_object(Body=codebook, Bucket=S3_BUCKET, Key=CODEBOOK_PATH)
+            Returns: None
+        """
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory() as tmp:
+            # download data
+            archive = self.download(source, os.path.join(tmp, 'source.zip'))
+            if archive is None:
+                return
+            with zipfile.ZipFile(archive) as file:
+                members = {os.path.basename(name): name for name in file.namelist()}
+
+                # write codebook to target path
+                self.s3.put_object(Body=file.read(members[CODEBOOK_MEMBER]),
+                                   Bucket=S3_BUCKET, Key=CODEBOOK_PATH)
 
-        # write csv to target path - keep the index as 'user'
-        data.index.name = 'user'
-        data.to_csv(f's3://{S3_BUCKET}/{DATA_PATH}', index=True)
-        logger.info("Codebook and data uploaded to s3.")
+                # write csv to target path - keep the index as 'user'
+                n_rows = 0
+                with file.open(members[DATA_MEMBER]) as tsv, \
+                        MultipartWriter(self.s3, S3_BUCKET, DATA_PATH) as target:
+                    for chunk in pd.read_csv(tsv, delimiter='\t', chunksize=chunk_size):
+                        chunk.index.name = 'user'
+                        target.write(chunk.to_csv(header=n_rows == 0, index=True).encode())
+                        n_rows += len(chunk)
+
+        logger.info("Codebook and data (%d rows) uploaded to s3 in %.1fs, peak RSS %.0f MB.",
+                    n_rows, time.monotonic() - started, peak_rss_mb())
 
     def download_data_from_s3(self):
-        """read data and codebook from s3 bucket"""
+        """read data and codebook from s3 bucket, through the local artifact cache"""
 
         # read codebook
-        result = self.s3.get_object(Bucket=S3_BUCKET, Key=CODEBOOK_PATH)
-        text = result['Body'].read().decode()
+        text = self.cache.get_bytes(CODEBOOK_PATH).decode()
 
         # read csv file
-        data = pd.read_csv(f's3://{S3_BUCKET}/{DATA_PATH}')
+        data = self.cache.get_frame(DATA_PATH)
         logger.info("Codebook and data downloaded from s3.")
 
         return data, text
@@ -80,11 +175,45 @@ class Ingest:
         self.s3.put_object(Body=pickle_obj, Bucket=S3_BUCKET, Key=filepath)
         logger.info("Model uploaded to s3.")
 
-    def download_model_from_s3(self):
-        """download fitted models from s3 bucket"""
+    def upload_scorer_to_s3(self, scorer, prefix=SCORER_PATH):
+        """upload the arrays of a scoring artifact to s3 bucket as .npy files
+
+            Args:
+                scorer: :obj: LinearScorer - scoring artifact exported from the fitted models
+                prefix: str - s3 prefix to save the arrays under
+
+            Returns: None
+        """
+        bodies = scorer.to_bytes()
+        for name, key in zip(scorer.ARRAYS, scorer_paths(prefix)):
+            self.s3.put_object(Body=bodies[name], Bucket=S3_BUCKET, Key=key)
+        logger.info("Scoring artifact uploaded to s3.")
+
+    def download_model_from_s3(self, manifest=PROMOTED):
+        """download fitted models from s3 bucket, through the local artifact cache
+
+            Both models are read from the copies archived with one version, so they always
+            match; buckets without a manifest fall back to the promoted copies.
+
+            Args:
+                manifest: dict - manifest of the version to download, or None for the promoted
+                    copies; by default the manifest of the promoted version is read first
 
-        fa_pickle_obj = self.s3.get_object(Bucket=S3_BUCKET, Key=FA_PATH)['Body'].read()
-        ca_pickle_obj = self.s3.get_object(Bucket=S3_BUCKET, Key=CA_PATH)['Body'].read()
+            Returns: (fa, ca): tuple - fitted factor and cluster analysis models
+        """
+        if manifest is PROMOTED:
+            try:
+                manifest = self.download_manifest_from_s3()
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                logger.warning("Model manifest could not be read; using the promoted models.",
+                               exc_info=True)
+                manifest = None
+        if manifest is None:
+            fa_path, ca_path = FA_PATH, CA_PATH
+        else:
+            fa_path, ca_path = pickled_model_paths(model_version_prefix(manifest['version']))
+        fa_pickle_obj = self.cache.get_bytes(fa_path)
+        ca_pickle_obj = self.cache.get_bytes(ca_path)
         logger.info("Fitted models downloaded from s3.")
 
         fa = pickle.loads(fa_pickle_obj)
@@ -92,3 +221,61 @@ class Ingest:
         logger.info("Fitted models loaded.")
 
         return fa, ca
+
+    def download_manifest_from_s3(self):
+        """read the manifest of the promoted model version, through the local artifact cache
+
+            Returns: dict - model version, last user id it has absorbed and its history,
+                or None if no version was recorded yet (offline: if none is cached)
+        """
+        try:
+            body = self.cache.get_bytes(MODEL_MANIFEST_PATH)
+        except FileNotFoundError:
+            return None
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            return None
+        return json.loads(body)
+
+    def upload_model_version_to_s3(self, fa, ca, scorer, manifest):
+        """archive fitted models, their scoring artifact and manifest under a versioned prefix
+
+            Args:
+                fa: :obj: FactorAnalyzer - fitted factor analysis model
+                ca: :obj: KMeans - fitted cluster analysis model
+                scorer: :obj: LinearScorer - scoring artifact exported from `fa` and `ca`
+                manifest: dict - manifest of the version, with at least a 'version' number
+
+            Returns: str - s3 prefix of the version
+        """
+        prefix = model_version_prefix(manifest['version'])
+        fa_path, ca_path = pickled_model_paths(prefix)
+        self.upload_model_to_s3(fa, filepath=fa_path)
+        self.upload_model_to_s3(ca, filepath=ca_path)
+        self.upload_scorer_to_s3(scorer, prefix=f'{prefix}/scorer')
+        self.s3.put_object(Body=json.dumps(manifest, indent=2).encode(),
+                           Bucket=S3_BUCKET, Key=f'{prefix}/manifest.json')
+        logger.info("Model version %d archived at %s.", manifest['version'], prefix)
+        return prefix
+
+    def promote_model_version_to_s3(self, fa, ca, scorer, manifest):
+        """make a model version the one used by the app and the pipeline
+
+            The manifest is written last, so it only names a version once all its artifacts
+            are in place.
+
+            Args:
+                fa: :obj: FactorAnalyzer - fitted factor analysis model
+                ca: :obj: KMeans - fitted cluster analysis model
+                scorer: :obj: LinearScorer - scoring artifact exported from `fa` and `ca`
+                manifest: dict - manifest of the version
+
+            Returns: None
+        """
+        self.upload_model_to_s3(fa, filepath=FA_PATH)
+        self.upload_model_to_s3(ca, filepath=CA_PATH)
+        self.upload_scorer_to_s3(scorer)
+        self.s3.put_object(Body=json.dumps(manifest, indent=2).encode(),
+                           Bucket=S3_BUCKET, Key=MODEL_MANIFEST_PATH)
+        logger.info("Model version %d promoted.", manifest['version'])
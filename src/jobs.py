@@ -0,0 +1,138 @@
+import datetime
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy.sql import exists
+
+from config.flaskconfig import logging, REGISTRATION_WORKERS
+from src.create_db import RegistrationJob
+
+logger = logging.getLogger(__name__)
+
+# jobs still pending after this long were lost, e.g. when the process holding the queue restarted
+JOB_TIMEOUT = datetime.timedelta(minutes=10)
+
+
+class RegistrationQueue:
+    """In-process queue that scores and stores registrations on background threads.
+
+    Each registration is recorded in `registration_jobs` before the request returns, so its
+    status can be reported on the next login; a pool of worker threads then runs
+    `SurveyManager.add_user_record` and records the outcome.
+    """
+
+    def __init__(self, sm, workers=REGISTRATION_WORKERS):
+        """
+        Args:
+            sm: :obj: SurveyManager - manager whose (thread-scoped) session and models are used
+            workers: int - number of worker threads
+        """
+        self.sm = sm
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self._waits = deque(maxlen=1024)
+        self._durations = deque(maxlen=1024)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='registration')
+
+    def submit(self, username, password, age, gender, survey, image):
+        """Queue a registration; arguments as for `SurveyManager.add_user_record`.
+
+        Returns: int - id of the registration job
+        """
+        session = self.sm.session
+        job = RegistrationJob(username=username, status='pending',
+                              created_at=datetime.datetime.utcnow())
+        session.add(job)
+        session.commit()
+        with self._lock:
+            self.submitted += 1
+        self._executor.submit(self._run, job.id, time.monotonic(),
+                              dict(username=username, password=password, age=age, gender=gender,
+                                   survey=survey, image=image))
+        return job.id
+
+    def is_queued(self, username):
+        """Whether a registration of a username is still pending or running, so the name is taken.
+
+        Jobs older than JOB_TIMEOUT were lost and no longer hold on to their username.
+        """
+        since = datetime.datetime.utcnow() - JOB_TIMEOUT
+        return self.sm.session.query(exists().where(RegistrationJob.username == username)
+                                     .where(RegistrationJob.status.in_(['pending', 'running']))
+                                     .where(RegistrationJob.created_at > since)).scalar()
+
+    def status(self, username):
+        """Status of the latest registration of a username.
+
+        Returns: (status, error): tuple - 'pending', 'running', 'done' or 'failed' and the
+            error message of a failed job, or None if the username was never queued
+        """
+        job = self.sm.session.query(RegistrationJob.status, RegistrationJob.error,
+                                    RegistrationJob.created_at) \
+            .filter(RegistrationJob.username == username) \
+            .order_by(RegistrationJob.id.desc()).first()
+        if job is None:
+            return None
+        if job.status in ('pending', 'running') \
+                and datetime.datetime.utcnow() - job.created_at > JOB_TIMEOUT:
+            return 'failed', 'registration was interrupted'
+        return job.status, job.error
+
+    def metrics(self):
+        """Counters for monitoring.
+
+        Returns: dict - queue depth, submitted/completed/failed counts, and mean and p95 seconds
+            spent waiting in the queue and processing, over recent jobs
+        """
+        with self._lock:
+            waits, durations = np.array(self._waits), np.array(self._durations)
+            metrics = {'depth': self.submitted - self.completed - self.failed,
+                       'submitted': self.submitted, 'completed': self.completed,
+                       'failed': self.failed}
+        for name, values in [('wait', waits), ('processing', durations)]:
+            if not len(values):
+                values = np.zeros(1)
+            metrics[f'mean_{name}_seconds'] = float(values.mean())
+            metrics[f'p95_{name}_seconds'] = float(np.percentile(values, 95))
+        return metrics
+
+    def shutdown(self, wait=True):
+        """Stop accepting registrations and, by default, finish the queued ones."""
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job_id, queued_at, registration):
+        started = time.monotonic()
+        session = self.sm.session
+        failed = True
+        try:
+            self._update(job_id, status='running')
+            self.sm.add_user_record(**registration)
+            self._update(job_id, status='done', finished_at=datetime.datetime.utcnow())
+            failed = False
+        except Exception as error:
+            logger.exception('Registration job %d failed.', job_id)
+            try:
+                session.rollback()
+                self._update(job_id, status='failed', error=str(error)[:255],
+                             finished_at=datetime.datetime.utcnow())
+            except Exception:  # e.g. the database is unreachable; the job times out instead
+                logger.exception('Failure of registration job %d could not be recorded.', job_id)
+        finally:
+            # worker threads are reused; do not keep their session (and connection) around
+            session.remove()
+            with self._lock:
+                self._waits.append(started - queued_at)
+                self._durations.append(time.monotonic() - started)
+                self.completed += not failed
+                self.failed += failed
+
+    def _update(self, job_id, **values):
+        session = self.sm.session
+        session.query(RegistrationJob).filter(RegistrationJob.id == job_id) \
+            .update(values, synchronize_session=False)
+        session.commit()
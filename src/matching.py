@@ -0,0 +1,510 @@
+import operator
+import threading
+from collections import namedtuple
+from functools import reduce
+
+import numpy as np
+from sqlalchemy import Float, Integer, String, bindparam, desc, or_
+from sqlalchemy.sql import column, select, table
+
+from config.flaskconfig import logging, MATCH_ANN_CELL_SIZE, MATCH_ANN_NPROBE
+from src.scoring import nearest_centroid
+
+logger = logging.getLogger(__name__)
+
+N_FACTORS = 12
+FACTOR_COLUMNS = [f'factor{i}' for i in range(1, N_FACTORS + 1)]
+GENDERS = {1: 'Male', 2: 'Female', 3: 'Non-binary'}
+
+# a match as rendered on the homepage; mirrors the columns of the sql match query
+Match = namedtuple('Match', ['cosine', 'id', 'name', 'age', 'has_photo', 'sex'])
+
+
+# packed factors are little-endian float64, 96 bytes per user, at the precision they were
+# computed with; single-precision factor columns (FLOAT on MySQL) hold rounded values, so there
+# the index and the sql match query can order users with nearly equal cosines differently
+PACKED_DTYPE = np.dtype('<f8')
+PACKED_SIZE = PACKED_DTYPE.itemsize * N_FACTORS
+
+
+def pack_factors(vector):
+    """Serialize a factor vector for the `factors` column.
+
+    Args:
+        vector: array-like of shape (12,) - factor vector
+
+    Returns: bytes - packed float64 values
+    """
+    return np.asarray(vector, dtype=PACKED_DTYPE).reshape(N_FACTORS).tobytes()
+
+
+def unpack_factors(blobs):
+    """Read packed factor vectors as one array, without touching the values one by one.
+
+    Args:
+        blobs: list of bytes - values of the `factors` column
+
+    Returns: :obj: numpy array of shape (n, 12) - read-only float64 view of the joined blobs
+    """
+    return np.frombuffer(b''.join(blobs), dtype=PACKED_DTYPE).reshape(-1, N_FACTORS)
+
+
+def factor_columns(vector):
+    """Keyword arguments setting the factor columns of a user record from a vector.
+
+    Args:
+        vector: array-like of shape (12,) - factor vector
+
+    Returns: dict - float value of every factor column, plus the packed `factors` column
+    """
+    values = np.asarray(vector, dtype=np.float64).reshape(N_FACTORS)
+    return {**dict(zip(FACTOR_COLUMNS, values.tolist())), 'factors': pack_factors(values)}
+
+
+def factor_vector(user):
+    """Factor vector of a user record, from the packed column if it is filled in.
+
+    Args:
+        user: :obj: UserData - user record
+
+    Returns: :obj: numpy array of shape (12,)
+    """
+    if getattr(user, 'factors', None) is not None:
+        return unpack_factors([user.factors])[0].astype(np.float64)
+    return np.array([getattr(user, column) for column in FACTOR_COLUMNS], dtype=np.float64)
+
+
+def factor_norm(vectors):
+    """L2 norm of factor vectors, computed the same way at write time and at query time.
+
+    Args:
+        vectors: array-like of shape (12,) or (n, 12) - factor vectors
+
+    Returns: float or :obj: numpy array of shape (n,)
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    return np.sqrt(np.sum(vectors * vectors, axis=-1))
+
+
+def user_norm(user):
+    """Stored norm of a user record, falling back to computing it for rows not yet backfilled."""
+    return user.norm if user.norm is not None else float(factor_norm(factor_vector(user)))
+
+
+# user_data as seen by the sql match query; a lightweight Core table so this module does not
+# depend on the ORM models
+_user_data = table('user_data', column('id', Integer), column('name', String),
+                   column('age', Float), column('gender', Float), column('cluster', Integer),
+                   column('norm', Float), column('photo_hash', String), column('image', String),
+                   *(column(name, Float) for name in FACTOR_COLUMNS))
+
+# the sql match query, built once with bound parameters so its text never changes; cosine
+# similarity uses the `norm` column stored with every row, so ranking is a plain dot product
+_cosine = reduce(operator.add, (_user_data.c[name] * bindparam(name, type_=Float)
+                                for name in FACTOR_COLUMNS)) \
+    / (_user_data.c.norm * bindparam('user_norm', type_=Float))
+MATCH_QUERY = select([_cosine.label('cosine'), _user_data.c.id, _user_data.c.name,
+                      _user_data.c.age,
+                      or_(_user_data.c.photo_hash.isnot(None),
+                          _user_data.c.image.isnot(None)).label('has_photo'),
+                      _user_data.c.gender]) \
+    .where(_user_data.c.cluster == bindparam('cluster', type_=Integer)) \
+    .where(_user_data.c.id != bindparam('user_id', type_=Integer)) \
+    .order_by(desc('cosine')) \
+    .limit(bindparam('limit', type_=Integer))
+
+# compiled forms of MATCH_QUERY, one per database dialect
+_compiled_cache = {}
+
+
+def match_params(user, limit):
+    """Bound parameters of MATCH_QUERY for a user.
+
+    Args:
+        user: :obj: UserData - user to find matches for
+        limit: int - number of matches to return
+
+    Returns: dict
+    """
+    vector = factor_vector(user)
+    return {**dict(zip(FACTOR_COLUMNS, vector.tolist())), 'user_norm': float(user_norm(user)),
+            'cluster': int(user.cluster), 'user_id': int(user.id), 'limit': int(limit)}
+
+
+def sql_matches(connection, user, limit):
+    """Rank the users in `user`'s cluster by cosine similarity in the database.
+
+    The query is compiled once per dialect and reused for every request.
+
+    Args:
+        connection: :obj: sqlalchemy Connection - e.g. `session.connection()`
+        user: :obj: UserData - user to find matches for
+        limit: int - number of matches to return
+
+    Returns: list of Match - best match first
+    """
+    rows = connection.execution_options(compiled_cache=_compiled_cache) \
+        .execute(MATCH_QUERY, match_params(user, limit)).fetchall()
+    return [Match(row.cosine, row.id, row.name, row.age, bool(row.has_photo),
+                  GENDERS.get(row.gender)) for row in rows]
+
+
+def _query(vector, norm=None):
+    """Factor vector as float64, its norm, and the float32 unit vector the index is scanned with."""
+    vector = np.asarray(vector, dtype=np.float64)
+    norm = factor_norm(vector) if norm is None else norm
+    return vector, norm, (vector / norm if norm > 0 else vector).astype(np.float32)
+
+
+class _Partition:
+    """Growable, contiguous storage for the users of one cluster.
+
+    Also keeps a cone around the unit vectors of its users, an axis and the smallest cosine
+    of any user with it, which bounds the best cosine any user in the partition can have
+    with a query.
+    """
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.units = np.empty((capacity, N_FACTORS), dtype=np.float32)
+        self.vectors = np.empty((capacity, N_FACTORS), dtype=np.float64)
+        self.norms = np.empty(capacity, dtype=np.float64)
+        self.axis = None
+        self.axis_size = 0
+        self.min_cosine = 1.0
+
+    def extend(self, ids, units, vectors, norms):
+        end = self.size + len(ids)
+        if end > len(self.ids):
+            capacity = max(end, 2 * len(self.ids))
+            for name in ('ids', 'units', 'vectors', 'norms'):
+                old = getattr(self, name)
+                new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+        self.ids[self.size:end] = ids
+        self.units[self.size:end] = units
+        self.vectors[self.size:end] = vectors
+        self.norms[self.size:end] = norms
+        self.size = end
+        self._widen(self.units[end - len(ids):end])
+
+    def _widen(self, units):
+        """Grow the cone to cover new users; its axis is recomputed whenever the size doubles."""
+        if self.axis is None or self.size >= 2 * self.axis_size:
+            mean = self.units[:self.size].mean(axis=0, dtype=np.float64)
+            self.axis = mean / factor_norm(mean) if factor_norm(mean) > 0 else mean
+            self.axis_size = self.size
+            self.min_cosine = 1.0
+            units = self.units[:self.size]
+        if len(units):
+            self.min_cosine = min(self.min_cosine, float((units @ self.axis).min()))
+
+    def max_cosine(self, query):
+        """Upper bound of the cosine of a unit query vector with any user in the partition."""
+        if not self.size or not factor_norm(self.axis) > 0:
+            return 1.0
+        angle = np.arccos(np.clip(np.dot(query, self.axis), -1, 1))
+        spread = np.arccos(np.clip(self.min_cosine, -1, 1))
+        return float(np.cos(max(0.0, angle - spread)))
+
+    def view(self):
+        n = self.size
+        return self.ids[:n], self.units[:n], self.vectors[:n], self.norms[:n]
+
+
+class MatchIndex:
+    """In-memory cosine similarity index over user factor vectors, partitioned by cluster.
+
+    L2-normalized vectors are kept in a float32 matrix per cluster so a query is one
+    matrix-vector product plus `argpartition`. The shortlisted candidates are then
+    re-scored in float64 with the same formula as `MATCH_QUERY`, which makes the
+    final ranking identical to the sql ranking when the database stores the factors in
+    double precision (see `PACKED_DTYPE`).
+    """
+
+    # float32 scores are within this distance of the exact float64 scores
+    tolerance = 1e-5
+
+    def __init__(self):
+        self.last_id = 0
+        self.clusters_searched = 0
+        self.clusters_pruned = 0
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(partition.size for partition in self._partitions.values())
+
+    def add(self, ids, clusters, vectors, norms=None):
+        """Insert users into the index.
+
+        Args:
+            ids: array-like of int - user ids
+            clusters: array-like of int - cluster assignments
+            vectors: array-like of shape (n, 12) - factor vectors
+            norms: array-like of float - precomputed vector norms; missing values are computed
+
+        Returns: None
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        clusters = np.asarray(clusters, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, N_FACTORS)
+        norms = factor_norm(vectors) if norms is None else np.asarray(norms, dtype=np.float64)
+        norms = np.where(np.isnan(norms), factor_norm(vectors), norms)
+        units = np.divide(vectors, norms[:, None], out=np.zeros_like(vectors),
+                          where=norms[:, None] > 0)
+        with self._lock:
+            for cluster in np.unique(clusters):
+                rows = clusters == cluster
+                partition = self._partitions.setdefault(int(cluster), _Partition())
+                partition.extend(ids[rows], units[rows], vectors[rows], norms[rows])
+            if len(ids):
+                self.last_id = max(self.last_id, int(ids.max()))
+
+    def clear(self):
+        """Remove every user from the index."""
+        with self._lock:
+            self._partitions = {}
+            self.last_id = 0
+
+    def stale_clusters(self):
+        """Clusters whose cells `build_cells` would rebuild; the exact index has no cells."""
+        return []
+
+    def build_cells(self):
+        """Build the cells of `stale_clusters`; the exact index has no cells.
+
+        Returns: int - number of clusters whose cells were rebuilt
+        """
+        return 0
+
+    def top_k(self, user_id, cluster, vector, k, norm=None):
+        """Rank the other users in a cluster by cosine similarity.
+
+        Args:
+            user_id: int - id of the querying user, excluded from the results
+            cluster: int - cluster to search
+            vector: array-like of shape (12,) - factor vector of the querying user
+            k: int - number of matches to return
+            norm: float - precomputed norm of `vector`
+
+        Returns: (ids, scores): tuple - numpy arrays of user ids and cosine similarities, best first
+        """
+        with self._lock:
+            partition = self._partitions.get(int(cluster))
+            if partition is None:
+                return np.empty(0, dtype=np.int64), np.empty(0)
+            view = partition.view()
+        return self._rank(view, user_id, vector, k, norm)
+
+    def top_k_across(self, user_id, clusters, vector, k, norm=None):
+        """Rank the other users of several clusters by cosine similarity.
+
+        Clusters are searched in the order given, e.g. the user's own cluster first and then
+        the clusters with the closest centroids. A cluster is skipped when the cone around its
+        users shows none of them can beat the k-th best match found so far.
+
+        Args:
+            user_id: int - id of the querying user, excluded from the results
+            clusters: list of int - clusters to search, most promising first
+            vector: array-like of shape (12,) - factor vector of the querying user
+            k: int - number of matches to return
+            norm: float - precomputed norm of `vector`
+
+        Returns: (ids, scores): tuple - numpy arrays of user ids and cosine similarities, best first
+        """
+        query = _query(vector, norm)[2]
+        ids, scores = np.empty(0, dtype=np.int64), np.empty(0)
+        for cluster in clusters:
+            with self._lock:
+                partition = self._partitions.get(int(cluster))
+                bound = partition.max_cosine(query) if partition is not None else -np.inf
+            if len(scores) == k and bound < scores[-1] - self.tolerance:
+                self.clusters_pruned += 1
+                continue
+            if partition is None:
+                continue
+            self.clusters_searched += 1
+            found_ids, found_scores = self.top_k(user_id, cluster, vector, k, norm)
+            ids = np.concatenate([ids, found_ids])
+            scores = np.concatenate([scores, found_scores])
+            order = np.lexsort((ids, -scores))[:k]
+            ids, scores = ids[order], scores[order]
+        return ids, scores
+
+    def metrics(self):
+        """Counters for monitoring.
+
+        Returns: dict - users indexed, and clusters searched and pruned by `top_k_across`
+        """
+        return {'users': len(self), 'clusters_searched': self.clusters_searched,
+                'clusters_pruned': self.clusters_pruned}
+
+    def _rank(self, view, user_id, vector, k, norm, scanned=None):
+        """Top k of the users in `view`, shortlisted in float32 and re-scored exactly.
+
+        `scanned` restricts the ranking to some rows: a (rows, float32 scores) tuple.
+        """
+        ids, units, vectors, norms = view
+        vector, norm, query = _query(vector, norm)
+
+        rows, scores = (None, units @ query) if scanned is None else scanned
+        row_ids = ids if rows is None else ids[rows]
+        scores[row_ids == user_id] = -np.inf
+        if k < len(scores):
+            # shortlist everything that could still rank in the top k once re-scored exactly
+            kth = scores[np.argpartition(-scores, k - 1)[:k]].min()
+            candidates = np.flatnonzero(scores >= kth - self.tolerance)
+        else:
+            candidates = np.flatnonzero(np.isfinite(scores))
+        candidates = candidates[row_ids[candidates] != user_id]
+        if rows is not None:
+            candidates = rows[candidates]
+
+        exact = self._cosine(vectors[candidates], norms[candidates], vector, norm)
+        order = np.lexsort((ids[candidates], -exact))[:k]
+        return ids[candidates[order]], exact[order]
+
+    @staticmethod
+    def _cosine(vectors, norms, vector, norm):
+        """Cosine similarity evaluated in the same order as the sql query."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = (vectors @ vector) / (norms * norm)
+        return np.where(np.isfinite(cosine), cosine, -np.inf)
+
+
+class _Cells:
+    """Inverted file over the users of one cluster: users grouped by their closest cell.
+
+    Cell centroids are found with spherical k-means on a sample of the unit vectors; every
+    user is then assigned to the centroid with the largest dot product. A copy of the unit
+    vectors is kept sorted by cell, so scanning a cell reads one contiguous block. Users
+    appended to the partition after the cells were built are not in any cell and are always
+    scanned.
+    """
+
+    def __init__(self, units, n_cells, iterations=10, sample_factor=64, seed=0):
+        """
+        Args:
+            units: :obj: numpy array of shape (n, 12) - unit factor vectors of the cluster
+            n_cells: int - number of cells
+            iterations: int - k-means iterations
+            sample_factor: int - users sampled per cell to fit the centroids
+            seed: int - random seed of the sample and of the initial centroids
+        """
+        rng = np.random.default_rng(seed)
+        sample = units[rng.permutation(len(units))[:sample_factor * n_cells]].astype(np.float64)
+        centroids = sample[:n_cells]
+        for _ in range(iterations):
+            labels = nearest_centroid(sample, centroids)
+            counts = np.bincount(labels, minlength=n_cells)
+            sums = np.stack([np.bincount(labels, weights=sample[:, j], minlength=n_cells)
+                             for j in range(N_FACTORS)], axis=1)
+            # empty cells keep their centroid; centroids stay on the unit sphere, so the
+            # closest centroid in euclidean distance is the one with the largest dot product
+            centroids = np.where(counts[:, None] > 0, sums, centroids)
+            centroids = centroids / np.maximum(factor_norm(centroids), 1e-12)[:, None]
+        labels = np.concatenate([nearest_centroid(units[start:start + 65536], centroids)
+                                 for start in range(0, len(units), 65536)])
+        self.centroids = centroids.astype(np.float32)
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.searchsorted(labels[self.order], np.arange(n_cells + 1))
+        self.units = units[self.order]
+        self.size = len(units)
+
+    def scan(self, query, nprobe, units):
+        """Score the users in the cells closest to a query.
+
+        Args:
+            query: :obj: numpy array of shape (12,) - unit query vector
+            nprobe: int - number of cells to scan
+            units: :obj: numpy array of shape (n, 12) - current unit vectors of the partition
+
+        Returns: (rows, scores): tuple - partition rows of the `nprobe` closest cells and of the
+            users added after the cells were built, and their float32 dot products with the
+            query; None if every row has to be scanned anyway
+        """
+        if nprobe >= len(self.centroids):
+            return None
+        cells = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        blocks = [slice(self.offsets[cell], self.offsets[cell + 1]) for cell in cells]
+        rows = [self.order[block] for block in blocks] + [np.arange(self.size, len(units))]
+        scores = [self.units[block] @ query for block in blocks] + [units[self.size:] @ query]
+        return np.concatenate(rows), np.concatenate(scores)
+
+
+class ApproximateMatchIndex(MatchIndex):
+    """MatchIndex that scans only part of large clusters, trading recall for latency.
+
+    Each cluster holding more than `nprobe` cells' worth of users is split into cells of
+    about `cell_size` users (an IVF index inside the KMeans cluster). A query scans the
+    `nprobe` cells whose centroids are closest to the user, so the best matches in other
+    cells can be missed. Users added after the cells were built are always scanned, and
+    `build_cells` rebuilds the cells of clusters that have doubled in size since; it runs
+    k-means, so callers serving queries run it off the request path. Candidates are
+    re-scored exactly as in MatchIndex, so the scores are exact.
+    """
+
+    def __init__(self, cell_size=MATCH_ANN_CELL_SIZE, nprobe=MATCH_ANN_NPROBE):
+        """
+        Args:
+            cell_size: int - average number of users per cell
+            nprobe: int - cells scanned per query
+        """
+        super().__init__()
+        self.cell_size = cell_size
+        self.nprobe = nprobe
+        self._cells = {}
+
+    def stale_clusters(self):
+        """Clusters with more than `nprobe` cells' worth of users that have no cells yet or have
+        doubled in size since theirs were built."""
+        with self._lock:
+            sizes = {cluster: partition.size for cluster, partition in self._partitions.items()}
+            cells = dict(self._cells)
+        return [cluster for cluster, size in sizes.items()
+                if size // self.cell_size > self.nprobe
+                and (cluster not in cells or size >= 2 * cells[cluster].size)]
+
+    def build_cells(self):
+        """Build the cells of `stale_clusters`, swapping each in once it is complete.
+
+        Returns: int - number of clusters whose cells were rebuilt
+        """
+        rebuilt = 0
+        for cluster in self.stale_clusters():
+            with self._lock:
+                partition = self._partitions.get(cluster)
+                if partition is None:  # cleared meanwhile
+                    continue
+                units = partition.view()[1]
+            n_cells = len(units) // self.cell_size
+            cells = _Cells(units, n_cells)
+            with self._lock:
+                if self._partitions.get(cluster) is not partition:
+                    continue
+                self._cells[cluster] = cells
+            rebuilt += 1
+            logger.debug('Match index cells of cluster %d rebuilt: %d users in %d cells.',
+                         cluster, len(units), n_cells)
+        return rebuilt
+
+    def clear(self):
+        """Remove every user from the index."""
+        with self._lock:
+            self._partitions = {}
+            self._cells = {}
+            self.last_id = 0
+
+    def top_k(self, user_id, cluster, vector, k, norm=None):
+        """Rank the users in the cells of a cluster closest to a user; arguments as `MatchIndex`."""
+        with self._lock:
+            partition = self._partitions.get(int(cluster))
+            if partition is None:
+                return np.empty(0, dtype=np.int64), np.empty(0)
+            view = partition.view()
+            cells = self._cells.get(int(cluster))
+        scanned = cells.scan(_query(vector, norm)[2], self.nprobe, view[1]) if cells else None
+        return self._rank(view, user_id, vector, k, norm, scanned)
@@ -0,0 +1,140 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+# largest block of similarities computed at once, in float64 values (32 MB)
+BLOCK_VALUES = 4 * 2 ** 20
+
+# cluster arrays of a worker process, memory-mapped on first use by `_load`
+_arrays = {}
+
+
+def _mix(ids):
+    """64-bit hash of every id (the splitmix64 finalizer), spreading nearby ids over all bits."""
+    x = np.asarray(ids, dtype=np.uint64) + np.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def cluster_signatures(ids, clusters):
+    """Number of users of every cluster and an order-independent hash of their ids.
+
+    The hash is the xor of a 64-bit hash of every id, so unlike e.g. a sum of ids it changes
+    when some users leave a cluster and others with the same id sum join it.
+
+    Args:
+        ids: array-like of int - user ids
+        clusters: array-like of int - cluster of every user
+
+    Returns: dict - (n_users, members_hash) tuple of ints keyed by cluster; the hash is a
+        signed 64-bit int so it fits a BIGINT column
+    """
+    ids, clusters = np.asarray(ids, dtype=np.int64), np.asarray(clusters, dtype=np.int64)
+    if not len(ids):
+        return {}
+    order = np.argsort(clusters, kind='stable')
+    labels, starts, counts = np.unique(clusters[order], return_index=True, return_counts=True)
+    hashes = np.bitwise_xor.reduceat(_mix(ids[order]), starts).view(np.int64)
+    return {int(cluster): (int(count), int(value))
+            for cluster, count, value in zip(labels, counts, hashes)}
+
+
+def top_k_matches(ids, vectors, norms, start, stop, k):
+    """Top k matches of some users of a cluster among the other users of the cluster.
+
+    Similarities are computed for blocks of users at a time with the same formula as the
+    in-memory index, and ties are broken by user id as there.
+
+    Args:
+        ids: :obj: numpy array of shape (n,) - user ids of the cluster
+        vectors: :obj: numpy array of shape (n, 12) - factor vectors
+        norms: :obj: numpy array of shape (n,) - factor vector norms
+        start: int - first row to find matches for
+        stop: int - row after the last one to find matches for
+        k: int - number of matches per user
+
+    Returns: (match_ids, scores): tuple of numpy arrays of shape (stop - start, min(k, n - 1)) -
+        matches of each user best first; scores of missing matches (users without factors)
+        are -inf
+    """
+    k = min(k, len(ids) - 1)
+    match_ids = np.empty((stop - start, max(k, 0)), dtype=np.int64)
+    scores = np.empty((stop - start, max(k, 0)))
+    if k <= 0:
+        return match_ids, scores
+    block_size = max(1, BLOCK_VALUES // len(ids))
+    for begin in range(start, stop, block_size):
+        end = min(begin + block_size, stop)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block = (vectors[begin:end] @ vectors.T) / (norms[begin:end, None] * norms[None, :])
+        block[~np.isfinite(block)] = -np.inf
+        block[np.arange(end - begin), np.arange(begin, end)] = -np.inf
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.lexsort((ids[top], -top_scores))
+        match_ids[begin - start:end - start] = np.take_along_axis(ids[top], order, axis=1)
+        scores[begin - start:end - start] = np.take_along_axis(top_scores, order, axis=1)
+    return match_ids, scores
+
+
+def _load(directory, cluster):
+    """Memory-map the arrays of a cluster saved by `materialize`, once per worker process."""
+    key = (directory, cluster)
+    if key not in _arrays:
+        _arrays[key] = tuple(np.load(os.path.join(directory, f'{cluster}-{name}.npy'),
+                                     mmap_mode='r') for name in ('ids', 'vectors', 'norms'))
+    return _arrays[key]
+
+
+def _task(directory, cluster, start, stop, k):
+    """Matches of rows `start` to `stop` of a cluster, computed in a worker process."""
+    ids, vectors, norms = _load(directory, cluster)
+    # one BLAS thread per worker; the pool already keeps every core busy
+    with threadpool_limits(limits=1):
+        return cluster, start, top_k_matches(ids, vectors, norms, start, stop, k)
+
+
+def materialize(clusters, k, workers=None, rows_per_task=4096):
+    """Compute the top k matches of every user of some clusters in a process pool.
+
+    The arrays of every cluster are written once to temporary .npy files that the workers
+    memory-map, and the users of large clusters are split over several tasks.
+
+    Args:
+        clusters: dict - (ids, vectors, norms) numpy arrays of each cluster, keyed by cluster
+        k: int - number of matches per user
+        workers: int - worker processes; defaults to the number of cores
+        rows_per_task: int - users whose matches are computed per task
+
+    Yields: (cluster, ids, match_ids, scores): tuple - a cluster, as soon as all its users are
+        done, with the output of `top_k_matches` for all of them
+    """
+    tasks = [(cluster, start, min(start + rows_per_task, len(ids)))
+             for cluster, (ids, _, _) in clusters.items()
+             for start in range(0, len(ids), rows_per_task)]
+    if not tasks:
+        return
+    remaining = {cluster: 0 for cluster in clusters}
+    for cluster, _, _ in tasks:
+        remaining[cluster] += 1
+    results = {cluster: {} for cluster in clusters}
+    with tempfile.TemporaryDirectory() as tmp:
+        for cluster, arrays in clusters.items():
+            for name, array in zip(('ids', 'vectors', 'norms'), arrays):
+                np.save(os.path.join(tmp, f'{cluster}-{name}.npy'), array)
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1,
+                                                 len(tasks))) as pool:
+            futures = [pool.submit(_task, tmp, *task, k) for task in tasks]
+            for future in as_completed(futures):
+                cluster, start, result = future.result()
+                results[cluster][start] = result
+                remaining[cluster] -= 1
+                if remaining[cluster]:
+                    continue
+                parts = [part for _, part in sorted(results.pop(cluster).items())]
+                yield (cluster, clusters[cluster][0], np.concatenate([p[0] for p in parts]),
+                       np.concatenate([p[1] for p in parts]))
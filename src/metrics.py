@@ -0,0 +1,169 @@
+import math
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from config.flaskconfig import logging, METRICS_SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, from a fast cache hit to a cold model download
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(pairs):
+    """Prometheus label set of (name, value) pairs, e.g. {route="index"}."""
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _number(value):
+    return '+Inf' if value == math.inf else repr(float(value))
+
+
+class Histogram:
+    """Thread-safe latency histogram with fixed buckets, one series per combination of labels."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name: str - metric name
+            documentation: str - help text
+            labelnames: tuple of str - names of the labels passed to `observe`, in order
+            buckets: tuple of float - sorted bucket upper bounds; +Inf is implied
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        """Record a value for the series identified by `labelvalues`."""
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def snapshot(self):
+        """Copy of every series: labels -> (per-bucket counts, sum)."""
+        with self._lock:
+            return {labels: (list(counts), total)
+                    for labels, (counts, total) in self._series.items()}
+
+    def render(self):
+        """Lines of the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labelvalues, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                le = _labels([*zip(self.labelnames, labelvalues), ('le', _number(bound))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _labels(list(zip(self.labelnames, labelvalues)))
+            lines.append(f'{self.name}_sum{labels} {_number(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """Histograms and gauge collectors of this process, rendered for a Prometheus scrape.
+
+    Sampling is decided once per request, so a sampled request has all its stages timed
+    and an unsampled one costs a single random draw.
+    """
+
+    def __init__(self, sample_rate=METRICS_SAMPLE_RATE):
+        """
+        Args:
+            sample_rate: float - fraction of requests (and of timed work outside requests) recorded
+        """
+        self.sample_rate = sample_rate
+        self._histograms = []
+        self._collectors = []
+        self._local = threading.local()
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a Histogram."""
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def collector(self, prefix, function):
+        """Export the numeric values of `function()`, e.g. a component's `metrics`, as gauges.
+
+        Args:
+            prefix: str - prepended to each key to form the metric name
+            function: callable - returns a dict of metric values; None values are skipped
+
+        Returns: None
+        """
+        self._collectors.append((prefix, function))
+
+    def start_request(self):
+        """Decide whether the current request is sampled."""
+        self._local.sampled = random.random() < self.sample_rate
+
+    def end_request(self):
+        """Forget the sampling decision once the current request is done."""
+        self._local.sampled = None
+
+    def sampled(self):
+        """Whether work on this thread should be recorded."""
+        sampled = getattr(self._local, 'sampled', None)
+        return sampled if sampled is not None else random.random() < self.sample_rate
+
+    @contextmanager
+    def timer(self, histogram, *labelvalues):
+        """Time the body of a with block into `histogram` if the current work is sampled."""
+        if not self.sampled():
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - started, *labelvalues)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format.
+
+        Returns: str
+        """
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for prefix, function in self._collectors:
+            try:
+                values = function()
+            except Exception:  # one failing component should not break the scrape
+                logger.exception('Metrics of %s could not be collected.', prefix)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (bool, int, float)):
+                    lines.append(f'# TYPE {prefix}_{key} gauge')
+                    lines.append(f'{prefix}_{key} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+REQUEST_SECONDS = METRICS.histogram('http_request_duration_seconds',
+                                    'Latency of requests by route, method and status.',
+                                    ('route', 'method', 'status'))
+STAGE_SECONDS = METRICS.histogram('stage_duration_seconds',
+                                  'Time spent in the hot steps of request handling and jobs.',
+                                  ('stage',))
+
+
+def timer(stage):
+    """Time a step, e.g. `with timer('match_query'): ...`, into the stage histogram."""
+    return METRICS.timer(STAGE_SECONDS, stage)
@@ -0,0 +1,155 @@
+import datetime
+from collections import namedtuple
+from types import SimpleNamespace
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, DateTime, MetaData, Table
+from sqlalchemy.sql import text
+
+from config.flaskconfig import logging
+from src.create_db import UserData, Photo, RegistrationJob, UserMatch, MatchCluster, add_column, \
+    create_index
+from src.matching import FACTOR_COLUMNS, MATCH_QUERY, match_params
+
+logger = logging.getLogger(__name__)
+
+# applied migrations; kept out of the models' metadata so it is only created by the Migrator
+schema_migrations = Table('schema_migrations', MetaData(),
+                          Column('version', Integer, primary_key=True),
+                          Column('name', String(100), nullable=False),
+                          Column('applied_at', DateTime, nullable=False))
+
+Migration = namedtuple('Migration', ['version', 'name', 'apply'])
+
+
+def _index(name):
+    return next(index for index in UserData.__table__.indexes if index.name == name)
+
+
+# every step checks the live schema first, so it is safe on tables that already have the change;
+# append new steps with the next version number, never edit or reorder applied ones
+MIGRATIONS = [
+    Migration(1, 'add user_data.norm',
+              lambda connection: add_column(connection, 'norm', 'FLOAT')),
+    Migration(2, 'add photos table and user_data.photo_hash',
+              lambda connection: (Photo.__table__.create(connection, checkfirst=True),
+                                  add_column(connection, 'photo_hash', 'VARCHAR(64)'))),
+    Migration(3, 'add user_data.factors',
+              lambda connection: add_column(connection, 'factors', 'BLOB')),
+    Migration(4, 'index user_data.name',
+              lambda connection: create_index(connection, _index('ix_user_data_name'))),
+    Migration(5, 'index user_data.cluster',
+              lambda connection: create_index(connection, _index('ix_user_data_cluster'))),
+    Migration(6, 'add registration_jobs table',
+              lambda connection: RegistrationJob.__table__.create(connection, checkfirst=True)),
+    Migration(7, 'add user_matches and match_clusters tables',
+              lambda connection: (UserMatch.__table__.create(connection, checkfirst=True),
+                                  MatchCluster.__table__.create(connection, checkfirst=True))),
+]
+
+
+class Migrator:
+    """Apply schema migrations to an existing database, recording them in `schema_migrations`."""
+
+    def __init__(self, engine, migrations=MIGRATIONS):
+        """
+        Args:
+            engine: :obj: sqlalchemy Engine
+            migrations: list of Migration - ordered by version
+        """
+        self.engine = engine
+        self.migrations = migrations
+        schema_migrations.create(engine, checkfirst=True)
+
+    def applied(self):
+        """Versions already applied."""
+        with self.engine.connect() as connection:
+            return {row.version for row in connection.execute(schema_migrations.select())}
+
+    def pending(self):
+        """Migrations not applied yet, in order."""
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def migrate(self):
+        """Apply every pending migration, each in its own transaction.
+
+        Returns: list of Migration - the migrations applied
+        """
+        pending = self.pending()
+        for migration in pending:
+            with self.engine.begin() as connection:
+                migration.apply(connection)
+                self._record(connection, migration)
+            logger.info('Migration %d applied: %s.', migration.version, migration.name)
+        if not pending:
+            logger.info('Database schema is up to date.')
+        return pending
+
+    def require(self, version):
+        """Stop a command that depends on a migration the database has not applied yet.
+
+        Args:
+            version: int - version of the migration
+
+        Returns: None
+        """
+        if version not in self.applied():
+            migration = next(m for m in self.migrations if m.version == version)
+            raise RuntimeError(f'Migration {version} ({migration.name}) has not been applied; '
+                               f'run `python run.py migrate` first.')
+
+    def stamp(self):
+        """Record every migration as applied without running it, e.g. for a schema just created."""
+        with self.engine.begin() as connection:
+            for migration in self.pending():
+                self._record(connection, migration)
+
+    @staticmethod
+    def _record(connection, migration):
+        connection.execute(schema_migrations.insert().values(
+            version=migration.version, name=migration.name, applied_at=datetime.datetime.utcnow()))
+
+
+def hot_queries(engine):
+    """The queries run on every homepage view and login, with representative parameters.
+
+    'materialized' is the homepage query of the 'materialized' matching backend.
+
+    Returns: dict - sql of each query, keyed by name
+    """
+    user = SimpleNamespace(id=1, cluster=0, norm=1.0, **dict.fromkeys(FACTOR_COLUMNS, 1.0))
+    login = sqlalchemy.select([UserData.__table__.c.id]) \
+        .where(UserData.__table__.c.name == 'anonymous user 0') \
+        .where(UserData.__table__.c.password == '00000')
+    match = MATCH_QUERY.params(**match_params(user, 10))
+    matches, users = UserMatch.__table__, UserData.__table__
+    materialized = sqlalchemy.select([matches.c.score, users.c.name]) \
+        .select_from(matches.join(users, users.c.id == matches.c.match_id)) \
+        .where(matches.c.user_id == 1).order_by(matches.c.rank)
+    return {name: str(query.compile(engine, compile_kwargs={'literal_binds': True}))
+            for name, query in [('match', match), ('login', login), ('materialized', materialized)]}
+
+
+def explain(engine, sql):
+    """Query plan of a statement as reported by the database.
+
+    Args:
+        engine: :obj: sqlalchemy Engine
+        sql: str - statement to explain
+
+    Returns: list of str - one line per plan row, or the database error if the statement
+        does not run on the current schema (e.g. before the columns it uses are added)
+    """
+    prefix = 'EXPLAIN QUERY PLAN' if engine.dialect.name == 'sqlite' else 'EXPLAIN'
+    with engine.connect() as connection:
+        try:
+            result = connection.execute(text(f'{prefix} {sql}'))
+        except sqlalchemy.exc.DBAPIError as error:
+            return [f'not runnable on this schema: {error.orig}']
+        return [' | '.join(str(value) for value in row) for row in result]
+
+
+def explain_hot_queries(engine):
+    """Query plans of `hot_queries`, keyed by name."""
+    return {name: explain(engine, sql) for name, sql in hot_queries(engine).items()}
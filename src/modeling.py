@@ -1,10 +1,20 @@
+import copy
+import re
+import time
+
+import numpy as np
+import pandas as pd
 from factor_analyzer.factor_analyzer import FactorAnalyzer
 from sklearn.cluster import KMeans
 import yaml
 from config.flaskconfig import logging
+from src.scoring import LinearScorer, nearest_centroid
 
 logger = logging.getLogger(__name__)
 
+# 16PF survey items are named after their factor letter and question number, e.g. 'A1'
+SURVEY_COLUMN = re.compile('^[A-P][0-9]+$')
+
 
 class OfflineModeling:
     """Class for offline modeling for deployment in production setting"""
@@ -35,3 +45,202 @@ class OfflineModeling:
         logger.info('users in the raw seed dataset are now assigned to 10 clusters.')
 
         return arrays, clusters
+
+    def scorer(self):
+        """Export the fitted models as a compact scoring artifact for the web app.
+
+        Returns: :obj: LinearScorer
+        """
+        return LinearScorer.from_models(self.fa, self.ca)
+
+
+def update_cluster_model(ca, counts, batches):
+    """Fold new rows into a fitted KMeans model without refitting it (mini-batch k-means).
+
+    Each batch is assigned to the current centroids, then every centroid moves towards its
+    new rows with a learning rate of 1 / (rows it has absorbed so far). With `counts` set to
+    the number of rows each cluster was fitted on, every centroid stays the running mean of
+    all the rows assigned to it.
+
+    Args:
+        ca: :obj: KMeans - fitted cluster analysis model
+        counts: array-like of shape (n_clusters,) - rows already represented by each centroid
+        batches: iterable of arrays of shape (n, n_factors) - factors of the new rows
+
+    Returns: (model, counts): tuple - updated copy of `ca` and the updated counts
+    """
+    centroids = np.array(ca.cluster_centers_, dtype=np.float64)
+    counts = np.array(counts, dtype=np.float64)
+    for batch in batches:
+        batch = np.asarray(batch, dtype=np.float64)
+        labels = nearest_centroid(batch, centroids)
+        for cluster in np.unique(labels):
+            rows = batch[labels == cluster]
+            counts[cluster] += len(rows)
+            centroids[cluster] += (rows.sum(axis=0) - len(rows) * centroids[cluster]) \
+                / counts[cluster]
+    model = copy.deepcopy(ca)
+    model.cluster_centers_ = centroids.astype(ca.cluster_centers_.dtype)
+    return model, counts
+
+
+def survey_columns(columns):
+    """Survey item columns among `columns`, in order."""
+    return [column for column in columns if SURVEY_COLUMN.match(str(column))]
+
+
+def compact_dtypes(frame):
+    """Downcast a table to compact dtypes: int8 for Likert answers and float32 for floats.
+
+    Args:
+        frame: :obj: pandas DataFrame - raw survey data or factors
+
+    Returns: :obj: pandas DataFrame
+    """
+    dtypes = {column: np.int8 for column in survey_columns(frame.columns)}
+    dtypes.update({column: np.float32 for column in frame.columns
+                   if column not in dtypes and frame[column].dtype == np.float64})
+    return frame.astype(dtypes)
+
+
+def read_table(path, columns=None):
+    """Read a table, with the format detected from the file extension.
+
+    Supports .csv, .parquet, .feather and .npy; .npy files are memory-mapped.
+
+    Args:
+        path: str - local file path
+        columns: list or callable - columns to read, or a predicate on column names;
+            parquet and feather files only read those columns from disk
+
+    Returns: :obj: pandas DataFrame, or a memory-mapped numpy array for .npy files
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if path.endswith('.parquet') or path.endswith('.feather'):
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names if path.endswith('.parquet') \
+            else pa.ipc.open_file(path).schema.names
+        if callable(columns):
+            columns = [name for name in names if columns(name)]
+        if path.endswith('.parquet'):
+            return pq.read_table(path, columns=columns).to_pandas()
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def read_survey(path):
+    """Read only the survey item columns of raw data, as int8.
+
+    Args:
+        path: str - local .csv, .parquet or .feather file of raw data, or a .npy file
+            holding only the survey answers
+
+    Returns: :obj: pandas DataFrame - one column per survey item
+    """
+    if path.endswith('.npy'):
+        return pd.DataFrame(np.asarray(read_table(path), dtype=np.int8))
+    survey = read_table(path, columns=lambda column: SURVEY_COLUMN.match(column) is not None)
+    return survey.astype(np.int8)
+
+
+def write_table(frame, path):
+    """Write a table, with the format detected from the file extension.
+
+    Args:
+        frame: :obj: pandas DataFrame - table to write; must be numeric for .npy files
+        path: str - local .csv, .parquet, .feather or .npy file path
+
+    Returns: None
+    """
+    frame = frame.rename(columns=str)
+    if path.endswith('.npy'):
+        np.save(path, frame.to_numpy())
+    elif path.endswith('.parquet'):
+        frame.to_parquet(path, index=False)
+    elif path.endswith('.feather'):
+        frame.reset_index(drop=True).to_feather(path)
+    else:
+        frame.to_csv(path, index=False)
+
+
+def read_chunks(path, chunk_size):
+    """Read a csv or parquet file in chunks of at most `chunk_size` rows.
+
+    Args:
+        path: str - local path of a .csv or .parquet file
+        chunk_size: int - rows per chunk
+
+    Returns: generator of :obj: pandas DataFrame
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+
+class _ChunkWriter:
+    """Append DataFrames to a csv or parquet file without holding earlier chunks in memory."""
+
+    def __init__(self, path):
+        self.path = path
+        self._parquet = None
+        self._header = True
+
+    def write(self, frame):
+        if self.path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table)
+        else:
+            frame.to_csv(self.path, mode='w' if self._header else 'a', header=self._header,
+                         index=False)
+        self._header = False
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+def score_survey(input_path, output_path, fa, ca, chunk_size=10000):
+    """Score raw survey responses in fixed-size chunks with fitted models.
+
+    Survey items are the columns named like 'A1' ... 'P10', in file order. A 'user' column,
+    if present, is carried over to the output to identify the rows.
+
+    Args:
+        input_path: str - .csv or .parquet file of raw survey responses
+        output_path: str - .csv or .parquet file to write factors and cluster labels to
+        fa: :obj: FactorAnalyzer - fitted factor analysis model
+        ca: :obj: KMeans - fitted cluster analysis model
+        chunk_size: int - rows held in memory at a time
+
+    Returns: int - number of rows scored
+    """
+    writer = _ChunkWriter(output_path)
+    started = time.monotonic()
+    n_rows = 0
+    try:
+        for chunk in read_chunks(input_path, chunk_size):
+            survey = chunk[[column for column in chunk.columns if SURVEY_COLUMN.match(column)]]
+            factors = fa.transform(survey.values)
+            scores = pd.DataFrame(factors.astype(np.float32),
+                                  columns=[f'factor{i + 1}' for i in range(factors.shape[1])])
+            scores['cluster'] = ca.predict(factors)
+            if 'user' in chunk.columns:
+                scores.insert(0, 'user', chunk['user'].values)
+            writer.write(scores)
+            n_rows += len(chunk)
+            logger.info('%d rows scored (%.0f rows/sec).', n_rows,
+                        n_rows / max(time.monotonic() - started, 1e-9))
+    finally:
+        writer.close()
+    logger.info('Scores for %d rows written to %s.', n_rows, output_path)
+    return n_rows
@@ -0,0 +1,54 @@
+import hashlib
+from io import BytesIO
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from config.flaskconfig import logging, THUMBNAIL_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def photo_hash(data):
+    """Content address of a photo.
+
+    Args:
+        data: bytes - image file contents
+
+    Returns: str - hex sha256 digest
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_mimetype(data):
+    """Guess the mimetype of an uploaded image from its magic bytes.
+
+    Args:
+        data: bytes - image file contents
+
+    Returns: str - mimetype
+    """
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE):
+    """Crop and scale a photo to a fixed-size square jpeg.
+
+    Args:
+        data: bytes - image file contents
+        size: int - width and height of the thumbnail in pixels
+
+    Returns: bytes - jpeg thumbnail, or None if the upload is not a readable image
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            thumbnail = ImageOps.fit(image.convert('RGB'), (size, size))
+    except (UnidentifiedImageError, OSError):
+        logger.warning('Uploaded photo could not be decoded; no thumbnail generated.')
+        return None
+    buffer = BytesIO()
+    thumbnail.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
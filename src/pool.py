@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from config.flaskconfig import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, \
+    DB_POOL_PRE_PING
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts take and how often the pool is exhausted.
+
+    Checkout time includes waiting for a connection to be returned and opening a new one,
+    i.e. everything a request spends before it can run its first query.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.saturated_checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._waits = deque(maxlen=1024)
+        self._metrics_lock = threading.Lock()
+
+    def _do_get(self):
+        saturated = self.capacity() is not None and self.checkedout() >= self.capacity()
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        wait = time.perf_counter() - started
+        with self._metrics_lock:
+            self.checkouts += 1
+            self.saturated_checkouts += saturated
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self._waits.append(wait)
+        return connection
+
+    def capacity(self):
+        """Maximum number of connections checked out at once, or None if overflow is unbounded."""
+        return None if self._max_overflow < 0 else self.size() + self._max_overflow
+
+    def metrics(self):
+        """Counters for monitoring.
+
+        Returns: dict - checkouts, checkouts that found every connection in use, timeouts,
+            mean/p95/max checkout seconds over recent checkouts, connections in use and
+            saturation (in use / capacity)
+        """
+        with self._metrics_lock:
+            waits = np.array(self._waits)
+            checkouts = self.checkouts
+            metrics = {'checkouts': checkouts, 'saturated_checkouts': self.saturated_checkouts,
+                       'timeouts': self.timeouts,
+                       'mean_wait_seconds': self.wait_seconds / checkouts if checkouts else 0.0,
+                       'p95_wait_seconds': float(np.percentile(waits, 95)) if len(waits) else 0.0,
+                       'max_wait_seconds': self.max_wait_seconds}
+        capacity = self.capacity()
+        metrics.update({'size': self.size(), 'checked_out': self.checkedout(),
+                        'overflow': self.overflow(),
+                        'saturation': self.checkedout() / capacity if capacity else None})
+        return metrics
+
+
+def pool_options():
+    """Keyword arguments of `create_engine` for a monitored connection pool sized from the config.
+
+    Returns: dict
+    """
+    return {'poolclass': TimedQueuePool, 'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT, 'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING}
+
+
+def engine_options(engine_string):
+    """Keyword arguments of `create_engine` for a database.
+
+    sqlite keeps SQLAlchemy's defaults: it has no server-side connections to pool or expire.
+
+    Args:
+        engine_string: str - sqlalchemy engine string
+
+    Returns: dict
+    """
+    if engine_string.startswith('sqlite'):
+        return {}
+    return pool_options()
+
+
+def pool_metrics(engine):
+    """Metrics of the pool of an engine, or an empty dict if it is not a TimedQueuePool."""
+    return engine.pool.metrics() if isinstance(engine.pool, TimedQueuePool) else {}
@@ -0,0 +1,267 @@
+import json
+import os
+import pickle
+import threading
+from collections import namedtuple
+
+from config.flaskconfig import logging, S3_BUCKET, FA_PATH, CA_PATH, SCORER_PATH, \
+    MODEL_MANIFEST_PATH, MODEL_VERSIONS_PATH, MODEL_REFRESH_INTERVAL
+from src.scoring import LinearScorer, scorer_paths
+from src.metrics import timer
+
+logger = logging.getLogger(__name__)
+
+# immutable view of the loaded models; replaced as a whole so readers never see a half-swap
+Snapshot = namedtuple('Snapshot', ['models', 'versions'])
+
+
+def model_version_prefix(version):
+    """Prefix every artifact of a model version is archived under, e.g. model/versions/v3."""
+    return f'{MODEL_VERSIONS_PATH}/v{version}'
+
+
+def pickled_model_paths(prefix):
+    """Keys of the pickled factor and cluster analysis models under a version prefix."""
+    return f'{prefix}/fa.pkl', f'{prefix}/ca.pkl'
+
+
+def load_pickled_models(bodies):
+    """Unpickle models from their serialized bytes.
+
+    Args:
+        bodies: list of bytes - pickled models, e.g. of the factor and cluster analysis models
+
+    Returns: tuple - the unpickled models, in the same order
+    """
+    return tuple(pickle.loads(body) for body in bodies)
+
+
+def load_scorer(bodies):
+    """Load a LinearScorer from its .npy arrays, given in the order of `scorer_paths`."""
+    return LinearScorer.from_bytes(dict(zip(LinearScorer.ARRAYS, bodies)))
+
+
+class S3ModelSource:
+    """Read serialized models and their version tags from an s3 bucket."""
+
+    def __init__(self, s3, bucket=S3_BUCKET):
+        """
+        Args:
+            s3: :obj: boto3 s3 client
+            bucket: str - s3 bucket name
+        """
+        self.s3 = s3
+        self.bucket = bucket
+
+    def version(self, key):
+        """Version tag of an object, fetched with a HEAD request (no body download).
+
+        Args:
+            key: str - object key in the bucket
+
+        Returns: str - object version id if versioning is enabled, otherwise its ETag; None if
+            there is no such object
+        """
+        try:
+            head = self.s3.head_object(Bucket=self.bucket, Key=key)
+        except self.s3.exceptions.ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return head.get('VersionId') or head['ETag']
+
+    def read(self, key):
+        """Download an object.
+
+        Args:
+            key: str - object key in the bucket
+
+        Returns: (body, version): tuple - raw bytes and the version tag they belong to
+        """
+        result = self.s3.get_object(Bucket=self.bucket, Key=key)
+        return result['Body'].read(), result.get('VersionId') or result['ETag']
+
+
+class LocalModelSource:
+    """Read serialized models from a local directory, e.g. for tests or offline development."""
+
+    def __init__(self, root):
+        """
+        Args:
+            root: str - directory that plays the role of the s3 bucket
+        """
+        self.root = root
+
+    def version(self, key):
+        """Version tag of a file, derived from its modification time and size; None if missing."""
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+    def read(self, key):
+        """Read a file and return its bytes along with its version tag."""
+        version = self.version(key)
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read(), version
+
+
+class ModelRegistry:
+    """Process-wide cache for fitted models.
+
+    Models are downloaded and deserialized once; a background thread then polls the
+    version tags of their objects and swaps in new models when any of them changes.
+
+    With a manifest, only the manifest is polled, and every model is read from the copies
+    archived with the version it names. The promoted copies are overwritten one by one, so
+    reading them could mix models of two versions.
+    """
+
+    def __init__(self, source, paths=(FA_PATH, CA_PATH), loader=load_pickled_models,
+                 refresh_interval=MODEL_REFRESH_INTERVAL, manifest=None,
+                 versioned_paths=pickled_model_paths):
+        """
+        Args:
+            source: :obj: S3ModelSource or LocalModelSource - where the serialized models live
+            paths: tuple of str - keys of the serialized objects, by default the pickled
+                factor and cluster analysis models
+            loader: callable - builds the models from the bytes of `paths`, in order
+            refresh_interval: float - seconds between version checks; 0 disables the refresher
+            manifest: str - key of the manifest of the promoted model version; `paths` are
+                read directly only while it does not exist
+            versioned_paths: callable - keys of the objects of `paths` under a version prefix
+        """
+        self.source = source
+        self.paths = tuple(paths)
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.manifest = manifest
+        self.versioned_paths = versioned_paths
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self):
+        """Return the current models, e.g. the (fa, ca) tuple, loading them on first use."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    self.misses += 1
+                    snapshot = self._snapshot = self._load()
+                    self.start()
+                else:
+                    self.hits += 1
+        else:
+            self.hits += 1
+        return snapshot.models
+
+    def refresh(self):
+        """Reload the models if any of their objects changed at the source.
+
+        Returns: bool - True if new models were swapped in
+        """
+        versions = self._versions()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.versions == versions:
+            return False
+        with self._lock:
+            snapshot = self._load()
+            self._snapshot = snapshot
+            self.refreshes += 1
+        logger.info('Fitted models refreshed to versions %s.', snapshot.versions)
+        return True
+
+    def start(self):
+        """Start the background refresher if it is enabled and not already running."""
+        if self.refresh_interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='model-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background refresher."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def metrics(self):
+        """Counters for monitoring.
+
+        Returns: dict - hits, misses, refreshes and failed refresh attempts
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'refreshes': self.refreshes, 'refresh_errors': self.refresh_errors}
+
+    def _versions(self):
+        """Version tags that identify the current models: the manifest's alone if it exists."""
+        if self.manifest is not None:
+            version = self.source.version(self.manifest)
+            if version is not None:
+                return (version,)
+        return tuple(self.source.version(path) for path in self.paths)
+
+    def _load(self):
+        """Download and deserialize the models, all of the same version."""
+        with timer('model_fetch'):
+            if self.manifest is not None and self.source.version(self.manifest) is not None:
+                bodies, versions = self._read_version()
+            else:
+                bodies, versions = zip(*(self.source.read(path) for path in self.paths))
+                if versions != self._versions():
+                    raise ValueError('Models changed while they were read.')
+        models = self.loader(list(bodies))
+        logger.info('Fitted models loaded into the model registry.')
+        return Snapshot(models, versions)
+
+    def _read_version(self):
+        """Read the models archived with the version named by the manifest.
+
+        Returns: (bodies, versions): tuple - raw bytes of the models, in the order of `paths`,
+            and the version tag of the manifest
+        """
+        body, tag = self.source.read(self.manifest)
+        version = json.loads(body)['version']
+        prefix = model_version_prefix(version)
+        # the archived manifest is written after the models, so it proves they are complete
+        archived = json.loads(self.source.read(f'{prefix}/manifest.json')[0])
+        if archived['version'] != version:
+            raise ValueError(f'{prefix} holds model version {archived["version"]}, '
+                             f'not {version}.')
+        return [self.source.read(key)[0] for key in self.versioned_paths(prefix)], (tag,)
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:  # keep serving the current models if the source is unreachable
+                self.refresh_errors += 1
+                logger.exception('Model refresh failed; keeping the current models.')
+
+
+_registry = None
+
+
+def get_registry(s3):
+    """Return the scorer registry shared by everything in this process, creating it on first call.
+
+    Args:
+        s3: :obj: boto3 s3 client used if the registry has to be created
+
+    Returns: :obj: ModelRegistry
+    """
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry(S3ModelSource(s3), paths=scorer_paths(SCORER_PATH),
+                                  loader=load_scorer, manifest=MODEL_MANIFEST_PATH,
+                                  versioned_paths=lambda prefix: scorer_paths(f'{prefix}/scorer'))
+    return _registry
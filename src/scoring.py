@@ -0,0 +1,126 @@
+import os
+from io import BytesIO
+
+import numpy as np
+
+
+class LinearScorer:
+    """Factor analysis transform and KMeans assignment reduced to plain numpy arrays.
+
+    For a fitted FactorAnalyzer, `transform` standardizes the answers with the training
+    means and standard deviations and multiplies by a fixed weight matrix; KMeans `predict`
+    picks the nearest centroid. Storing those four arrays as .npy files lets the web app
+    score registrations without importing factor_analyzer or unpickling sklearn objects.
+    """
+
+    ARRAYS = ('mean', 'std', 'weights', 'centroids')
+
+    def __init__(self, mean, std, weights, centroids):
+        """
+        Args:
+            mean: :obj: numpy array of shape (n_items,) - training means of the survey answers
+            std: :obj: numpy array of shape (n_items,) - training standard deviations
+            weights: :obj: numpy array of shape (n_items, n_factors) - factor score weights
+            centroids: :obj: numpy array of shape (n_clusters, n_factors) - cluster centers
+        """
+        self.mean = mean
+        self.std = std
+        self.weights = weights
+        self.centroids = centroids
+
+    @classmethod
+    def from_models(cls, fa, ca):
+        """Export the arrays used by fitted models.
+
+        Args:
+            fa: :obj: FactorAnalyzer - fitted factor analysis model
+            ca: :obj: KMeans - fitted cluster analysis model
+
+        Returns: :obj: LinearScorer
+        """
+        structure = fa.structure_ if fa.structure_ is not None else fa.loadings_
+        try:
+            weights = np.linalg.solve(fa.corr_, structure)
+        except np.linalg.LinAlgError:
+            # FactorAnalyzer.transform falls back to the loadings in this case
+            weights = fa.loadings_
+        return cls(fa.mean_, fa.std_, weights, ca.cluster_centers_)
+
+    @classmethod
+    def from_bytes(cls, bodies):
+        """Load a scorer from serialized arrays.
+
+        Args:
+            bodies: dict - .npy file contents keyed by the names in `ARRAYS`
+
+        Returns: :obj: LinearScorer
+        """
+        return cls(**{name: np.load(BytesIO(bodies[name]), allow_pickle=False)
+                      for name in cls.ARRAYS})
+
+    @classmethod
+    def load(cls, directory):
+        """Load a scorer saved with `save`."""
+        return cls(**{name: np.load(os.path.join(directory, f'{name}.npy'), allow_pickle=False)
+                      for name in cls.ARRAYS})
+
+    def to_bytes(self):
+        """Serialize the arrays.
+
+        Returns: dict - .npy file contents keyed by the names in `ARRAYS`
+        """
+        bodies = {}
+        for name in self.ARRAYS:
+            buffer = BytesIO()
+            np.save(buffer, getattr(self, name), allow_pickle=False)
+            bodies[name] = buffer.getvalue()
+        return bodies
+
+    def save(self, directory):
+        """Save the arrays as .npy files in `directory`."""
+        os.makedirs(directory, exist_ok=True)
+        for name, body in self.to_bytes().items():
+            with open(os.path.join(directory, f'{name}.npy'), 'wb') as f:
+                f.write(body)
+
+    def transform(self, survey):
+        """Factor scores of raw survey answers, as `FactorAnalyzer.transform`.
+
+        Args:
+            survey: array-like of shape (n, n_items) - raw survey answers
+
+        Returns: :obj: numpy array of shape (n, n_factors)
+        """
+        return np.dot((np.asarray(survey, dtype=np.float64) - self.mean) / self.std, self.weights)
+
+    def predict(self, factors):
+        """Nearest centroid of each row, as `KMeans.predict`.
+
+        Args:
+            factors: array-like of shape (n, n_factors) - factor scores
+
+        Returns: :obj: numpy array of shape (n,) - cluster labels
+        """
+        return nearest_centroid(factors, self.centroids)
+
+
+def nearest_centroid(factors, centroids):
+    """Index of the closest centroid (in euclidean distance) to each row.
+
+    Args:
+        factors: array-like of shape (n, n_factors) - factor scores
+        centroids: array-like of shape (n_clusters, n_factors) - cluster centers
+
+    Returns: :obj: numpy array of shape (n,) - cluster labels
+    """
+    factors = np.asarray(factors, dtype=np.float64)
+    centroids = np.asarray(centroids, dtype=np.float64)
+    distances = (np.einsum('ij,ij->i', factors, factors)[:, None]
+                 - 2 * factors @ centroids.T
+                 + np.einsum('ij,ij->i', centroids, centroids)[None, :])
+    return np.argmin(distances, axis=1)
+
+
+def scorer_paths(prefix):
+    """Keys of the scorer arrays under an s3 prefix or local directory."""
+    return tuple(f'{prefix}/{name}.npy' for name in LinearScorer.ARRAYS)
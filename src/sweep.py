@@ -0,0 +1,149 @@
+import itertools
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from factor_analyzer.factor_analyzer import FactorAnalyzer
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
+
+from config.flaskconfig import logging
+
+logger = logging.getLogger(__name__)
+
+RESULT_COLUMNS = ['n_factors', 'rotation', 'n_clusters', 'fa_fit_seconds', 'ca_fit_seconds',
+                  'inertia', 'silhouette', 'peak_rss_mb']
+
+# standardized survey matrix of a worker process, memory-mapped once by `_attach`
+_survey = None
+
+
+def standardize(survey):
+    """Center and scale survey answers column by column.
+
+    FactorAnalyzer works on the correlation matrix, so fitting it on standardized answers
+    gives the same model as fitting it on the raw answers.
+
+    Args:
+        survey: array-like of shape (n, n_items) - raw survey answers
+
+    Returns: :obj: numpy array of shape (n, n_items) - float64 z-scores
+    """
+    survey = np.asarray(survey, dtype=np.float64)
+    std = survey.std(axis=0)
+    return (survey - survey.mean(axis=0)) / np.where(std > 0, std, 1)
+
+
+def sweep_grid(n_factors, rotations, n_clusters):
+    """Factor model settings to fit, each with every cluster count.
+
+    Args:
+        n_factors: list of int - numbers of factors
+        rotations: list of str - FactorAnalyzer rotations, e.g. 'promax' or 'varimax'
+        n_clusters: list of int - numbers of clusters
+
+    Returns: list of (n_factors, rotation, n_clusters) tuples, one per factor model
+    """
+    return [(k, rotation, tuple(n_clusters))
+            for k, rotation in itertools.product(n_factors, rotations)]
+
+
+def _reset_peak_rss():
+    """Restart the count of peak resident memory of this process, where linux allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process since `_reset_peak_rss`, or over its lifetime
+    where the count cannot be restarted."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _attach(path):
+    """Pool initializer: memory-map the standardized matrix, shared through the page cache."""
+    global _survey
+    _survey = np.load(path, mmap_mode='r')
+
+
+def _fit(n_factors, rotation, n_clusters, sample_size, random_state):
+    """Fit one factor model and a KMeans model per cluster count on the shared matrix.
+
+    The peak memory of a row is that of the worker while fitting its factor model and KMeans
+    model, not since the worker started, so earlier settings do not inflate it.
+    """
+    rows = []
+    # one BLAS thread per worker; the pool already keeps every core busy
+    with threadpool_limits(limits=1):
+        _reset_peak_rss()
+        started = time.monotonic()
+        fa = FactorAnalyzer(n_factors=n_factors, rotation=rotation)
+        fa.fit(_survey)
+        factors = fa.transform(_survey)
+        fa_seconds = time.monotonic() - started
+        fa_peak = _peak_rss_mb()
+        for k in n_clusters:
+            _reset_peak_rss()
+            started = time.monotonic()
+            ca = KMeans(n_clusters=k, random_state=random_state)
+            labels = ca.fit_predict(factors)
+            ca_seconds = time.monotonic() - started
+            silhouette = silhouette_score(factors, labels,
+                                          sample_size=min(sample_size, len(factors)),
+                                          random_state=random_state)
+            rows.append([n_factors, rotation, k, fa_seconds, ca_seconds, ca.inertia_, silhouette,
+                         max(fa_peak, _peak_rss_mb())])
+    return rows
+
+
+def run_sweep(survey, n_factors, rotations, n_clusters, workers=None, sample_size=5000,
+              random_state=42):
+    """Fit factor and cluster analysis models over a grid of settings in a process pool.
+
+    The standardized survey matrix is written once to a temporary .npy file that every
+    worker memory-maps, instead of being pickled into each task.
+
+    Args:
+        survey: array-like of shape (n, n_items) - raw survey answers
+        n_factors: list of int - numbers of factors
+        rotations: list of str - FactorAnalyzer rotations
+        n_clusters: list of int - numbers of clusters
+        workers: int - worker processes; defaults to the number of cores
+        sample_size: int - rows sampled to compute the silhouette score
+        random_state: int - seed of KMeans and of the silhouette sample
+
+    Returns: :obj: pandas DataFrame - one row per setting with the columns in RESULT_COLUMNS,
+        best silhouette first
+    """
+    grid = sweep_grid(n_factors, rotations, n_clusters)
+    workers = min(workers or os.cpu_count() or 1, len(grid))
+    rows = []
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'survey.npy')
+        np.save(path, standardize(survey))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                 initargs=(path,)) as pool:
+            futures = [pool.submit(_fit, *setting, sample_size, random_state) for setting in grid]
+            for future in as_completed(futures):
+                rows.extend(future.result())
+                logger.info('%d/%d factor models fitted.', len(rows) // len(n_clusters), len(grid))
+    logger.info('Sweep of %d settings finished in %.1fs on %d workers.', len(rows),
+                time.monotonic() - started, workers)
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS) \
+        .sort_values(['silhouette', 'inertia'], ascending=[False, True]).reset_index(drop=True)
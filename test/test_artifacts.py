@@ -0,0 +1,126 @@
+import io
+import json
+import pickle
+import zipfile
+
+import pandas as pd
+import pytest
+
+from src.artifacts import ArtifactCache
+from src.ingest import Ingest, MultipartWriter
+
+
+class FakeS3:
+    """in-memory stand-in for the boto3 s3 client calls used by the cache."""
+
+    def __init__(self):
+        self.objects = {}
+        self.downloads = 0
+
+    def put(self, key, body, etag):
+        self.objects[key] = (body, f'"{etag}"')
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': self.objects[Key][1]}
+
+    def get_object(self, Bucket, Key):
+        self.downloads += 1
+        body, etag = self.objects[Key]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Body, Bucket, Key):
+        self.put(Key, Body, 'put')
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.uploads = {}
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        self.uploads[PartNumber] = Body
+        return {'ETag': f'part{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        body = b''.join(self.uploads[part['PartNumber']] for part in MultipartUpload['Parts'])
+        self.put(Key, body, 'multipart')
+
+
+def test_cache_downloads_each_version_once(tmp_path):
+    """test unchanged objects are read locally and changed ones are downloaded again."""
+    s3 = FakeS3()
+    s3.put('raw/data.csv', b'user,A1\n0,1\n1,5\n', 'v1')
+    cache = ArtifactCache(s3, bucket='bucket', root=str(tmp_path), offline=False)
+
+    first = cache.get_frame('raw/data.csv')
+    second = cache.get_frame('raw/data.csv')
+    assert s3.downloads == 1
+    pd.testing.assert_frame_equal(first, second)
+
+    s3.put('raw/data.csv', b'user,A1\n0,2\n', 'v2')
+    assert cache.get_frame('raw/data.csv')['A1'].tolist() == [2]
+    assert s3.downloads == 2
+
+
+def test_offline_mode_reads_local_copies_only(tmp_path):
+    """test offline mode serves the cached copy without s3 and fails clearly without one."""
+    s3 = FakeS3()
+    s3.put('model/fa.pkl', b'model bytes', 'v1')
+    ArtifactCache(s3, bucket='bucket', root=str(tmp_path), offline=False).get_bytes('model/fa.pkl')
+
+    offline = ArtifactCache(None, bucket='bucket', root=str(tmp_path), offline=True)
+    assert offline.get_bytes('model/fa.pkl') == b'model bytes'
+    with pytest.raises(FileNotFoundError):
+        offline.get_bytes('model/ca.pkl')
+
+
+def test_models_are_read_offline_from_the_cache(tmp_path):
+    """test offline mode loads cached models, of the archived version the cached manifest names."""
+    s3 = FakeS3()
+    for key, model in (('model/fa.pkl', 'fa v1'), ('model/ca.pkl', 'ca v1')):
+        s3.put(key, pickle.dumps(model), 'v1')
+    online = ArtifactCache(s3, bucket='bucket', root=str(tmp_path), offline=False)
+    ingest = Ingest()
+    ingest.s3, ingest.cache = None, ArtifactCache(None, bucket='bucket', root=str(tmp_path),
+                                                  offline=True)
+
+    for key in list(s3.objects):
+        online.get_bytes(key)
+    assert ingest.download_manifest_from_s3() is None
+    assert ingest.download_model_from_s3() == ('fa v1', 'ca v1')
+
+    s3.put('model/manifest.json', json.dumps({'version': 2}).encode(), 'v2')
+    for name in ('fa', 'ca'):
+        s3.put(f'model/versions/v2/{name}.pkl', pickle.dumps(f'{name} v2'), 'v2')
+    for key in list(s3.objects):
+        online.get_bytes(key)
+    assert ingest.download_model_from_s3() == ('fa v2', 'ca v2')
+    assert ingest.download_model_from_s3(None) == ('fa v1', 'ca v1')
+
+
+def test_multipart_writer_uploads_in_parts():
+    """test buffered writes are uploaded as parts and reassembled in order."""
+    s3 = FakeS3()
+    with MultipartWriter(s3, 'bucket', 'raw/data.csv', part_size=10) as target:
+        for i in range(5):
+            target.write(f'row {i}\n'.encode())
+
+    assert len(s3.uploads) == 3
+    assert s3.objects['raw/data.csv'][0] == b''.join(f'row {i}\n'.encode() for i in range(5))
+
+
+def test_streaming_ingest_from_local_archive(tmp_path):
+    """test the archive members are picked by name and the tsv is converted to csv in chunks."""
+    survey = pd.DataFrame({'A1': range(1, 26), 'B1': range(25, 0, -1), 'age': 30})
+    archive = tmp_path / '16PF.zip'
+    with zipfile.ZipFile(archive, 'w') as file:
+        file.writestr('16PF/data.csv', survey.to_csv(sep='\t', index=False))
+        file.writestr('16PF/codebook.html', '<html>codebook</html>')
+    ingest = Ingest()
+    ingest.s3 = FakeS3()
+
+    ingest.upload_data_to_s3(source=f'file://{archive}', chunk_size=7)
+
+    bodies = {key: body for key, (body, etag) in ingest.s3.objects.items()}
+    assert b'codebook' in bodies['raw/codebook.txt']
+    uploaded = pd.read_csv(io.BytesIO(bodies['raw/data.csv']))
+    assert uploaded['user'].tolist() == list(range(25))
+    pd.testing.assert_frame_equal(uploaded.drop(columns='user'), survey)
@@ -0,0 +1,54 @@
+from sqlalchemy import event, inspect
+
+from src.create_db import Base, UserData, SurveyManager
+from src.matching import FACTOR_COLUMNS
+
+
+def make_manager():
+    """set up an in-memory sqlite database with a user holding a legacy base64 photo."""
+    sm = SurveyManager(engine_string='sqlite://')
+    Base.metadata.create_all(sm.engine)
+    sm.session.add(UserData(name='qiana', password='secret', cluster=0, image='aGVsbG8=',
+                            **dict.fromkeys(FACTOR_COLUMNS, 1.0)))
+    sm.session.commit()
+    sm.session.expunge_all()
+    return sm
+
+
+def test_load_user_skips_password_and_photo():
+    """test the session user is loaded in one query without the password and legacy photo."""
+    sm = make_manager()
+    statements = []
+    event.listen(sm.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+
+    user = sm.load_user(1)
+    assert user.has_photo and user.name == 'qiana' and user.cluster == 0
+
+    assert len(statements) == 1
+    unloaded = inspect(user).unloaded
+    assert 'image' in unloaded and 'password' in unloaded
+    assert sm.load_user(2) is None
+
+
+def test_homepage_reads_no_unloaded_column():
+    """test the attributes index.html and the match backends read from the user are loaded."""
+    sm = make_manager()
+    user = sm.load_user(1)
+    statements = []
+    event.listen(sm.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+
+    # read by index.html, then by find_matches and the sql match query
+    for attribute in ['name', 'age', 'id', 'has_photo', 'cluster', 'norm', 'factors',
+                      *FACTOR_COLUMNS]:
+        getattr(user, attribute)
+    assert statements == []
+
+
+def test_authenticate_and_username_exists():
+    """test credential lookups and existence checks."""
+    sm = make_manager()
+    assert sm.authenticate('qiana', 'secret').id == 1
+    assert sm.authenticate('qiana', 'wrong') is None
+    assert sm.username_exists('qiana') and not sm.username_exists('someone else')
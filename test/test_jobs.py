@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.create_db import Base, UserData, SurveyManager
+from src.jobs import RegistrationQueue
+from src.registry import ModelRegistry, LocalModelSource, load_scorer
+from src.scoring import LinearScorer, scorer_paths
+
+
+def make_manager(tmp_path):
+    """set up a sqlite file database, shared by the worker threads, and a stand-in scorer."""
+    rng = np.random.default_rng(0)
+    LinearScorer(np.zeros(4), np.ones(4), rng.normal(size=(4, 12)),
+                 rng.normal(size=(3, 12))).save(str(tmp_path / 'scorer'))
+    registry = ModelRegistry(LocalModelSource(str(tmp_path)), paths=scorer_paths('scorer'),
+                             loader=load_scorer, refresh_interval=0)
+    sm = SurveyManager(engine_string=f"sqlite:///{tmp_path / 'jobs.db'}", registry=registry)
+    Base.metadata.create_all(sm.engine)
+    return sm
+
+
+def test_registrations_are_stored_in_the_background(tmp_path, monkeypatch):
+    """test queued registrations are scored and stored, and failures are reported by status."""
+    sm = make_manager(tmp_path)
+    # hold the workers on their first jobs until the queued ones have been checked
+    release, add_user_record = threading.Event(), sm.add_user_record
+    monkeypatch.setattr(sm, 'add_user_record',
+                        lambda **registration: release.wait(5) and add_user_record(**registration))
+    queue = RegistrationQueue(sm, workers=2)
+    survey = pd.DataFrame([[1, 2, 3, 4]], columns=['A1', 'A2', 'A3', 'A4'])
+
+    for i in range(5):
+        queue.submit(username=f'user {i}', password='00000', age=30, gender=1,
+                     survey=survey, image=None)
+    # a survey with the wrong number of answers cannot be scored
+    queue.submit(username='broken', password='00000', age=30, gender=1,
+                 survey=survey.iloc[:, :2], image=None)
+    assert queue.status('broken') == ('pending', None) and queue.is_queued('broken')
+    assert not sm.username_exists('broken')
+    release.set()
+    queue.shutdown()
+
+    assert sm.session.query(UserData).count() == 5
+    assert queue.status('user 0') == ('done', None)
+    assert queue.status('broken')[0] == 'failed' and queue.status('nobody') is None
+    assert not queue.is_queued('broken') and not sm.username_exists('broken')
+    metrics = queue.metrics()
+    assert metrics['depth'] == 0 and metrics['completed'] == 5 and metrics['failed'] == 1
+    assert metrics['mean_processing_seconds'] > 0
+
+
+def test_failure_that_cannot_be_recorded_is_still_counted(tmp_path, monkeypatch):
+    """test a failed job is counted even when its failure cannot be written to the database."""
+    sm = make_manager(tmp_path)
+    queue = RegistrationQueue(sm, workers=1)
+    update = queue._update
+
+    def update_unless_failed(job_id, **values):
+        if values['status'] == 'failed':
+            raise RuntimeError('database is unreachable')
+        update(job_id, **values)
+
+    monkeypatch.setattr(queue, '_update', update_unless_failed)
+    survey = pd.DataFrame([[1, 2]], columns=['A1', 'A2'])
+    queue.submit(username='broken', password='00000', age=30, gender=1, survey=survey, image=None)
+    queue.shutdown()
+
+    assert queue.status('broken') == ('running', None)
+    metrics = queue.metrics()
+    assert metrics['depth'] == 0 and metrics['completed'] == 0 and metrics['failed'] == 1
@@ -0,0 +1,320 @@
+import threading
+
+import numpy as np
+import pytest
+from sqlalchemy import event as sqlalchemy_event
+
+from src.create_db import Base, UserData, SurveyManager, seed_records, is_seed_name
+from src.cache import MatchCache
+from src.matching import MatchIndex, ApproximateMatchIndex, FACTOR_COLUMNS, factor_norm, \
+    sql_matches, factor_vector, unpack_factors, factor_columns
+from src.migrations import Migrator
+from src.registry import ModelRegistry, LocalModelSource, load_scorer
+from src.scoring import LinearScorer, nearest_centroid, scorer_paths
+
+
+def make_manager(n_users=300, n_clusters=3, seed=0, with_norms=True, packed=False,
+                 factors=None, engine_string='sqlite://'):
+    """set up a sqlite database, in memory by default, with random users."""
+    sm = SurveyManager(engine_string=engine_string)
+    Base.metadata.create_all(sm.engine)
+    rng = np.random.default_rng(seed)
+    if factors is None:
+        factors = rng.normal(size=(n_users, len(FACTOR_COLUMNS)))
+    sm.session.add_all([UserData(name=f'user {i}', password='00000',
+                                 cluster=int(rng.integers(n_clusters)), gender=1.0,
+                                 norm=float(factor_norm(factors[i])) if with_norms else None,
+                                 **(factor_columns(factors[i]) if packed else
+                                    dict(zip(FACTOR_COLUMNS, factors[i].tolist()))))
+                        for i in range(len(factors))])
+    sm.session.commit()
+    return sm
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_index_ranking_matches_sql(packed):
+    """test the in-memory index returns exactly the ranking of the sql match query."""
+    sm = make_manager(packed=packed)
+    for user in sm.session.query(UserData).limit(20):
+        expected = sql_matches(sm.session.connection(), user, 10)
+        actual = sm.find_matches(user, 10)
+        assert [row.name for row in actual] == [row.name for row in expected]
+        assert np.allclose([row.cosine for row in actual], [row.cosine for row in expected])
+        assert all(row.sex == 'Male' for row in actual)
+
+
+def test_packed_ranking_matches_sql_on_near_ties():
+    """test packed factors rank users whose cosines differ by less than float32 precision
+    exactly like the sql match query, given double-precision factor columns as in sqlite."""
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(20, len(FACTOR_COLUMNS)))
+    # groups of ten near-duplicates of every query, whose cosines with it tie in float32
+    near = np.repeat(queries + rng.normal(size=queries.shape), 10, axis=0) \
+        + rng.normal(scale=1e-9, size=(200, len(FACTOR_COLUMNS)))
+    sm = make_manager(n_clusters=1, packed=True, factors=np.vstack([queries, near]))
+    for user in sm.session.query(UserData).limit(20):
+        expected = sql_matches(sm.session.connection(), user, 10)
+        assert [row.id for row in sm.find_matches(user, 10)] == [row.id for row in expected]
+
+
+def test_backfill_norms():
+    """test missing norms are filled in once the migration adding the column is applied."""
+    sm = make_manager(n_users=20, with_norms=False)
+    with pytest.raises(RuntimeError, match='run.py migrate'):
+        sm.backfill_norms()
+    Migrator(sm.engine).stamp()
+    sm.backfill_norms()
+
+    for user in sm.session.query(UserData):
+        assert np.isclose(user.norm, factor_norm([getattr(user, c) for c in FACTOR_COLUMNS]))
+
+
+def test_index_sees_new_registrations():
+    """test users inserted after the index is loaded are matched once synced."""
+    sm = make_manager(n_users=50, n_clusters=1)
+    user = sm.session.query(UserData).first()
+    sm.find_matches(user, 10)
+
+    twin = UserData(name='twin', password='00000', cluster=user.cluster,
+                    **{column: getattr(user, column) * 2 for column in FACTOR_COLUMNS})
+    sm.session.add(twin)
+    sm.session.commit()
+    sm.sync_match_index(force=True)
+
+    assert sm.find_matches(user, 10)[0].name == 'twin'
+
+
+def test_match_index_built_off_the_request_path(tmp_path, monkeypatch):
+    """test cells and reloaded indexes are built on a background thread while the current index
+    keeps serving matches, and swapped in once complete."""
+    sm = make_manager(n_users=200, n_clusters=1,
+                      engine_string=f"sqlite:///{tmp_path / 'users.db'}")
+    started, release = threading.Event(), threading.Event()
+
+    class SlowIndex(ApproximateMatchIndex):
+        def __init__(self):
+            super().__init__(cell_size=10, nprobe=2)
+
+        def build_cells(self):
+            started.set()
+            release.wait(5)
+            return super().build_cells()
+
+    sm.index_class = SlowIndex
+    user = sm.session.query(UserData).first()
+    sm.find_matches(user, 10)
+    assert started.wait(5) and sm.match_index.stale_clusters() == [user.cluster]
+
+    twin = UserData(name='twin', password='00000', cluster=user.cluster, norm=user.norm * 2,
+                    **{column: getattr(user, column) * 2 for column in FACTOR_COLUMNS})
+    sm.session.add(twin)
+    sm.session.commit()
+    sm.sync_match_index(force=True)
+    assert sm.find_matches(user, 10)[0].name == 'twin'
+    release.set()
+    sm._builder.join()
+    assert sm.match_index.stale_clusters() == []
+
+    monkeypatch.setattr('src.create_db.MATCH_INDEX_RELOAD_INTERVAL', 0)
+    current = sm.match_index
+    started.clear()
+    release.clear()
+    sm.sync_match_index(force=True)
+    assert started.wait(5) and sm.match_index is current
+    sm.session.add(UserData(name='late', password='00000', cluster=user.cluster,
+                            norm=user.norm, **{c: getattr(user, c) for c in FACTOR_COLUMNS}))
+    sm.session.commit()
+    release.set()
+    sm._builder.join()
+    assert sm.match_index is not current and len(sm.match_index) == 202
+
+
+def test_top_k_excludes_user_and_handles_small_clusters():
+    """test the querying user is never matched and k larger than the cluster is fine."""
+    index = MatchIndex()
+    vectors = np.eye(12)[:3]
+    index.add([1, 2, 3], [0, 0, 1], vectors)
+
+    ids, scores = index.top_k(1, 0, vectors[0], 10)
+
+    assert ids.tolist() == [2]
+    assert index.top_k(1, 5, vectors[0], 10)[0].size == 0
+    assert len(index) == 3
+
+
+def test_approximate_index_recall_and_new_users():
+    """test probing every cell is exact, probing a few keeps most matches, and users added after
+    the cells were built are still found."""
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(5000, 12))
+    exact, approximate = MatchIndex(), ApproximateMatchIndex(cell_size=100, nprobe=10)
+    for index in (exact, approximate):
+        index.add(np.arange(1, 5001), np.zeros(5000), vectors)
+    assert approximate.stale_clusters() == [0] and approximate.build_cells() == 1
+    assert approximate.stale_clusters() == []
+    queries = range(1, 5001, 100)
+
+    recall = np.mean([len(set(approximate.top_k(i, 0, vectors[i - 1], 10)[0])
+                          & set(exact.top_k(i, 0, vectors[i - 1], 10)[0])) / 10 for i in queries])
+    assert 0.5 < recall < 1
+    approximate.nprobe = 50
+    for i in queries:
+        assert approximate.top_k(i, 0, vectors[i - 1], 10)[0].tolist() == \
+            exact.top_k(i, 0, vectors[i - 1], 10)[0].tolist()
+
+    approximate.nprobe = 1
+    approximate.add([5001], [0], [vectors[0] * 2])
+    assert approximate.top_k(1, 0, vectors[0], 1)[0].tolist() == [5001]
+
+
+def test_cross_cluster_matches_near_a_boundary(tmp_path):
+    """test a user on a cluster boundary is matched with users of the closest other cluster,
+    distant clusters are pruned, and new users there invalidate the cached matches."""
+    centroids = np.zeros((3, 12))
+    centroids[0, 0], centroids[1, 1], centroids[2, 0] = 3, 3, -3
+    LinearScorer(np.zeros(4), np.ones(4), np.zeros((4, 12)), centroids) \
+        .save(str(tmp_path / 'scorer'))
+    registry = ModelRegistry(LocalModelSource(str(tmp_path)), paths=scorer_paths('scorer'),
+                             loader=load_scorer, refresh_interval=0)
+    sm = SurveyManager(engine_string='sqlite://', registry=registry)
+    Base.metadata.create_all(sm.engine)
+    rng = np.random.default_rng(0)
+    for i in range(90):
+        factors = centroids[i % 3] + rng.normal(scale=0.3, size=12)
+        sm.session.add(UserData(name=f'user {i}', password='00000', cluster=i % 3,
+                                **dict(zip(FACTOR_COLUMNS, factors.tolist()))))
+    boundary = centroids[0] / 2 + centroids[1] / 2
+    user = UserData(name='boundary', password='00000', cluster=0,
+                    **dict(zip(FACTOR_COLUMNS, boundary.tolist())))
+    sm.session.add_all([user, UserData(name='twin', password='00000', cluster=1,
+                                       **dict(zip(FACTOR_COLUMNS, (boundary * 2).tolist())))])
+    sm.session.commit()
+
+    assert 'twin' not in [match.name for match in sm.find_matches(user, 5)]
+    sm.match_cache.clear()
+    sm.neighbor_clusters = 2
+    assert sm.neighbours(user) == [1, 2]
+    assert sm.find_matches(user, 5)[0].name == 'twin'
+    assert sm.match_index.clusters_pruned == 1
+
+    closer = UserData(name='closer', password='00000', cluster=1,
+                      **dict(zip(FACTOR_COLUMNS, (boundary * 3).tolist())))
+    sm.session.add(closer)
+    sm.session.commit()
+    sm.sync_match_index(force=True)
+    assert [match.name for match in sm.find_matches(user, 2)] == ['twin', 'closer']
+
+
+def test_match_cache_invalidation_and_eviction():
+    """test cached matches are dropped per cluster and evicted least recently used first."""
+    cache = MatchCache(maxsize=2)
+    cache.put_matches(1, 0, ['a'], cache.generation(0))
+    cache.put_matches(2, 1, ['b'], cache.generation(1))
+    assert cache.get_matches(1, 0) == ['a']
+
+    cache.put_matches(3, 1, ['c'], cache.generation(1))
+    assert cache.get_matches(2, 1) is None
+
+    stale = cache.generation(0)
+    cache.invalidate_cluster(0)
+    cache.put_matches(1, 0, ['stale'], stale)
+    assert cache.get_matches(1, 0) is None
+    assert cache.get_matches(3, 1) == ['c']
+    assert cache.metrics()['evictions'] == 1
+
+
+def test_sql_match_cache_sees_other_workers(tmp_path, monkeypatch):
+    """test the sql backend drops cached matches of clusters another worker inserted users into."""
+    monkeypatch.setattr('src.create_db.MATCH_BACKEND', 'sql')
+    monkeypatch.setattr('src.create_db.MATCH_INDEX_SYNC_INTERVAL', 0)
+    url = f"sqlite:///{tmp_path / 'shared.db'}"
+    worker, other = SurveyManager(engine_string=url), SurveyManager(engine_string=url)
+    Base.metadata.create_all(worker.engine)
+    rng = np.random.default_rng(0)
+
+    def make_user(name, cluster, vector):
+        return UserData(name=name, password='00000', cluster=cluster,
+                        norm=float(factor_norm(vector)), **factor_columns(vector))
+
+    worker.session.add_all([make_user(f'user {i}', i % 2, rng.normal(size=12))
+                            for i in range(20)])
+    worker.session.commit()
+    user = worker.session.query(UserData).first()
+    worker.find_matches(user, 10)
+    assert len(worker.match_cache) == 1
+
+    other.session.add(make_user('elsewhere', 1 - user.cluster, factor_vector(user) * 2))
+    other.session.commit()
+    assert worker.find_matches(user, 10)[0].name != 'elsewhere'
+    assert worker.match_cache.metrics()['hits'] == 1
+
+    other.session.add(make_user('twin', user.cluster, factor_vector(user) * 2))
+    other.session.commit()
+    assert worker.find_matches(user, 10)[0].name == 'twin'
+
+
+def test_load_seed_records_in_chunks_and_resume():
+    """test seed records are bulk loaded in chunks and a rerun resumes where it stopped."""
+    sm = SurveyManager(engine_string='sqlite://')
+    Base.metadata.create_all(sm.engine)
+    rng = np.random.default_rng(1)
+    records = seed_records(rng.normal(size=(25, 12)), rng.integers(3, size=25),
+                           np.array([[30.0, 1.0]] * 24 + [[np.nan, 2.0]]))
+
+    assert sm.next_seed_record() == 0
+    assert sm.load_records(records.iloc[:10], chunk_size=4) == 10
+    # resuming does not depend on how many seed records are left, e.g. after a deletion
+    sm.session.query(UserData).filter(UserData.name == 'anonymous user 3').delete()
+    sm.session.commit()
+    assert sm.next_seed_record() == 10
+    assert sm.load_records(records, chunk_size=4, start=sm.next_seed_record()) == 25
+
+    users = sm.session.query(UserData).order_by(UserData.id).all()
+    assert [user.name for user in users] == [f'anonymous user {i}' for i in range(25) if i != 3]
+    assert is_seed_name(users[0].name) and not is_seed_name('anonymous')
+    assert users[-1].age is None and np.isclose(users[0].norm, records['norm'][0])
+
+
+def test_reassign_clusters_updates_changed_rows_only():
+    """test users move to their nearest centroid and unchanged rows are not written."""
+    sm = make_manager(n_users=200, n_clusters=3)
+    centroids = np.random.default_rng(1).normal(size=(3, len(FACTOR_COLUMNS)))
+    ids, clusters, factors = map(np.concatenate, zip(*sm.factor_batches(batch_size=64)))
+    expected = nearest_centroid(factors, centroids)
+    user = sm.session.query(UserData).first()
+    sm.find_matches(user, 10)
+
+    statements = []
+    sqlalchemy_event.listen(sm.engine, 'before_cursor_execute',
+                            lambda conn, cursor, statement, parameters, context, executemany:
+                            statements.append((statement, parameters)))
+    assert sm.reassign_clusters(centroids, batch_size=64) == np.count_nonzero(expected != clusters)
+
+    updated = [params for statement, params in statements if statement.startswith('UPDATE')]
+    assert sum(len(params) for params in updated) == np.count_nonzero(expected != clusters)
+    stored = dict(sm.session.query(UserData.id, UserData.cluster))
+    assert [stored[i] for i in ids.tolist()] == expected.tolist()
+    sm.session.expire_all()
+    user = sm.session.query(UserData).first()
+    assert all(match.id in ids[expected == user.cluster] for match in sm.find_matches(user, 10))
+
+
+def test_pack_factors_migration():
+    """test legacy rows get packed float64 factors and the ranking is unchanged."""
+    sm = make_manager(n_users=120, n_clusters=2)
+    users = sm.session.query(UserData).limit(5).all()
+    before = [[match.id for match in sm.find_matches(user, 10)] for user in users]
+    Migrator(sm.engine).stamp()
+    sm.pack_factors(batch_size=50)
+
+    rows = sm.session.query(UserData).order_by(UserData.id).all()
+    packed = unpack_factors([row.factors for row in rows])
+    assert packed.dtype == np.float64 and packed.shape == (120, len(FACTOR_COLUMNS))
+    columns = [[getattr(row, c) for c in FACTOR_COLUMNS] for row in rows]
+    assert np.array_equal(packed, columns)
+    assert np.array_equal(factor_vector(rows[0]), packed[0])
+
+    # rebuild the index from the packed column
+    sm._loaded_at = None
+    after = [[match.id for match in sm.find_matches(user, 10)] for user in users]
+    assert after == before
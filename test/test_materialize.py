@@ -0,0 +1,75 @@
+import numpy as np
+
+from src.create_db import Base, UserData, UserMatch, SurveyManager
+from src.matching import MatchIndex, FACTOR_COLUMNS, factor_vector
+from src.materialize import top_k_matches, cluster_signatures
+
+
+def make_manager(tmp_path, n_users=200, n_clusters=3):
+    """set up a sqlite file database with random users."""
+    sm = SurveyManager(engine_string=f"sqlite:///{tmp_path / 'matches.db'}")
+    Base.metadata.create_all(sm.engine)
+    rng = np.random.default_rng(0)
+    sm.session.add_all([UserData(name=f'user {i}', password='00000', cluster=i % n_clusters,
+                                 **dict(zip(FACTOR_COLUMNS, rng.normal(size=12).tolist())))
+                        for i in range(n_users)])
+    sm.session.commit()
+    return sm
+
+
+def test_blocked_top_k_matches_the_index(monkeypatch):
+    """test block-wise top k gives the ranking of the in-memory index, whatever the block size."""
+    monkeypatch.setattr('src.materialize.BLOCK_VALUES', 500 * 7)
+    rng = np.random.default_rng(0)
+    ids, vectors = np.arange(1, 501), rng.normal(size=(500, 12))
+    vectors[7] = 0
+    norms = np.sqrt((vectors ** 2).sum(axis=1))
+    index = MatchIndex()
+    index.add(ids, np.zeros(500), vectors)
+
+    match_ids, scores = top_k_matches(ids, vectors, norms, 100, 500, 10)
+    for row in range(100, 500, 25):
+        expected_ids, expected_scores = index.top_k(ids[row], 0, vectors[row], 10)
+        assert match_ids[row - 100].tolist() == expected_ids.tolist()
+        assert np.allclose(scores[row - 100], expected_scores)
+    assert not np.isin(8, match_ids)
+    assert np.isneginf(top_k_matches(ids, vectors, norms, 7, 8, 10)[1]).all()
+    assert top_k_matches(ids[:3], vectors[:3], norms[:3], 0, 3, 10)[0].shape == (3, 2)
+
+
+def test_refresh_matches_is_incremental(tmp_path):
+    """test the materialized matches equal the live ones and only changed clusters are redone."""
+    sm = make_manager(tmp_path)
+    assert sm.refresh_matches(k=5, workers=2) == [0, 1, 2]
+    assert sm.refresh_matches(k=5, workers=2) == []
+
+    user = sm.session.query(UserData).filter(UserData.cluster == 1).first()
+    materialized, live = sm.materialized_matches(user, 5), sm.find_matches(user, 5)
+    assert [match.id for match in materialized] == [match.id for match in live]
+    assert np.allclose([match.cosine for match in materialized], [match.cosine for match in live])
+    assert sm.session.query(UserMatch).count() == 200 * 5
+
+    twin = UserData(name='twin', password='00000', cluster=1,
+                    **{column: value * 2 for column, value in
+                       zip(FACTOR_COLUMNS, factor_vector(user).tolist())})
+    sm.session.add(twin)
+    sm.session.commit()
+    assert sm.materialized_matches(twin, 5)[0].name == user.name
+    assert sm.refresh_matches(k=5, workers=2) == [1]
+    assert sm.materialized_matches(user, 5)[0].name == 'twin'
+
+
+def test_cluster_signatures_tell_swapped_members_apart(tmp_path):
+    """test moving users {1, 4} out of a cluster and {2, 3} in changes its signature."""
+    before = cluster_signatures([1, 2, 3, 4, 5], [0, 1, 1, 0, 0])
+    after = cluster_signatures([1, 2, 3, 4, 5], [1, 0, 0, 1, 0])
+    assert before[0][0] == after[0][0] == 3 and before[0] != after[0]
+    assert cluster_signatures([5, 4, 1], [0, 0, 0]) == {0: before[0]}
+
+    sm = make_manager(tmp_path, n_users=20, n_clusters=2)
+    sm.refresh_matches(k=3, workers=1)
+    # users 1 and 3 are in cluster 0, users 2 and 4 in cluster 1: swap 1 with 2 and 3 with 4
+    for user_id, cluster in [(1, 1), (3, 1), (2, 0), (4, 0)]:
+        sm.session.query(UserData).filter(UserData.id == user_id).update({'cluster': cluster})
+    sm.session.commit()
+    assert sm.refresh_matches(k=3, workers=1) == [0, 1]
@@ -0,0 +1,45 @@
+from src.metrics import Histogram, MetricsRegistry
+
+
+def test_histogram_renders_cumulative_buckets():
+    """test the Prometheus text format of a histogram."""
+    histogram = Histogram('latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1))
+    for value in [0.05, 0.5, 0.5, 3]:
+        histogram.observe(value, 'index')
+
+    lines = histogram.render()
+    assert lines[:2] == ['# HELP latency_seconds Latency.', '# TYPE latency_seconds histogram']
+    assert 'latency_seconds_bucket{route="index",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="index",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{route="index",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="index"} 4.05' in lines
+    assert 'latency_seconds_count{route="index"} 4' in lines
+
+
+def test_sampling_is_decided_per_request():
+    """test a sample rate of 0 records nothing and a sampled request times every stage."""
+    metrics = MetricsRegistry(sample_rate=0)
+    histogram = metrics.histogram('stage_seconds', 'Stages.', ('stage',))
+    with metrics.timer(histogram, 'predict'):
+        pass
+    assert histogram.snapshot() == {}
+
+    metrics.sample_rate = 1
+    metrics.start_request()
+    for stage in ['predict', 'predict', 'render']:
+        with metrics.timer(histogram, stage):
+            pass
+    metrics.end_request()
+    counts = {labels: sum(buckets) for labels, (buckets, _) in histogram.snapshot().items()}
+    assert counts == {('predict',): 2, ('render',): 1}
+
+
+def test_collectors_export_gauges():
+    """test numeric component metrics are exported and a failing collector is skipped."""
+    metrics = MetricsRegistry()
+    metrics.collector('match_cache', lambda: {'hits': 3, 'hit_ratio': 0.75, 'name': 'lru'})
+    metrics.collector('broken', lambda: 1 / 0)
+
+    text = metrics.render()
+    assert 'match_cache_hits 3.0\n' in text and 'match_cache_hit_ratio 0.75\n' in text
+    assert 'name' not in text and 'broken' not in text
@@ -0,0 +1,64 @@
+import sqlalchemy
+
+from src.create_db import Base, create_new_db
+from src.migrations import Migrator, MIGRATIONS, explain_hot_queries
+
+# user_data as created before any migration existed
+LEGACY_SCHEMA = ('CREATE TABLE user_data (id INTEGER PRIMARY KEY, name VARCHAR(50) NOT NULL, '
+                 'password VARCHAR(32) NOT NULL, '
+                 + ', '.join(f'factor{i} FLOAT NOT NULL' for i in range(1, 13))
+                 + ', cluster INTEGER NOT NULL, age FLOAT, gender FLOAT, image VARCHAR(28500))')
+
+
+def test_migrate_legacy_database(tmp_path):
+    """test pending migrations update a legacy table once, and the plans use the indexes."""
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    engine.execute(LEGACY_SCHEMA)
+    engine.execute("INSERT INTO user_data (name, password, "
+                   + ', '.join(f'factor{i}' for i in range(1, 13))
+                   + ", cluster) VALUES ('qiana', '00000', " + ', '.join(['0.5'] * 12) + ', 3)')
+    migrator = Migrator(engine)
+
+    assert len(migrator.migrate()) == len(MIGRATIONS)
+    assert migrator.migrate() == []
+
+    inspector = sqlalchemy.inspect(engine)
+    columns = {column['name'] for column in inspector.get_columns('user_data')}
+    assert {'norm', 'photo_hash', 'factors'} <= columns and 'photos' in inspector.get_table_names()
+    assert engine.execute('SELECT name, cluster FROM user_data').fetchall() == [('qiana', 3)]
+    plans = explain_hot_queries(engine)
+    assert 'ix_user_data_cluster' in ' '.join(plans['match'])
+    assert 'ix_user_data_name' in ' '.join(plans['login'])
+    assert 'SEARCH user_matches' in ' '.join(plans['materialized'])
+
+
+def test_stamp_new_database():
+    """test a schema created from the models starts with every migration recorded."""
+    engine = sqlalchemy.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    migrator = Migrator(engine)
+    migrator.stamp()
+    assert migrator.pending() == [] and migrator.applied() == {m.version for m in MIGRATIONS}
+
+
+def test_create_db_keeps_legacy_table_pending(tmp_path, monkeypatch):
+    """test create_db over a legacy table leaves every migration to `migrate`."""
+    url = f"sqlite:///{tmp_path / 'legacy.db'}"
+    engine = sqlalchemy.create_engine(url)
+    engine.execute(LEGACY_SCHEMA)
+    monkeypatch.setattr('src.create_db.SQLALCHEMY_DATABASE_URI', url)
+    create_new_db()
+    migrator = Migrator(engine)
+    assert migrator.pending() == MIGRATIONS
+
+    migrator.migrate()
+    columns = {column['name'] for column in sqlalchemy.inspect(engine).get_columns('user_data')}
+    assert {'norm', 'photo_hash', 'factors'} <= columns
+
+
+def test_create_db_stamps_new_database(tmp_path, monkeypatch):
+    """test create_db on an empty database records every migration as applied."""
+    url = f"sqlite:///{tmp_path / 'new.db'}"
+    monkeypatch.setattr('src.create_db.SQLALCHEMY_DATABASE_URI', url)
+    create_new_db()
+    assert Migrator(sqlalchemy.create_engine(url)).pending() == []
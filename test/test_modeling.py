@@ -3,13 +3,22 @@ import numpy as np
 from src.ingest import Ingest
 from src.modeling import OfflineModeling
 
-ingest = Ingest()
-data = ingest.download_data_from_s3()[0]
-fa, ca = ingest.download_model_from_s3()
 
+@pytest.fixture(scope='module')
+def data():
+    """raw seed data, read through the local artifact cache (set OFFLINE=1 to skip s3)."""
+    return Ingest().download_data_from_s3()[0]
 
-def test_cluster_happy():
+
+@pytest.fixture(scope='module')
+def saved_models():
+    """fitted models saved in s3, read through the local artifact cache."""
+    return Ingest().download_model_from_s3()
+
+
+def test_cluster_happy(data, saved_models):
     """test generated clusters are the same for models saved in s3 and newly trained models."""
+    fa, ca = saved_models
     # training
     models = OfflineModeling()
     models.fa.fit(data.iloc[:, 1:164])
@@ -28,7 +37,8 @@ def test_cluster_happy():
     assert cluster_test[0] == cluster_true[0]
 
 
-def test_cluster_unhappy():
+def test_cluster_unhappy(data, saved_models):
     """Test data with wrong dimensions generate error."""
+    fa, ca = saved_models
     with pytest.raises(ValueError):
         fa.transform(data)
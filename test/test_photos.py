@@ -0,0 +1,80 @@
+from base64 import b64encode
+from io import BytesIO
+
+from PIL import Image
+
+from src.create_db import Base, UserData, Photo, SurveyManager
+from src.matching import FACTOR_COLUMNS
+from src.migrations import Migrator
+from src.photos import photo_hash, make_thumbnail
+
+
+def make_png(width, height):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), color=(200, 30, 30)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_manager():
+    sm = SurveyManager(engine_string='sqlite://')
+    Base.metadata.create_all(sm.engine)
+    return sm
+
+
+def make_user(name, **kwargs):
+    return UserData(name=name, password='00000', cluster=0,
+                    **{column: 1.0 for column in FACTOR_COLUMNS}, **kwargs)
+
+
+def test_photos_are_deduplicated_and_thumbnailed():
+    """test identical uploads are stored once with a fixed-size thumbnail."""
+    sm = make_manager()
+    data = make_png(300, 200)
+    sm.session.add_all([make_user('a', photo_hash=sm.add_photo(data)),
+                        make_user('b', photo_hash=sm.add_photo(data))])
+    sm.session.commit()
+
+    assert sm.session.query(Photo).count() == 1
+    user = sm.session.query(UserData).filter_by(name='b').first()
+    original, etag = sm.get_photo(user.id)
+    thumbnail, thumb_etag = sm.get_photo(user.id, thumbnail=True)
+    assert original == data and etag == user.photo_hash
+    assert Image.open(BytesIO(thumbnail)).size == (96, 96)
+    assert thumb_etag != etag
+
+
+def test_photo_stored_concurrently_is_reused(tmp_path, monkeypatch):
+    """test a photo stored by another worker between the check and the insert is reused."""
+    url = f"sqlite:///{tmp_path / 'photos.db'}"
+    worker, other = SurveyManager(engine_string=url), SurveyManager(engine_string=url)
+    Base.metadata.create_all(worker.engine)
+    data = make_png(300, 200)
+
+    def thumbnail_while_other_stores(data):
+        thumbnail = make_thumbnail(data)
+        other.session.add(Photo(hash=photo_hash(data), data=data, thumbnail=thumbnail))
+        other.session.commit()
+        return thumbnail
+
+    monkeypatch.setattr('src.create_db.make_thumbnail', thumbnail_while_other_stores)
+    worker.session.add(make_user('a', photo_hash=worker.add_photo(data)))
+    worker.session.commit()
+
+    assert worker.session.query(Photo).count() == 1
+    user = worker.session.query(UserData).filter_by(name='a').first()
+    assert worker.get_photo(user.id)[0] == data
+
+
+def test_migrate_photos():
+    """test legacy base64 photos are converted to binary storage."""
+    sm = make_manager()
+    data = make_png(50, 50)
+    sm.session.add(make_user('legacy', image=b64encode(data).decode('utf-8')))
+    sm.session.commit()
+
+    Migrator(sm.engine).stamp()
+    sm.migrate_photos()
+
+    user = sm.session.query(UserData).filter_by(name='legacy').first()
+    assert user.image is None and user.has_photo
+    assert sm.get_photo(user.id)[0] == data
@@ -0,0 +1,85 @@
+import json
+import os
+import pickle
+
+import pytest
+
+from src.registry import ModelRegistry, LocalModelSource
+
+
+def write_models(root, fa, ca):
+    """pickle stand-in models into a local directory laid out like the s3 bucket."""
+    os.makedirs(os.path.join(root, 'model'), exist_ok=True)
+    for name, obj in (('fa', fa), ('ca', ca)):
+        with open(os.path.join(root, 'model', f'{name}.pkl'), 'wb') as f:
+            pickle.dump(obj, f)
+
+
+def make_registry(root):
+    return ModelRegistry(LocalModelSource(str(root)), paths=('model/fa.pkl', 'model/ca.pkl'),
+                         refresh_interval=0)
+
+
+def test_registry_loads_once(tmp_path):
+    """test models are only read from the source on the first call."""
+    write_models(tmp_path, {'model': 'fa'}, {'model': 'ca'})
+    registry = make_registry(tmp_path)
+
+    for _ in range(3):
+        fa, ca = registry.get()
+
+    assert fa == {'model': 'fa'} and ca == {'model': 'ca'}
+    assert registry.metrics() == {'hits': 2, 'misses': 1, 'refreshes': 0, 'refresh_errors': 0}
+
+
+def test_registry_refresh_swaps_changed_models(tmp_path):
+    """test refresh is a no-op for unchanged models and swaps in updated ones."""
+    write_models(tmp_path, 'fa', 'ca')
+    registry = make_registry(tmp_path)
+    registry.get()
+    assert not registry.refresh()
+
+    write_models(tmp_path, 'fa v2', 'ca v2')
+    assert registry.refresh()
+    assert registry.get() == ('fa v2', 'ca v2')
+    assert registry.metrics()['refreshes'] == 1
+
+
+def write_version(root, version, fa, ca, promote=True):
+    """archive stand-in models as a model version and, by default, promote its manifest."""
+    prefix = os.path.join(root, 'model', 'versions', f'v{version}')
+    os.makedirs(prefix, exist_ok=True)
+    for name, obj in (('fa', fa), ('ca', ca)):
+        with open(os.path.join(prefix, f'{name}.pkl'), 'wb') as f:
+            pickle.dump(obj, f)
+    for path in [os.path.join(prefix, 'manifest.json')] + \
+            ([os.path.join(root, 'model', 'manifest.json')] if promote else []):
+        with open(path, 'w') as f:
+            json.dump({'version': version}, f)
+
+
+def test_registry_reads_every_model_of_the_manifest_version(tmp_path):
+    """test only the manifest is polled and a half-promoted version is never mixed in."""
+    write_models(tmp_path, 'fa v1', 'ca v1')
+    write_version(tmp_path, 1, 'fa v1', 'ca v1')
+    registry = ModelRegistry(LocalModelSource(str(tmp_path)),
+                             paths=('model/fa.pkl', 'model/ca.pkl'), refresh_interval=0,
+                             manifest='model/manifest.json')
+    assert registry.get() == ('fa v1', 'ca v1')
+
+    # version 2 is archived and its factor model promoted, but not its manifest yet
+    write_version(tmp_path, 2, 'fa v2', 'ca v2', promote=False)
+    write_models(tmp_path, 'fa v2', 'ca v1')
+    assert not registry.refresh()
+    assert registry.get() == ('fa v1', 'ca v1')
+
+    write_version(tmp_path, 2, 'fa v2', 'ca v2')
+    assert registry.refresh()
+    assert registry.get() == ('fa v2', 'ca v2')
+
+    # a manifest naming a version whose archive is incomplete is rejected
+    with open(os.path.join(tmp_path, 'model', 'manifest.json'), 'w') as f:
+        json.dump({'version': 3}, f)
+    with pytest.raises(FileNotFoundError):
+        registry.refresh()
+    assert registry.get() == ('fa v2', 'ca v2')
@@ -0,0 +1,114 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+from factor_analyzer.factor_analyzer import FactorAnalyzer
+from sklearn.cluster import KMeans
+
+from src.modeling import score_survey, read_survey, read_table, write_table, compact_dtypes, \
+    update_cluster_model
+from src.registry import load_scorer
+from src.scoring import LinearScorer, nearest_centroid
+
+ITEMS = [f'{letter}{i}' for letter in 'ABC' for i in range(1, 9)]
+
+
+@pytest.fixture(scope='module')
+def survey():
+    """synthetic Likert answers with a few latent factors, laid out like the raw data csv."""
+    rng = np.random.default_rng(0)
+    latent = rng.normal(size=(600, 3))
+    answers = np.clip(np.rint(3 + latent @ rng.normal(size=(3, len(ITEMS)))
+                              + rng.normal(scale=0.5, size=(600, len(ITEMS)))), 1, 5)
+    data = pd.DataFrame(answers.astype(int), columns=ITEMS)
+    data.insert(0, 'user', np.arange(len(data)))
+    data['age'] = 30
+    return data
+
+
+@pytest.fixture(scope='module')
+def models(survey):
+    fa = FactorAnalyzer(n_factors=3, rotation='promax')
+    fa.fit(survey[ITEMS])
+    ca = KMeans(n_clusters=4, random_state=42, n_init=10)
+    ca.fit(fa.transform(survey[ITEMS]))
+    return fa, ca
+
+
+@pytest.mark.parametrize('extension', ['csv', 'parquet'])
+def test_score_survey_matches_single_pass(tmp_path, survey, models, extension):
+    """test chunked batch scoring gives the same factors and clusters as scoring all at once."""
+    fa, ca = models
+    input_path, output_path = str(tmp_path / f'in.{extension}'), str(tmp_path / f'out.{extension}')
+    if extension == 'csv':
+        survey.to_csv(input_path, index=False)
+    else:
+        survey.to_parquet(input_path, index=False)
+
+    assert score_survey(input_path, output_path, fa, ca, chunk_size=128) == len(survey)
+
+    scores = pd.read_csv(output_path) if extension == 'csv' else pd.read_parquet(output_path)
+    factors = fa.transform(survey[ITEMS].values)
+    assert scores['user'].tolist() == survey['user'].tolist()
+    assert np.allclose(scores[['factor1', 'factor2', 'factor3']].values, factors, atol=1e-5)
+    assert (scores['cluster'].values == ca.predict(factors)).all()
+
+
+def test_linear_scorer_matches_pickled_models(survey, models):
+    """test the .npy scoring artifact gives identical factors and clusters to the pickled models."""
+    fa, ca = (pickle.loads(pickle.dumps(model)) for model in models)
+    scorer = load_scorer(list(LinearScorer.from_models(fa, ca).to_bytes().values()))
+    answers = np.vstack([survey[ITEMS].values,
+                         np.random.default_rng(1).integers(1, 6, size=(200, len(ITEMS)))])
+
+    factors = scorer.transform(answers)
+
+    assert np.array_equal(factors, fa.transform(answers))
+    assert np.array_equal(scorer.predict(factors), ca.predict(factors))
+
+
+@pytest.mark.parametrize('extension', ['csv', 'parquet', 'feather'])
+def test_read_survey_projects_items_as_int8(tmp_path, survey, extension):
+    """test only the survey items are read back, with compact dtypes, whatever the format."""
+    path = str(tmp_path / f'data.{extension}')
+    write_table(compact_dtypes(survey), path)
+
+    items = read_survey(path)
+
+    assert items.columns.tolist() == ITEMS
+    assert (items.dtypes == np.int8).all()
+    assert np.array_equal(items.values, survey[ITEMS].values)
+
+
+def test_npy_tables_are_memory_mapped(tmp_path):
+    """test factors round trip through .npy as float32 without being read into memory."""
+    path = str(tmp_path / 'features.npy')
+    write_table(compact_dtypes(pd.DataFrame(np.random.default_rng(0).normal(size=(10, 3)))), path)
+
+    features = read_table(path)
+
+    assert isinstance(features, np.memmap) and features.dtype == np.float32
+
+
+def test_update_cluster_model_keeps_running_means(survey, models):
+    """test incremental updates move each centroid to the mean of all rows assigned to it."""
+    fa, ca = models
+    factors = fa.transform(survey[ITEMS])
+    old, new = factors[:400], factors[400:]
+    labels = ca.predict(old)
+    counts = np.bincount(labels, minlength=ca.n_clusters)
+    # start from exact means of the old rows so the running mean can be checked directly
+    ca = pickle.loads(pickle.dumps(ca))
+    ca.cluster_centers_ = np.array([old[labels == k].mean(axis=0) for k in range(ca.n_clusters)])
+
+    updated, updated_counts = update_cluster_model(ca, counts, [new[:1], new[1:]])
+
+    # the second batch is assigned to the centroids moved by the first one
+    moved, _ = update_cluster_model(ca, counts, [new[:1]])
+    assigned = np.concatenate([labels, nearest_centroid(new[:1], ca.cluster_centers_),
+                               nearest_centroid(new[1:], moved.cluster_centers_)])
+    assert updated is not ca
+    assert np.array_equal(updated_counts, np.bincount(assigned, minlength=ca.n_clusters))
+    for k in range(ca.n_clusters):
+        assert np.allclose(updated.cluster_centers_[k], factors[assigned == k].mean(axis=0))
@@ -0,0 +1,24 @@
+import numpy as np
+from factor_analyzer.factor_analyzer import FactorAnalyzer
+from sklearn.cluster import KMeans
+
+from src.sweep import run_sweep, standardize, RESULT_COLUMNS
+
+
+def test_sweep_matches_serial_fits():
+    """test every grid setting is fitted once in the pool and matches a fit in this process."""
+    rng = np.random.default_rng(0)
+    latent = rng.normal(size=(400, 3))
+    survey = np.clip(np.rint(3 + latent @ rng.normal(size=(3, 20))
+                             + rng.normal(scale=0.5, size=(400, 20))), 1, 5)
+
+    results = run_sweep(survey, n_factors=[2, 3], rotations=['promax', 'varimax'],
+                        n_clusters=[3, 4], workers=2, sample_size=200)
+
+    assert list(results.columns) == RESULT_COLUMNS
+    assert len(results) == 8
+    assert results['silhouette'].is_monotonic_decreasing
+    row = results.set_index(['n_factors', 'rotation', 'n_clusters']).loc[(3, 'promax', 4)]
+    factors = FactorAnalyzer(n_factors=3, rotation='promax').fit(survey).transform(survey)
+    assert np.isclose(row['inertia'], KMeans(n_clusters=4, random_state=42).fit(factors).inertia_)
+    assert np.allclose(standardize(survey).mean(axis=0), 0)